@@ -0,0 +1,76 @@
+"""Add indexes for the hot generation_tasks queries.
+
+Revision ID: add_generation_tasks_indexes
+Revises: add_user_bot_blocked_at
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_generation_tasks_indexes'
+down_revision: Union[str, None] = 'add_user_bot_blocked_at'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+ACTIVE_STATUSES = "status IN ('pending', 'processing')"
+
+
+def upgrade() -> None:
+    """Create the indexes without locking writes to generation_tasks (CONCURRENTLY)."""
+    with op.get_context().autocommit_block():
+        # User history (ORDER BY created_at DESC) and the hourly rate limit check
+        op.create_index(
+            'ix_generation_tasks_user_id_created_at',
+            'generation_tasks',
+            ['user_id', sa.text('created_at DESC')],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Recent generations, daily/hourly counts and sums
+        op.create_index(
+            'ix_generation_tasks_created_at',
+            'generation_tasks',
+            ['created_at'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Error and completion stats by period
+        op.create_index(
+            'ix_generation_tasks_status_created_at',
+            'generation_tasks',
+            ['status', 'created_at'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Tasks in the queue (live stats)
+        op.create_index(
+            'ix_generation_tasks_active_created_at',
+            'generation_tasks',
+            ['created_at'],
+            postgresql_where=sa.text(ACTIVE_STATUSES),
+            sqlite_where=sa.text(ACTIVE_STATUSES),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Drop the generation_tasks indexes."""
+    with op.get_context().autocommit_block():
+        for name in (
+            'ix_generation_tasks_active_created_at',
+            'ix_generation_tasks_status_created_at',
+            'ix_generation_tasks_created_at',
+            'ix_generation_tasks_user_id_created_at',
+        ):
+            op.drop_index(
+                name,
+                table_name='generation_tasks',
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
@@ -0,0 +1,85 @@
+"""Add rollup tables of the admin statistics.
+
+Revision ID: add_stats_rollups
+Revises: add_token_ledger
+Create Date: 2026-10-18
+
+The tables start empty; the first refresh of ``bot.services.stats_rollup``
+builds them from the whole history, later refreshes rebuild recent buckets.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_stats_rollups'
+down_revision: Union[str, None] = 'add_token_ledger'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Create the rollup tables and index users by registration time."""
+    op.create_table(
+        'task_stats_hourly',
+        sa.Column('hour', sa.DateTime(), nullable=False),
+        sa.Column('model', sa.String(length=50), nullable=False),
+        sa.Column('image_quality', sa.String(length=10), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('tasks', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('tokens_spent', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('hour', 'model', 'image_quality', 'status'),
+    )
+    op.create_table(
+        'task_stats_daily',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('model', sa.String(length=50), nullable=False),
+        sa.Column('image_quality', sa.String(length=10), nullable=False),
+        sa.Column('status', sa.String(length=20), nullable=False),
+        sa.Column('tasks', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('tokens_spent', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('day', 'model', 'image_quality', 'status'),
+    )
+    op.create_table(
+        'user_stats_daily',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('tasks', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('tokens_spent', sa.Integer(), nullable=False, server_default='0'),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('day', 'user_id'),
+    )
+    op.create_table(
+        'signup_stats_daily',
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('users', sa.Integer(), nullable=False, server_default='0'),
+        sa.PrimaryKeyConstraint('day'),
+    )
+
+    with op.get_context().autocommit_block():
+        # Signups of the refreshed days
+        op.create_index(
+            'ix_users_created_at',
+            'users',
+            ['created_at'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+
+def downgrade() -> None:
+    """Drop the rollup tables and the users index."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_users_created_at',
+            table_name='users',
+            postgresql_concurrently=True,
+            if_exists=True,
+        )
+
+    op.drop_table('signup_stats_daily')
+    op.drop_table('user_stats_daily')
+    op.drop_table('task_stats_daily')
+    op.drop_table('task_stats_hourly')
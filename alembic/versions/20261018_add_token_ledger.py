@@ -0,0 +1,175 @@
+"""Make transactions the append-only token ledger, add balance snapshots.
+
+Revision ID: add_token_ledger
+Revises: add_generation_tasks_indexes
+Create Date: 2026-10-18
+
+Before this revision only some balance changes wrote a transactions row.
+The missing history is backfilled from generation_tasks (charges and
+refunds of failed tasks) and payments (purchases), so finance stats read
+from the ledger cover the past as well. Backfilled rows describe balance
+changes users.tokens already contains: every user gets an opening snapshot
+of their current balance that covers all rows up to now, and compaction
+continues from there (``bot.services.ledger``).
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_token_ledger'
+down_revision: Union[str, None] = 'add_generation_tasks_indexes'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+BACKFILL_CHARGES = """
+INSERT INTO transactions (user_id, type, tokens_amount, description, task_id, created_at)
+SELECT t.user_id, 'generation', -t.tokens_spent,
+       CASE WHEN t.task_type = 'generate' THEN 'Генерация' ELSE 'Редактирование' END,
+       t.id, t.created_at
+FROM generation_tasks t
+WHERE t.tokens_spent > 0
+  AND NOT EXISTS (
+      SELECT 1 FROM transactions x WHERE x.task_id = t.id AND x.type = 'generation'
+  )
+"""
+
+BACKFILL_REFUNDS = """
+INSERT INTO transactions (user_id, type, tokens_amount, description, task_id, created_at)
+SELECT t.user_id, 'refund', t.tokens_spent, 'Возврат за неудачную генерацию',
+       t.id, COALESCE(t.updated_at, t.created_at)
+FROM generation_tasks t
+WHERE t.status = 'failed'
+  AND t.tokens_spent > 0
+  AND NOT EXISTS (
+      SELECT 1 FROM transactions x WHERE x.task_id = t.id AND x.type = 'refund'
+  )
+"""
+
+BACKFILL_PURCHASES = """
+INSERT INTO transactions (user_id, type, tokens_amount, description, payment_id, created_at)
+SELECT p.user_id, 'purchase', p.tokens_amount, 'Покупка пакета ' || p.package,
+       p.id, COALESCE(p.updated_at, p.created_at)
+FROM payments p
+WHERE p.status = 'succeeded'
+  AND p.is_gift = false
+  AND NOT EXISTS (
+      SELECT 1 FROM transactions x WHERE x.payment_id = p.id AND x.type = 'purchase'
+  )
+"""
+
+OPENING_SNAPSHOTS = """
+INSERT INTO token_balances (user_id, balance, spent, purchased, last_transaction_id)
+SELECT u.id, u.tokens,
+       COALESCE(totals.spent, 0), COALESCE(totals.purchased, 0),
+       (SELECT COALESCE(MAX(id), 0) FROM transactions)
+FROM users u
+LEFT JOIN (
+    SELECT user_id,
+           SUM(CASE WHEN type IN ('generation', 'refund') THEN -tokens_amount ELSE 0 END) AS spent,
+           SUM(CASE WHEN type = 'purchase' THEN tokens_amount ELSE 0 END) AS purchased
+    FROM transactions
+    GROUP BY user_id
+) totals ON totals.user_id = u.id
+"""
+
+APPEND_ONLY_FUNCTION = """
+CREATE OR REPLACE FUNCTION transactions_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'transactions is an append-only ledger: % is not allowed', TG_OP;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    """Create token_balances, index transactions, backfill the ledger and seed snapshots."""
+    op.create_table(
+        'token_balances',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('balance', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('spent', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('purchased', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('last_transaction_id', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id']),
+        sa.PrimaryKeyConstraint('user_id'),
+    )
+
+    with op.get_context().autocommit_block():
+        # A user's rows in order: history and the reconciliation tail
+        op.create_index(
+            'ix_transactions_user_id_id',
+            'transactions',
+            ['user_id', 'id'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Finance stats by type and period
+        op.create_index(
+            'ix_transactions_type_created_at',
+            'transactions',
+            ['type', 'created_at'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+        # Charge and refund rows of a task (refund_task checks for a refund)
+        op.create_index(
+            'ix_transactions_task_id',
+            'transactions',
+            ['task_id'],
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+    # Backfill and snapshots in one transaction: the snapshots cover exactly the rows they see
+    op.execute(BACKFILL_CHARGES)
+    op.execute(BACKFILL_REFUNDS)
+    op.execute(BACKFILL_PURCHASES)
+    op.execute(OPENING_SNAPSHOTS)
+
+    with op.get_context().autocommit_block():
+        # A task is refunded at most once; created after the backfill, which adds one refund per task
+        op.create_index(
+            'uq_transactions_task_id_refund',
+            'transactions',
+            ['task_id'],
+            unique=True,
+            postgresql_where=sa.text("type = 'refund'"),
+            sqlite_where=sa.text("type = 'refund'"),
+            postgresql_concurrently=True,
+            if_not_exists=True,
+        )
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute(APPEND_ONLY_FUNCTION)
+        op.execute(
+            "CREATE TRIGGER transactions_append_only BEFORE UPDATE OR DELETE ON transactions "
+            "FOR EACH ROW EXECUTE FUNCTION transactions_append_only()"
+        )
+
+
+def downgrade() -> None:
+    """Drop the snapshots, the indexes and the append-only trigger (backfilled rows stay)."""
+    with op.get_context().autocommit_block():
+        for name in (
+            'uq_transactions_task_id_refund',
+            'ix_transactions_task_id',
+            'ix_transactions_type_created_at',
+            'ix_transactions_user_id_id',
+        ):
+            op.drop_index(
+                name,
+                table_name='transactions',
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP TRIGGER IF EXISTS transactions_append_only ON transactions")
+        op.execute("DROP FUNCTION IF EXISTS transactions_append_only()")
+
+    op.drop_table('token_balances')
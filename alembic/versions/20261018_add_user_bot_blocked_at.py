@@ -0,0 +1,30 @@
+"""Add bot_blocked_at to users.
+
+Revision ID: add_user_bot_blocked_at
+Revises: add_tokens_non_negative
+Create Date: 2026-10-18
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'add_user_bot_blocked_at'
+down_revision: Union[str, None] = 'add_tokens_non_negative'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Add the column broadcasts use to skip users who blocked the bot."""
+    op.add_column(
+        'users',
+        sa.Column('bot_blocked_at', sa.DateTime(timezone=True), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    """Remove bot_blocked_at from users."""
+    op.drop_column('users', 'bot_blocked_at')
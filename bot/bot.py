@@ -1,10 +1,18 @@
-"""Aiogram Bot and Dispatcher initialization."""
+"""Aiogram Bot and Dispatcher initialization.
+
+The Bot returned by ``get_bot()`` is shared by the whole process: handlers,
+services, the progress animation and the RQ worker all send through one
+pooled aiohttp session instead of opening a new TLS connection per call.
+The session's rate limit middleware keeps all processes together within
+Telegram's message limits (``bot.services.telegram_rate_limit``).
+"""
 
 import logging
-from typing import Optional
+from typing import Any, Optional
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
 
@@ -17,17 +25,41 @@ _bot: Optional[Bot] = None
 _dp: Optional[Dispatcher] = None
 
 
+class PooledAiohttpSession(AiohttpSession):
+    """AiohttpSession with a bounded, keep-alive connection pool to api.telegram.org."""
+
+    def __init__(self, limit: int, keepalive_timeout: float, **kwargs: Any) -> None:
+        super().__init__(limit=limit, **kwargs)
+        # Keep idle connections open between sends instead of aiohttp's 15s default
+        self._connector_init["keepalive_timeout"] = keepalive_timeout
+        self._connector_init["limit_per_host"] = limit
+
+
 def get_bot() -> Bot:
-    """Get or create the Bot instance."""
+    """Get or create the shared Bot instance with a pooled session."""
     global _bot
     if _bot is None:
         if not config.bot_token:
             raise ValueError("BOT_TOKEN is not configured")
+        session = PooledAiohttpSession(
+            limit=config.telegram_pool_limit,
+            keepalive_timeout=config.telegram_keepalive_timeout,
+            timeout=config.telegram_request_timeout,
+        )
+        if config.telegram_global_rate > 0:
+            from bot.services.telegram_rate_limit import TelegramRateLimitMiddleware
+
+            session.middleware(TelegramRateLimitMiddleware())
         _bot = Bot(
             token=config.bot_token,
+            session=session,
             default=DefaultBotProperties(parse_mode=ParseMode.HTML),
         )
-        logger.info("Bot instance created")
+        logger.info(
+            f"Bot instance created (pool limit: {config.telegram_pool_limit}, "
+            f"keep-alive: {config.telegram_keepalive_timeout:.0f}s, "
+            f"rate limit: {config.telegram_global_rate or 'off'}/s)"
+        )
     return _bot
 
 
@@ -37,8 +69,9 @@ def get_dispatcher() -> Dispatcher:
     if _dp is None:
         if config.use_redis_fsm_storage:
             from aiogram.fsm.storage.redis import RedisStorage
+            from bot.redis_pool import get_redis
 
-            storage = RedisStorage.from_url(config.redis_url)
+            storage = RedisStorage(redis=get_redis())
             _dp = Dispatcher(storage=storage)
             logger.info("Dispatcher created with RedisStorage")
         else:
@@ -49,7 +82,7 @@ def get_dispatcher() -> Dispatcher:
 
 
 async def close_bot() -> None:
-    """Close bot session."""
+    """Close the shared bot session (application/worker shutdown hook)."""
     global _bot
     if _bot is not None:
         await _bot.session.close()
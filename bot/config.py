@@ -3,7 +3,7 @@
 import logging
 import os
 from dataclasses import dataclass, field
-from typing import List
+from typing import Dict, List
 from dotenv import load_dotenv
 
 _logger = logging.getLogger(__name__)
@@ -33,6 +33,22 @@ def _parse_int_list(value: str) -> List[int]:
         return []
 
 
+def _parse_int_map(value: str) -> Dict[str, int]:
+    """Parse comma-separated ``key=int`` pairs (queue weights and limits)."""
+    if not value:
+        return {}
+    result = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        key, _, number = item.partition("=")
+        try:
+            result[key.strip()] = int(number.strip())
+        except ValueError:
+            _logger.warning("Failed to parse %r in key=int list: %r", item, value)
+    return result
+
+
 @dataclass
 class Config:
     """Application configuration."""
@@ -46,6 +62,7 @@ class Config:
     
     # Redis
     redis_url: str
+    redis_pool_size: int  # Максимум async-соединений Redis на процесс
     
     # OpenAI
     openai_api_key: str
@@ -59,6 +76,10 @@ class Config:
     log_level: str
 
     telegram_request_timeout: float
+    telegram_pool_limit: int  # Максимум одновременных соединений с Bot API на процесс
+    telegram_keepalive_timeout: float  # Сколько держать простаивающие соединения с Bot API (сек)
+    telegram_global_rate: int  # Сообщений в секунду на весь бот, по всем процессам (0 - без лимита)
+    telegram_chat_rate: int  # Сообщений в секунду в один личный чат
     webhook_max_retries: int
     webhook_retry_delay_seconds: float
     webhook_retry_backoff: float
@@ -71,6 +92,43 @@ class Config:
     # Generation settings
     high_cost_threshold: int  # Порог для двойного подтверждения
     max_tasks_per_user_per_hour: int  # Rate limiting
+    max_inflight_tasks_per_user: int = 2  # Задач одного пользователя в очереди RQ одновременно (0 - без лимита)
+    progress_edits_per_second: float = 20.0  # Бюджет правок прогресс-сообщений в секунду
+
+    # Worker settings
+    worker_concurrency: int = 1  # Одновременных задач в одном процессе воркера
+    worker_drain_timeout: float = 300.0  # Сколько ждать текущие задачи при SIGTERM (сек)
+    # Веса полос очередей генерации (paid/light/heavy) для взвешенной выборки задач
+    generation_queue_weights: Dict[str, int] = field(
+        default_factory=lambda: {"paid": 6, "light": 3, "heavy": 1}
+    )
+    # Максимум одновременно выполняемых задач на очередь ("seedream:heavy=4"), по всем воркерам
+    generation_queue_limits: Dict[str, int] = field(default_factory=dict)
+
+    # Database pool settings
+    db_pool_size_app: int = 10  # Постоянных соединений пула webhook-приложения
+    db_max_overflow_app: int = 20  # Дополнительных соединений приложения при всплесках
+    db_pool_size_worker: int = 10  # Постоянных соединений пула воркера (не меньше WORKER_CONCURRENCY)
+    db_max_overflow_worker: int = 5  # Дополнительных соединений воркера
+    db_pool_size_analytics: int = 2  # Соединений для тяжёлой админ-статистики
+    db_max_overflow_analytics: int = 1  # Дополнительных соединений админ-статистики
+    db_pool_timeout: float = 10.0  # Сколько ждать свободное соединение пула (сек)
+    db_pool_recycle: int = 1800  # Переоткрывать соединения старше (сек), меньше idle-таймаута сервера/прокси
+    db_pool_pre_ping: bool = False  # Проверять соединение запросом при каждой выдаче из пула
+    db_statement_cache_size: int = 500  # Кэш prepared statements asyncpg на соединение (0 - для pgbouncer)
+    ledger_compaction_interval: int = 300  # Сжатие журнала токенов и сверка балансов раз в N сек (0 - выкл.)
+    stats_rollup_interval: int = 60  # Пересчёт сводных таблиц админ-статистики раз в N сек (0 - выкл.)
+
+    # Image provider HTTP settings
+    provider_request_timeout: float = 240.0  # Таймаут запроса к OpenAI/SeeDream (сек)
+    provider_connect_timeout: float = 10.0  # Таймаут установки соединения (сек)
+    provider_pool_limit: int = 20  # Максимум соединений на одного провайдера
+    provider_max_concurrency: int = 16  # Потолок адаптивного лимита запросов к модели по всем воркерам
+    provider_breaker_threshold: int = 5  # Перегрузок (429/5xx/таймаут) подряд до размыкания
+    provider_breaker_cooldown: float = 30.0  # Первая пауза разомкнутого провайдера (сек), дальше удваивается
+    download_timeout: float = 30.0  # Таймаут скачивания исходных/готовых изображений (сек)
+    source_download_concurrency: int = 4  # Сколько исходных фото edit качать параллельно
+    source_cache_max_mb: int = 512  # Размер кэша исходных фото в Redis (0 - выключен)
 
     # Admin settings
     admin_ids: List[int] = field(default_factory=list)  # Telegram IDs админов
@@ -106,6 +164,7 @@ def load_config() -> Config:
         webhook_url=os.getenv("WEBHOOK_URL", ""),
         database_url=os.getenv("DATABASE_URL", ""),
         redis_url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+        redis_pool_size=int(os.getenv("REDIS_POOL_SIZE", "50")),
         openai_api_key=os.getenv("OPENAI_API_KEY", ""),
         ark_api_key=os.getenv("ARK_API_KEY", ""),
         initial_tokens=int(os.getenv("INITIAL_TOKENS", "10")),
@@ -113,6 +172,10 @@ def load_config() -> Config:
         log_level=os.getenv("LOG_LEVEL", "INFO"),
 
         telegram_request_timeout=float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", "60")),
+        telegram_pool_limit=int(os.getenv("TELEGRAM_POOL_LIMIT", "100")),
+        telegram_keepalive_timeout=float(os.getenv("TELEGRAM_KEEPALIVE_TIMEOUT", "60")),
+        telegram_global_rate=int(os.getenv("TELEGRAM_GLOBAL_RATE", "30")),
+        telegram_chat_rate=int(os.getenv("TELEGRAM_CHAT_RATE", "1")),
         webhook_max_retries=int(os.getenv("WEBHOOK_MAX_RETRIES", "5")),
         webhook_retry_delay_seconds=float(os.getenv("WEBHOOK_RETRY_DELAY_SECONDS", "2")),
         webhook_retry_backoff=float(os.getenv("WEBHOOK_RETRY_BACKOFF", "2")),
@@ -127,6 +190,41 @@ def load_config() -> Config:
         # Generation settings
         high_cost_threshold=int(os.getenv("HIGH_COST_THRESHOLD", "20")),
         max_tasks_per_user_per_hour=int(os.getenv("MAX_TASKS_PER_USER_PER_HOUR", "20")),
+        max_inflight_tasks_per_user=int(os.getenv("MAX_INFLIGHT_TASKS_PER_USER", "2")),
+        progress_edits_per_second=float(os.getenv("PROGRESS_EDITS_PER_SECOND", "20")),
+
+        # Worker settings
+        worker_concurrency=int(os.getenv("WORKER_CONCURRENCY", "1")),
+        worker_drain_timeout=float(os.getenv("WORKER_DRAIN_TIMEOUT", "300")),
+        generation_queue_weights=_parse_int_map(
+            os.getenv("GENERATION_QUEUE_WEIGHTS", "paid=6,light=3,heavy=1")
+        ),
+        generation_queue_limits=_parse_int_map(os.getenv("GENERATION_QUEUE_LIMITS", "")),
+
+        # Database pool settings
+        db_pool_size_app=int(os.getenv("DB_POOL_SIZE_APP", "10")),
+        db_max_overflow_app=int(os.getenv("DB_MAX_OVERFLOW_APP", "20")),
+        db_pool_size_worker=int(os.getenv("DB_POOL_SIZE_WORKER", "10")),
+        db_max_overflow_worker=int(os.getenv("DB_MAX_OVERFLOW_WORKER", "5")),
+        db_pool_size_analytics=int(os.getenv("DB_POOL_SIZE_ANALYTICS", "2")),
+        db_max_overflow_analytics=int(os.getenv("DB_MAX_OVERFLOW_ANALYTICS", "1")),
+        db_pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        db_pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        db_pool_pre_ping=_parse_bool(os.getenv("DB_POOL_PRE_PING", "0"), default=False),
+        db_statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")),
+        ledger_compaction_interval=int(os.getenv("LEDGER_COMPACTION_INTERVAL", "300")),
+        stats_rollup_interval=int(os.getenv("STATS_ROLLUP_INTERVAL", "60")),
+
+        # Image provider HTTP settings
+        provider_request_timeout=float(os.getenv("PROVIDER_REQUEST_TIMEOUT", "240")),
+        provider_connect_timeout=float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "10")),
+        provider_pool_limit=int(os.getenv("PROVIDER_POOL_LIMIT", "20")),
+        provider_max_concurrency=int(os.getenv("PROVIDER_MAX_CONCURRENCY", "16")),
+        provider_breaker_threshold=int(os.getenv("PROVIDER_BREAKER_THRESHOLD", "5")),
+        provider_breaker_cooldown=float(os.getenv("PROVIDER_BREAKER_COOLDOWN", "30")),
+        download_timeout=float(os.getenv("DOWNLOAD_TIMEOUT", "30")),
+        source_download_concurrency=int(os.getenv("SOURCE_DOWNLOAD_CONCURRENCY", "4")),
+        source_cache_max_mb=int(os.getenv("SOURCE_CACHE_MAX_MB", "512")),
 
         # Admin settings
         admin_ids=_parse_int_list(os.getenv("ADMIN_IDS", "")),
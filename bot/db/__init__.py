@@ -1,6 +1,6 @@
 """Database module for the Telegram AI Image Bot."""
 
-from bot.db.database import Base, get_session_maker, get_engine, get_session, init_db, close_db
+from bot.db.database import Base, get_session_maker, get_engine, get_session, init_db, close_db, unit_of_work
 from bot.db.models import User, GenerationTask, Template
 from bot.db.repositories import UserRepository, TaskRepository
 
@@ -11,6 +11,7 @@ __all__ = [
     "get_session",
     "init_db",
     "close_db",
+    "unit_of_work",
     "User",
     "GenerationTask",
     "Template",
@@ -1,47 +1,302 @@
-"""Async SQLAlchemy database configuration."""
+"""Async SQLAlchemy database configuration.
 
-from typing import Optional
+Each process role has its own engine and pool profile (``POOL_PROFILES``):
 
+- ``app``       -> webhook handlers and the admin API of the FastAPI app
+- ``worker``    -> generation jobs (``worker.py`` switches the process to it)
+- ``analytics`` -> heavy admin statistics, in a small pool of their own so a
+  slow report never holds the connections webhook updates wait for
+
+The process role is ``app`` unless ``set_process_role`` changed it;
+``get_engine()``/``get_session_maker()`` without a role use it. Connections
+are not pinged on every checkout any more (``DB_POOL_PRE_PING``); they are
+recycled before server/proxy idle timeouts instead, and a connection that
+breaks anyway is invalidated with the pool. Pools record checkout metrics,
+see ``pool_stats``.
+
+Repository mutators commit their change, unless the session is a unit of
+work (``unit_of_work``): then they only send their statements and the block
+commits everything once at its end.
+"""
+
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Dict, Optional
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine, AsyncEngine
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from bot.config import config
 
+logger = logging.getLogger(__name__)
+
+ROLE_APP = "app"
+ROLE_WORKER = "worker"
+ROLE_ANALYTICS = "analytics"
+
+# A checkout that waits longer counts as slow
+SLOW_CHECKOUT_SECONDS = 0.05
+
+# Session.info flag of a unit of work
+UNIT_OF_WORK = "unit_of_work"
+
 
 class Base(DeclarativeBase):
     """Base class for all SQLAlchemy models."""
     pass
 
 
-# Engine and session maker will be initialized lazily
-_engine: Optional[AsyncEngine] = None
-_async_session_maker: Optional[async_sessionmaker[AsyncSession]] = None
+@dataclass(frozen=True)
+class PoolProfile:
+    """Connection pool settings of one process role."""
+
+    pool_size: int
+    max_overflow: int
+    timeout: float  # Seconds a checkout waits for a connection before failing
+    recycle: int  # Seconds after which a connection is reopened (-1 - never)
+    pre_ping: bool  # Test every connection with a round-trip on checkout
+
+
+POOL_PROFILES: Dict[str, PoolProfile] = {
+    ROLE_APP: PoolProfile(
+        pool_size=config.db_pool_size_app,
+        max_overflow=config.db_max_overflow_app,
+        timeout=config.db_pool_timeout,
+        recycle=config.db_pool_recycle,
+        pre_ping=config.db_pool_pre_ping,
+    ),
+    ROLE_WORKER: PoolProfile(
+        pool_size=config.db_pool_size_worker,
+        max_overflow=config.db_max_overflow_worker,
+        timeout=config.db_pool_timeout,
+        recycle=config.db_pool_recycle,
+        pre_ping=config.db_pool_pre_ping,
+    ),
+    ROLE_ANALYTICS: PoolProfile(
+        pool_size=config.db_pool_size_analytics,
+        max_overflow=config.db_max_overflow_analytics,
+        # Reports may wait for each other, webhook updates never wait for them
+        timeout=max(config.db_pool_timeout, 30.0),
+        recycle=config.db_pool_recycle,
+        pre_ping=config.db_pool_pre_ping,
+    ),
+}
+
+
+@dataclass
+class PoolMetrics:
+    """Checkout counters of one pool since the process started."""
+
+    checkouts: int = 0
+    slow_checkouts: int = 0  # Waited longer than SLOW_CHECKOUT_SECONDS
+    timeouts: int = 0  # No connection within the pool timeout
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    overflow_max: int = 0  # Most connections opened above pool_size at once
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, wait: float, overflow: int) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.overflow_max = max(self.overflow_max, overflow)
+            if wait > SLOW_CHECKOUT_SECONDS:
+                self.slow_checkouts += 1
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Queue pool that measures how long checkouts wait for a connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            record = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.record_timeout()
+            raise
+        self.metrics.record(time.perf_counter() - started, max(0, self.overflow()))
+        return record
+
+    def recreate(self):
+        # The pool is recreated after a disconnect; keep counting into the same metrics
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
 
+# Engines and session makers will be initialized lazily, one per role
+_process_role = ROLE_APP
+_engines: Dict[str, AsyncEngine] = {}
+_session_makers: Dict[str, async_sessionmaker[AsyncSession]] = {}
 
-def get_engine() -> AsyncEngine:
-    """Get or create the async database engine."""
-    global _engine
-    if _engine is None:
+
+def set_process_role(role: str) -> None:
+    """
+    Choose the pool profile of this process (call before the first query).
+
+    Args:
+        role: ROLE_APP or ROLE_WORKER
+    """
+    global _process_role
+    if role not in POOL_PROFILES:
+        raise ValueError(f"Unknown database role: {role}")
+    _process_role = role
+
+
+def _engine_kwargs(role: str) -> dict:
+    url = make_url(config.database_url)
+    if url.get_backend_name() == "sqlite":
+        # SQLite (local runs) keeps SQLAlchemy's default pool
+        return {}
+
+    profile = POOL_PROFILES[role]
+    kwargs = {
+        "poolclass": MeteredPool,
+        "pool_size": profile.pool_size,
+        "max_overflow": profile.max_overflow,
+        "pool_timeout": profile.timeout,
+        "pool_recycle": profile.recycle,
+        "pool_pre_ping": profile.pre_ping,
+    }
+    if url.get_driver_name() == "asyncpg":
+        kwargs["connect_args"] = {
+            # Prepared statements cached per connection; 0 behind pgbouncer in transaction mode
+            "prepared_statement_cache_size": config.db_statement_cache_size,
+            "statement_cache_size": config.db_statement_cache_size,
+            # Tells the roles apart in pg_stat_activity
+            "server_settings": {"application_name": f"telegram_bot:{role}"},
+        }
+    return kwargs
+
+
+def get_engine(role: Optional[str] = None) -> AsyncEngine:
+    """
+    Get or create the async database engine of a role.
+
+    Args:
+        role: Pool profile (default: the process role)
+    """
+    role = role or _process_role
+    engine = _engines.get(role)
+    if engine is None:
         if not config.database_url:
             raise ValueError("DATABASE_URL is not configured")
-        _engine = create_async_engine(
+        if role not in POOL_PROFILES:
+            raise ValueError(f"Unknown database role: {role}")
+        engine = create_async_engine(
             config.database_url,
             echo=False,
-            pool_pre_ping=True,
+            **_engine_kwargs(role),
         )
-    return _engine
+        _engines[role] = engine
+    return engine
+
 
+def get_session_maker(role: Optional[str] = None) -> async_sessionmaker[AsyncSession]:
+    """
+    Get or create the async session maker of a role.
 
-def get_session_maker() -> async_sessionmaker[AsyncSession]:
-    """Get or create the async session maker."""
-    global _async_session_maker
-    if _async_session_maker is None:
-        _async_session_maker = async_sessionmaker(
-            get_engine(),
+    Args:
+        role: Pool profile (default: the process role)
+    """
+    role = role or _process_role
+    session_maker = _session_makers.get(role)
+    if session_maker is None:
+        session_maker = async_sessionmaker(
+            get_engine(role),
             class_=AsyncSession,
             expire_on_commit=False,
         )
-    return _async_session_maker
+        _session_makers[role] = session_maker
+    return session_maker
+
+
+def pool_stats() -> Dict[str, dict]:
+    """
+    Current state and checkout metrics of every pool opened by this process.
+
+    Returns:
+        Dict role -> pool size, checked out and overflow connections, metrics
+    """
+    stats = {}
+    for role, engine in _engines.items():
+        pool = engine.pool
+        entry = {"pool": type(pool).__name__}
+        if isinstance(pool, MeteredPool):
+            metrics = pool.metrics
+            entry.update(
+                size=pool.size(),
+                checked_out=pool.checkedout(),
+                overflow=max(0, pool.overflow()),
+                **{k: v for k, v in asdict(metrics).items() if k != "wait_total"},
+                wait_avg=round(metrics.wait_total / metrics.checkouts, 4) if metrics.checkouts else 0.0,
+            )
+        stats[role] = entry
+    return stats
+
+
+@asynccontextmanager
+async def unit_of_work(
+    session: Optional[AsyncSession] = None,
+    role: Optional[str] = None,
+) -> AsyncIterator[AsyncSession]:
+    """
+    Batch repository mutations into one transaction.
+
+    Repository methods called with the session don't commit; the block
+    commits once when it ends and rolls everything back on an exception.
+
+    Args:
+        session: Session to batch on (default: a new session, closed at the end)
+        role: Pool profile of the new session
+
+    Example::
+
+        async with unit_of_work() as session:
+            await TaskRepository(session).update_status(task_id, status="failed")
+            await BalanceService(session).refund_task(task_id)
+    """
+    if session is None:
+        async with get_session_maker(role)() as new_session:
+            async with unit_of_work(new_session) as batched:
+                yield batched
+        return
+
+    outer = session.info.get(UNIT_OF_WORK, False)
+    session.info[UNIT_OF_WORK] = True
+    try:
+        yield session
+        if not outer:
+            await session.commit()
+    except BaseException:
+        if not outer:
+            await session.rollback()
+        raise
+    finally:
+        session.info[UNIT_OF_WORK] = outer
+
+
+async def commit_unless_batched(session: AsyncSession) -> None:
+    """Commit a repository mutation, unless it is part of a unit of work."""
+    if not session.info.get(UNIT_OF_WORK):
+        await session.commit()
 
 
 # Aliases for backward compatibility
@@ -71,8 +326,10 @@ async def init_db() -> None:
 
 async def close_db() -> None:
     """Close database connections."""
-    global _engine, _async_session_maker
-    if _engine is not None:
-        await _engine.dispose()
-        _engine = None
-        _async_session_maker = None
+    for role, stats in pool_stats().items():
+        logger.info(f"Database pool {role}: {stats}")
+    engines = list(_engines.values())
+    _engines.clear()
+    _session_makers.clear()
+    for engine in engines:
+        await engine.dispose()
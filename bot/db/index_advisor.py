@@ -0,0 +1,239 @@
+"""EXPLAIN the repository's hot queries and flag sequential scans.
+
+Usage::
+
+    python -m bot.db.index_advisor [--users 2000] [--tasks 50000] [--table generation_tasks]
+
+Runs against DATABASE_URL (PostgreSQL, or SQLite for a local check). Inside
+one transaction that is rolled back at the end it:
+
+1. seeds synthetic users and generation tasks spread over the last 30 days,
+   so the planner sees a table large enough for indexes to matter;
+2. runs every query of ``QUERY_SET`` through the real repository methods,
+   capturing the SQL they send;
+3. EXPLAINs each statement and reports sequential scans of the watched tables.
+
+Exit code is 1 if any watched table is scanned sequentially.
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Sequence, Tuple
+
+from sqlalchemy import event, insert, select, func
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession, create_async_engine
+
+from bot.config import config
+from bot.db.models import GenerationTask, User
+from bot.db.repositories import StatsRepository, TaskRepository, UserRepository
+
+# Telegram IDs of seeded users (far from real IDs)
+SEED_TELEGRAM_ID_BASE = 9_000_000_000
+
+STATUSES = ("done", "done", "done", "done", "failed", "pending", "processing")
+
+QueryCall = Callable[[AsyncSession, int, int], Awaitable[object]]
+
+# Repository queries on the request path and admin stats, called as (session, user_id, telegram_id)
+QUERY_SET: List[Tuple[str, QueryCall]] = [
+    ("UserRepository.get_by_telegram_id", lambda s, uid, tg: UserRepository(s).get_by_telegram_id(tg)),
+    ("TaskRepository.get_user_history", lambda s, uid, tg: TaskRepository(s).get_user_history(uid)),
+    ("TaskRepository.count_user_tasks_since", lambda s, uid, tg: TaskRepository(s).count_user_tasks_since(uid)),
+    ("StatsRepository.get_live_stats", lambda s, uid, tg: StatsRepository(s).get_live_stats()),
+    ("StatsRepository.get_error_stats", lambda s, uid, tg: StatsRepository(s).get_error_stats("24h")),
+    (
+        "StatsRepository.get_recent_generations",
+        lambda s, uid, tg: StatsRepository(s).get_recent_generations(period="today"),
+    ),
+]
+
+
+@dataclass
+class QueryReport:
+    """Plans of the statements one repository method sent."""
+
+    name: str
+    plans: List[List[str]] = field(default_factory=list)
+    seq_scans: List[str] = field(default_factory=list)
+    error: str = ""
+
+
+def _seq_scans(dialect: str, plan: Sequence[str], tables: Sequence[str]) -> List[str]:
+    """Plan lines that read a watched table without an index."""
+    found = []
+    for line in plan:
+        text = line.strip()
+        for table in tables:
+            if dialect == "postgresql" and f"Seq Scan on {table}" in text:
+                found.append(text)
+            elif dialect == "sqlite" and (
+                text.startswith(f"SCAN {table}") and "USING" not in text
+            ):
+                found.append(text)
+    return found
+
+
+async def seed(conn: AsyncConnection, users: int, tasks: int) -> None:
+    """Insert synthetic users and tasks (the caller rolls them back)."""
+    rng = random.Random(42)
+    now = datetime.now(timezone.utc)
+
+    await conn.execute(insert(User), [
+        {
+            "telegram_id": SEED_TELEGRAM_ID_BASE + i,
+            "username": f"seed_{i}",
+            "tokens": 0,
+            "api_tokens_spent": 0,
+            "selected_model": "gpt-image-1.5",
+            "image_quality": "medium",
+            "image_size": "1024x1024",
+        }
+        for i in range(users)
+    ])
+    user_ids = list((await conn.execute(
+        select(User.id).where(User.telegram_id >= SEED_TELEGRAM_ID_BASE)
+    )).scalars())
+
+    batch = []
+    for _ in range(tasks):
+        created_at = now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+        status = rng.choice(STATUSES)
+        batch.append({
+            # Skewed towards the first users: a few power users own thousands of tasks
+            "user_id": user_ids[int(len(user_ids) * rng.random() ** 3)],
+            "task_type": "generate",
+            "model": "gpt-image-1.5",
+            "image_quality": "medium",
+            "image_size": "1024x1024",
+            "prompt": "seed",
+            "status": status,
+            "tokens_spent": 1,
+            "api_tokens_spent": 0,
+            "images_count": 1,
+            "retry_count": 0,
+            "error_message": "seed error" if status == "failed" else None,
+            "created_at": created_at,
+            "updated_at": created_at + timedelta(seconds=rng.randint(10, 120)),
+        })
+        if len(batch) == 5000:
+            await conn.execute(insert(GenerationTask), batch)
+            batch = []
+    if batch:
+        await conn.execute(insert(GenerationTask), batch)
+
+    await conn.exec_driver_sql("ANALYZE")
+
+
+async def explain_query_set(
+    conn: AsyncConnection,
+    tables: Sequence[str] = ("generation_tasks",),
+) -> List[QueryReport]:
+    """
+    Run QUERY_SET on the connection and EXPLAIN every statement it sends.
+
+    Args:
+        conn: Connection inside an open transaction
+        tables: Tables whose sequential scans are reported
+
+    Returns:
+        One QueryReport per query of QUERY_SET
+    """
+    dialect = conn.dialect.name
+    explain_prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+
+    # The heaviest seeded user is the worst case of per-user queries
+    row = (await conn.execute(
+        select(GenerationTask.user_id, User.telegram_id)
+        .join(User, User.id == GenerationTask.user_id)
+        .group_by(GenerationTask.user_id, User.telegram_id)
+        .order_by(func.count(GenerationTask.id).desc())
+        .limit(1)
+    )).first()
+    user_id, telegram_id = row if row else (0, 0)
+
+    captured: List[Tuple[str, object]] = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    reports = []
+    session = AsyncSession(bind=conn, join_transaction_mode="create_savepoint")
+    for name, call in QUERY_SET:
+        report = QueryReport(name)
+        captured.clear()
+        event.listen(conn.sync_connection, "before_cursor_execute", capture)
+        try:
+            await call(session, user_id, telegram_id)
+        except Exception as e:
+            report.error = str(e).splitlines()[0]
+        finally:
+            event.remove(conn.sync_connection, "before_cursor_execute", capture)
+
+        for statement, parameters in list(captured):
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            result = await conn.exec_driver_sql(explain_prefix + statement, parameters)
+            if dialect == "sqlite":
+                plan = [row[-1] for row in result]
+            else:
+                plan = [row[0] for row in result]
+            report.plans.append(plan)
+            report.seq_scans.extend(_seq_scans(dialect, plan, tables))
+        reports.append(report)
+    await session.close()
+    return reports
+
+
+async def run(users: int, tasks: int, tables: Sequence[str]) -> int:
+    """Seed, explain and print the report; returns the exit code."""
+    engine = create_async_engine(config.database_url)
+    try:
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            try:
+                if users and tasks:
+                    print(f"Seeding {users} users and {tasks} tasks (rolled back afterwards)...")
+                    await seed(conn, users, tasks)
+                reports = await explain_query_set(conn, tables)
+            finally:
+                await transaction.rollback()
+    finally:
+        await engine.dispose()
+
+    flagged = 0
+    for report in reports:
+        status = "SEQ SCAN" if report.seq_scans else ("ERROR" if report.error else "ok")
+        print(f"\n[{status}] {report.name}")
+        if report.error:
+            print(f"    {report.error}")
+        for plan in report.plans:
+            for line in plan:
+                print(f"    {line}")
+            print()
+        if report.seq_scans:
+            flagged += 1
+
+    print(f"\n{flagged} of {len(reports)} queries scan {', '.join(tables)} sequentially")
+    return 1 if flagged else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000, help="Seeded users (0 - no seeding)")
+    parser.add_argument("--tasks", type=int, default=50000, help="Seeded generation tasks")
+    parser.add_argument(
+        "--table",
+        action="append",
+        dest="tables",
+        help="Table whose sequential scans are flagged (repeatable, default: generation_tasks)",
+    )
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.users, args.tasks, args.tables or ["generation_tasks"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 """SQLAlchemy models for the Telegram AI Image Bot."""
 
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional, List
 
-from sqlalchemy import BigInteger, Boolean, CheckConstraint, DateTime, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, Boolean, CheckConstraint, Date, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
@@ -44,16 +44,21 @@ class User(Base):
     updated_at: Mapped[Optional[datetime]] = mapped_column(
         DateTime(timezone=True), onupdate=func.now()
     )
+    # Set when a broadcast finds the user has blocked the bot; cleared on /start
+    bot_blocked_at: Mapped[Optional[datetime]] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
     
-    # Relationships
+    # Relationships are never loaded implicitly (lazy="raise"): a query that
+    # needs one asks for it with a loader profile (see bot.db.repositories)
     tasks: Mapped[List["GenerationTask"]] = relationship(
-        "GenerationTask", back_populates="user", lazy="selectin"
+        "GenerationTask", back_populates="user", lazy="raise"
     )
     referrer: Mapped[Optional["User"]] = relationship(
-        "User", remote_side=[id], foreign_keys=[referrer_id], lazy="selectin"
+        "User", remote_side=[id], foreign_keys=[referrer_id], lazy="raise"
     )
     referrals: Mapped[List["User"]] = relationship(
-        "User", back_populates="referrer", foreign_keys="User.referrer_id", lazy="selectin"
+        "User", back_populates="referrer", foreign_keys="User.referrer_id", lazy="raise"
     )
 
 
@@ -104,7 +109,28 @@ class GenerationTask(Base):
     )
     
     # Relationships
-    user: Mapped["User"] = relationship("User", back_populates="tasks")
+    user: Mapped["User"] = relationship("User", back_populates="tasks", lazy="raise")
+
+
+# Indexes of the hot generation_tasks queries (created by the 20261018 migration;
+# ``python -m bot.db.index_advisor`` checks the plans)
+# User history and the hourly rate limit check
+Index(
+    "ix_generation_tasks_user_id_created_at",
+    GenerationTask.user_id,
+    GenerationTask.created_at.desc(),
+)
+# Recent generations, daily/hourly counts and sums
+Index("ix_generation_tasks_created_at", GenerationTask.created_at)
+# Error and completion stats by period
+Index("ix_generation_tasks_status_created_at", GenerationTask.status, GenerationTask.created_at)
+# Tasks in the queue - a small fraction of the table
+Index(
+    "ix_generation_tasks_active_created_at",
+    GenerationTask.created_at,
+    postgresql_where=GenerationTask.status.in_(["pending", "processing"]),
+    sqlite_where=GenerationTask.status.in_(["pending", "processing"]),
+)
 
 
 class Template(Base):
@@ -155,7 +181,7 @@ class Payment(Base):
     )
     
     # Relationships
-    user: Mapped["User"] = relationship("User", lazy="selectin")
+    user: Mapped["User"] = relationship("User", lazy="raise")
 
 
 class Gift(Base):
@@ -189,12 +215,12 @@ class Gift(Base):
     )
     
     # Relationships
-    sender: Mapped["User"] = relationship("User", foreign_keys=[sender_id], lazy="selectin")
-    recipient: Mapped[Optional["User"]] = relationship("User", foreign_keys=[recipient_id], lazy="selectin")
+    sender: Mapped["User"] = relationship("User", foreign_keys=[sender_id], lazy="raise")
+    recipient: Mapped[Optional["User"]] = relationship("User", foreign_keys=[recipient_id], lazy="raise")
 
 
 class Transaction(Base):
-    """Transaction model for tracking all token movements."""
+    """Ledger row of a token movement (append-only, see ``bot.services.ledger``)."""
     
     __tablename__ = "transactions"
     
@@ -204,7 +230,7 @@ class Transaction(Base):
     )
     type: Mapped[str] = mapped_column(
         String(30), nullable=False
-    )  # purchase, referral_bonus, gift_received, gift_sent, generation, refund
+    )  # welcome_bonus, purchase, referral_bonus, gift_received, gift_sent, generation, refund, admin_grant, adjustment
     tokens_amount: Mapped[int] = mapped_column(Integer, nullable=False)  # positive = credit, negative = debit
     description: Mapped[str] = mapped_column(String(255), nullable=False)
     # Optional references
@@ -225,5 +251,92 @@ class Transaction(Base):
     )
     
     # Relationships
-    user: Mapped["User"] = relationship("User", foreign_keys=[user_id], lazy="selectin")
-    related_user: Mapped[Optional["User"]] = relationship("User", foreign_keys=[related_user_id], lazy="selectin")
+    user: Mapped["User"] = relationship("User", foreign_keys=[user_id], lazy="raise")
+    related_user: Mapped[Optional["User"]] = relationship("User", foreign_keys=[related_user_id], lazy="raise")
+
+
+# Ledger lookups (created by the 20261018 ledger migration)
+# A user's rows in order - history, reconciliation tail after the snapshot
+Index("ix_transactions_user_id_id", Transaction.user_id, Transaction.id)
+# Finance stats by type and period
+Index("ix_transactions_type_created_at", Transaction.type, Transaction.created_at)
+# Charge and refund rows of a task
+Index("ix_transactions_task_id", Transaction.task_id)
+# A task is refunded at most once
+Index(
+    "uq_transactions_task_id_refund",
+    Transaction.task_id,
+    unique=True,
+    postgresql_where=Transaction.type == "refund",
+    sqlite_where=Transaction.type == "refund",
+)
+
+
+class TokenBalance(Base):
+    """Compacted ledger totals of a user, up to ``last_transaction_id``."""
+    
+    __tablename__ = "token_balances"
+    
+    user_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("users.id"), primary_key=True
+    )
+    balance: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    spent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)  # Generation charges minus refunds
+    purchased: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    last_transaction_id: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
+
+
+# Rollups of the admin statistics (rebuilt by ``bot.services.stats_rollup``)
+class TaskStatsHourly(Base):
+    """Tasks created in an hour, per model, quality and status."""
+    
+    __tablename__ = "task_stats_hourly"
+    
+    hour: Mapped[datetime] = mapped_column(DateTime, primary_key=True)  # Start of the hour, UTC
+    model: Mapped[str] = mapped_column(String(50), primary_key=True)
+    image_quality: Mapped[str] = mapped_column(String(10), primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), primary_key=True)
+    tasks: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    tokens_spent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+class TaskStatsDaily(Base):
+    """Tasks created in a day (UTC), per model, quality and status."""
+    
+    __tablename__ = "task_stats_daily"
+    
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    model: Mapped[str] = mapped_column(String(50), primary_key=True)
+    image_quality: Mapped[str] = mapped_column(String(10), primary_key=True)
+    status: Mapped[str] = mapped_column(String(20), primary_key=True)
+    tasks: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    tokens_spent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+class UserStatsDaily(Base):
+    """Tasks a user created in a day (UTC); a row means the user was active."""
+    
+    __tablename__ = "user_stats_daily"
+    
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    user_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("users.id"), primary_key=True
+    )
+    tasks: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+    tokens_spent: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+class SignupStatsDaily(Base):
+    """Users registered in a day (UTC)."""
+    
+    __tablename__ = "signup_stats_daily"
+    
+    day: Mapped[date] = mapped_column(Date, primary_key=True)
+    users: Mapped[int] = mapped_column(Integer, default=0, nullable=False)
+
+
+# Signups by period (rollup refresh)
+Index("ix_users_created_at", User.created_at)
@@ -1,16 +1,42 @@
 """Repository classes for database CRUD operations."""
 
 import logging
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List
+from typing import Dict, Optional, List, Sequence, Tuple
 
-from sqlalchemy import select, desc, func
+from sqlalchemy import select, desc, func, insert, literal, update
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
 
 _logger = logging.getLogger(__name__)
 
 from bot.config import config
-from bot.db.models import User, GenerationTask
+from bot.db.database import commit_unless_batched
+from bot.db.models import (
+    User,
+    GenerationTask,
+    SignupStatsDaily,
+    TaskStatsDaily,
+    TaskStatsHourly,
+    TokenBalance,
+    Transaction,
+    UserStatsDaily,
+)
+
+
+# Loader profiles of User queries. Relationships are lazy="raise", so a query
+# loads exactly what its profile names and anything else fails loudly instead
+# of pulling the user's task history or referral list behind the caller's back.
+#
+# Session user: the users row only - handlers and middlewares, every update
+USER_SESSION_LOAD: tuple = ()
+# Profile: plus the user who invited them (one joined row)
+USER_PROFILE_LOAD = (joinedload(User.referrer),)
+
+# Mutators write with UPDATE/INSERT ... RETURNING and get the row back in the
+# same round-trip; populate_existing updates an instance the session already holds
+RETURNING_OPTIONS = {"populate_existing": True}
 
 
 class UserRepository:
@@ -19,34 +45,77 @@ class UserRepository:
     def __init__(self, session: AsyncSession):
         self.session = session
     
-    async def get_by_telegram_id(self, telegram_id: int) -> Optional[User]:
-        """Get user by Telegram ID."""
+    async def get_by_telegram_id(
+        self, telegram_id: int, load: tuple = USER_SESSION_LOAD
+    ) -> Optional[User]:
+        """Get user by Telegram ID (load - loader profile, USER_*_LOAD)."""
         result = await self.session.execute(
-            select(User).where(User.telegram_id == telegram_id)
+            select(User).where(User.telegram_id == telegram_id).options(*load)
         )
         return result.scalar_one_or_none()
     
-    async def get_by_id(self, user_id: int) -> Optional[User]:
-        """Get user by database ID."""
+    async def get_by_id(self, user_id: int, load: tuple = USER_SESSION_LOAD) -> Optional[User]:
+        """Get user by database ID (load - loader profile, USER_*_LOAD)."""
         result = await self.session.execute(
-            select(User).where(User.id == user_id)
+            select(User).where(User.id == user_id).options(*load)
         )
         return result.scalar_one_or_none()
     
-    async def get_by_username(self, username: str) -> Optional[User]:
-        """Get user by Telegram username (without @)."""
+    async def get_by_username(
+        self, username: str, load: tuple = USER_SESSION_LOAD
+    ) -> Optional[User]:
+        """Get user by Telegram username (without @; load - loader profile, USER_*_LOAD)."""
         result = await self.session.execute(
-            select(User).where(User.username == username)
+            select(User).where(User.username == username).options(*load)
         )
         return result.scalar_one_or_none()
     
     async def get_all_users(self) -> List[User]:
-        """Get all users for broadcast."""
+        """Get all users."""
         result = await self.session.execute(
             select(User).order_by(User.id)
         )
         return list(result.scalars().all())
     
+    async def get_broadcast_recipients(self, after_id: int, limit: int) -> List[Tuple[int, int]]:
+        """
+        Get the next page of broadcast recipients (users who haven't blocked the bot).
+        
+        Only two columns are read, without the ORM objects and their relationships.
+        
+        Args:
+            after_id: Last user ID of the previous page (0 for the first page)
+            limit: Page size
+        
+        Returns:
+            List of (user_id, telegram_id) ordered by user_id
+        """
+        result = await self.session.execute(
+            select(User.id, User.telegram_id)
+            .where(User.id > after_id, User.bot_blocked_at.is_(None))
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return [(row.id, row.telegram_id) for row in result]
+    
+    async def count_broadcast_recipients(self) -> int:
+        """Count users who haven't blocked the bot."""
+        result = await self.session.execute(
+            select(func.count(User.id)).where(User.bot_blocked_at.is_(None))
+        )
+        return result.scalar() or 0
+    
+    async def mark_bot_blocked(self, user_ids: List[int]) -> None:
+        """Exclude users who blocked the bot from future broadcasts."""
+        if not user_ids:
+            return
+        await self.session.execute(
+            update(User)
+            .where(User.id.in_(user_ids))
+            .values(bot_blocked_at=datetime.now(timezone.utc))
+        )
+        await commit_unless_batched(self.session)
+    
     async def get_or_create(
         self,
         telegram_id: int,
@@ -69,20 +138,36 @@ class UserRepository:
         user = await self.get_by_telegram_id(telegram_id)
         
         if user is not None:
+            if user.bot_blocked_at is not None:
+                # Unblocked the bot and came back - broadcasts reach them again
+                user.bot_blocked_at = None
+                await commit_unless_batched(self.session)
             return user, False
 
         # Create new user with initial tokens (7 free tokens)
-        user = User(
-            telegram_id=telegram_id,
-            username=username,
-            first_name=first_name,
-            tokens=config.initial_tokens,
-            api_tokens_spent=0,
-            referrer_id=referrer_id,
-        )
-        self.session.add(user)
-        await self.session.commit()
-        await self.session.refresh(user)
+        user = await self.session.scalar(
+            insert(User)
+            .values(
+                telegram_id=telegram_id,
+                username=username,
+                first_name=first_name,
+                tokens=config.initial_tokens,
+                api_tokens_spent=0,
+                referrer_id=referrer_id,
+            )
+            .returning(User)
+        )
+        if config.initial_tokens > 0:
+            # The balance is already set by the insert; record where it came from
+            await TransactionRepository(self.session).append([
+                LedgerEntry(
+                    user_id=user.id,
+                    amount=config.initial_tokens,
+                    type="welcome_bonus",
+                    description="Приветственный бонус",
+                )
+            ])
+        await commit_unless_batched(self.session)
         
         return user, True
     
@@ -107,37 +192,55 @@ class UserRepository:
             "total_referrals": total_referrals,
         }
     
-    async def update_tokens(self, user_id: int, tokens_delta: int) -> Optional[User]:
+    async def update_tokens(
+        self,
+        user_id: int,
+        tokens_delta: int,
+        type: str = "adjustment",
+        description: str = "Корректировка баланса",
+        **refs,
+    ) -> Optional[User]:
         """
-        Update user's token balance.
+        Update user's token balance through the ledger.
         
         Args:
             user_id: User's database ID
             tokens_delta: Amount to add (positive) or subtract (negative)
+            type: Ledger row type
+            description: Ledger row description
+            **refs: payment_id, gift_id, task_id, related_user_id of the row
         
         Returns:
-            Updated user or None if not found
+            Updated user or None if not found or the balance would go negative
         """
-        result = await self.session.execute(
-            select(User).where(User.id == user_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user is None:
-            return None
+        from bot.services.balance import InsufficientBalanceError
 
-        if tokens_delta < 0 and user.tokens + tokens_delta < 0:
+        try:
+            users = await TransactionRepository(self.session).post([
+                LedgerEntry(user_id, tokens_delta, type, description, **refs)
+            ])
+        except InsufficientBalanceError:
             _logger.warning(
-                "Refusing to set negative balance for user %s (current=%s, delta=%s)",
-                user_id, user.tokens, tokens_delta,
+                "Refusing to set negative balance for user %s (delta=%s) or user not found",
+                user_id, tokens_delta,
             )
             return None
+        return users[user_id]
 
-        user.tokens += tokens_delta
-        await self.session.commit()
-        await self.session.refresh(user)
-
-        return user
+    async def add_api_tokens(self, user_id: int, api_tokens: int) -> None:
+        """
+        Add to user's total API tokens spent (admin tracking).
+        
+        Args:
+            user_id: User's database ID
+            api_tokens: API tokens to add
+        """
+        await self.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(api_tokens_spent=User.api_tokens_spent + api_tokens)
+        )
+        await commit_unless_batched(self.session)
 
     async def update_model(self, user_id: int, model: str) -> Optional[User]:
         """
@@ -150,17 +253,15 @@ class UserRepository:
         Returns:
             Updated user or None if not found
         """
-        result = await self.session.execute(
-            select(User).where(User.id == user_id)
+        user = await self.session.scalar(
+            update(User)
+            .where(User.id == user_id)
+            .values(selected_model=model)
+            .returning(User)
+            .execution_options(**RETURNING_OPTIONS)
         )
-        user = result.scalar_one_or_none()
-        
-        if user is None:
-            return None
-        
-        user.selected_model = model
-        await self.session.commit()
-        await self.session.refresh(user)
+        if user is not None:
+            await commit_unless_batched(self.session)
         
         return user
 
@@ -172,26 +273,36 @@ class UserRepository:
     ) -> Optional[User]:
         """Update user's image generation settings."""
 
-        result = await self.session.execute(
-            select(User).where(User.id == user_id)
-        )
-        user = result.scalar_one_or_none()
-
-        if user is None:
-            return None
-
+        values = {}
         if image_quality is not None:
-            user.image_quality = image_quality
-
+            values["image_quality"] = image_quality
         if image_size is not None:
-            user.image_size = image_size
+            values["image_size"] = image_size
+        if not values:
+            return await self.get_by_id(user_id)
 
-        await self.session.commit()
-        await self.session.refresh(user)
+        user = await self.session.scalar(
+            update(User)
+            .where(User.id == user_id)
+            .values(**values)
+            .returning(User)
+            .execution_options(**RETURNING_OPTIONS)
+        )
+        if user is not None:
+            await commit_unless_batched(self.session)
 
         return user
 
 
+@dataclass
+class ChargedTask:
+    """Outcome of TaskRepository.create_charged."""
+
+    task: Optional[GenerationTask]  # None - nothing was charged or created
+    balance: Optional[int]  # Balance before the charge; None - user not found
+    recent_tasks: int  # User's tasks in the rate limit window before this one
+
+
 class TaskRepository:
     """Repository for GenerationTask CRUD operations."""
     
@@ -227,24 +338,198 @@ class TaskRepository:
         Returns:
             Created GenerationTask
         """
-        task = GenerationTask(
-            user_id=user_id,
-            task_type=task_type,
-            model=model,
-            image_quality=image_quality,
-            image_size=image_size,
-            prompt=prompt,
-            tokens_spent=tokens_spent,
-            source_image_url=source_image_url,
-            images_count=images_count,
-            status="pending",
-        )
-        self.session.add(task)
-        await self.session.commit()
-        await self.session.refresh(task)
+        task = await self.session.scalar(
+            insert(GenerationTask)
+            .values(
+                user_id=user_id,
+                task_type=task_type,
+                model=model,
+                image_quality=image_quality,
+                image_size=image_size,
+                prompt=prompt,
+                tokens_spent=tokens_spent,
+                source_image_url=source_image_url,
+                images_count=images_count,
+                status="pending",
+            )
+            .returning(GenerationTask)
+        )
+        await commit_unless_batched(self.session)
         
         return task
     
+    async def create_charged(
+        self,
+        user_id: int,
+        task_type: str,
+        prompt: str,
+        tokens_spent: int,
+        model: str = "gpt-image-1",
+        image_quality: str = "medium",
+        image_size: str = "1024x1024",
+        source_image_url: Optional[str] = None,
+        images_count: int = 1,
+        max_recent_tasks: Optional[int] = None,
+        recent_hours: int = 1,
+    ) -> ChargedTask:
+        """
+        Check the rate limit, deduct tokens, create the task and its ledger row atomically.
+        
+        On PostgreSQL this is one statement: data-modifying CTEs count the
+        user's recent tasks, deduct the balance only if it covers the cost and
+        the limit allows, insert the task from the charged row and the
+        "generation" transaction from the task. Nothing is written unless
+        every step succeeds. Other databases run the same steps in one
+        transaction.
+        
+        Args:
+            user_id: User's database ID
+            task_type: "generate" or "edit"
+            prompt: Text prompt for generation
+            tokens_spent: Tokens to deduct (task cost)
+            model: Model name
+            image_quality: Quality setting
+            image_size: Size setting
+            source_image_url: Source image for edit tasks
+            images_count: Number of input images (for edit tasks)
+            max_recent_tasks: Refuse if the user created this many tasks in
+                the last ``recent_hours`` (None - no limit)
+            recent_hours: Rate limit window in hours
+        
+        Returns:
+            ChargedTask with the created task, or task=None and what stopped it
+        """
+        since = datetime.now(timezone.utc) - timedelta(hours=recent_hours)
+        values = {
+            "task_type": task_type,
+            "model": model,
+            "image_quality": image_quality,
+            "image_size": image_size,
+            "prompt": prompt,
+            "source_image_url": source_image_url,
+            "status": "pending",
+            "tokens_spent": tokens_spent,
+            "api_tokens_spent": 0,
+            "images_count": images_count,
+            "retry_count": 0,
+        }
+        if self.session.get_bind().dialect.name == "postgresql":
+            return await self._create_charged_returning(
+                user_id, values, max_recent_tasks, since
+            )
+
+        recent_tasks = await self.count_user_tasks_since(user_id, hours=recent_hours)
+        balance = (await self.session.execute(
+            select(User.tokens).where(User.id == user_id)
+        )).scalar_one_or_none()
+        if (
+            balance is None
+            or (max_recent_tasks is not None and recent_tasks >= max_recent_tasks)
+            or balance < tokens_spent
+        ):
+            return ChargedTask(task=None, balance=balance, recent_tasks=recent_tasks)
+
+        charged = await self.session.execute(
+            update(User)
+            .where(User.id == user_id)
+            .where(User.tokens >= tokens_spent)
+            .values(tokens=User.tokens - tokens_spent)
+        )
+        if charged.rowcount == 0:
+            return ChargedTask(task=None, balance=balance, recent_tasks=recent_tasks)
+
+        task = await self.session.scalar(
+            insert(GenerationTask).values(user_id=user_id, **values).returning(GenerationTask)
+        )
+        await self.session.execute(
+            insert(Transaction).values(
+                user_id=user_id,
+                type="generation",
+                tokens_amount=-tokens_spent,
+                description=_generation_description(task_type),
+                task_id=task.id,
+            )
+        )
+        await commit_unless_batched(self.session)
+        return ChargedTask(task=task, balance=balance, recent_tasks=recent_tasks)
+
+    async def _create_charged_returning(
+        self,
+        user_id: int,
+        values: dict,
+        max_recent_tasks: Optional[int],
+        since: datetime,
+    ) -> ChargedTask:
+        """create_charged as a single PostgreSQL statement."""
+        cost = values["tokens_spent"]
+        columns = GenerationTask.__table__.c
+
+        recent = (
+            select(func.count(GenerationTask.id).label("n"))
+            .where(GenerationTask.user_id == user_id)
+            .where(GenerationTask.created_at >= since)
+            .cte("recent")
+        )
+        recent_n = select(recent.c.n).scalar_subquery()
+
+        charge = update(User).where(User.id == user_id).where(User.tokens >= cost)
+        if max_recent_tasks is not None:
+            charge = charge.where(recent_n < max_recent_tasks)
+        charged = charge.values(tokens=User.tokens - cost).returning(User.id).cte("charged")
+
+        task = (
+            insert(GenerationTask)
+            .from_select(
+                ["user_id", *values],
+                select(
+                    charged.c.id,
+                    *[literal(value, columns[name].type) for name, value in values.items()],
+                ),
+            )
+            .returning(GenerationTask.id, GenerationTask.created_at)
+            .cte("task")
+        )
+        ledger = (
+            insert(Transaction)
+            .from_select(
+                ["user_id", "type", "tokens_amount", "description", "task_id"],
+                select(
+                    literal(user_id),
+                    literal("generation"),
+                    literal(-cost),
+                    literal(_generation_description(values["task_type"])),
+                    task.c.id,
+                ),
+            )
+            .returning(Transaction.id)
+            .cte("ledger")
+        )
+
+        # Every part of the statement sees the rows as they were before it,
+        # so users.tokens here is the balance before the charge
+        row = (await self.session.execute(
+            select(
+                User.tokens,
+                recent_n,
+                select(task.c.id).scalar_subquery(),
+                select(task.c.created_at).scalar_subquery(),
+            )
+            .where(User.id == user_id)
+            .add_cte(ledger)
+        )).first()
+        await commit_unless_batched(self.session)
+
+        if row is None:
+            return ChargedTask(task=None, balance=None, recent_tasks=0)
+        balance, recent_tasks, task_id, created_at = row
+        if task_id is None:
+            return ChargedTask(task=None, balance=balance, recent_tasks=recent_tasks)
+        return ChargedTask(
+            task=GenerationTask(id=task_id, user_id=user_id, created_at=created_at, **values),
+            balance=balance,
+            recent_tasks=recent_tasks,
+        )
+
     async def update_status(
         self,
         task_id: int,
@@ -270,36 +555,50 @@ class TaskRepository:
         Returns:
             Updated task or None if not found
         """
-        result = await self.session.execute(
-            select(GenerationTask).where(GenerationTask.id == task_id)
-        )
-        task = result.scalar_one_or_none()
-        
-        if task is None:
-            return None
-        
-        task.status = status
+        values = {"status": status}
         
         if result_image_url is not None:
-            task.result_image_url = result_image_url
+            values["result_image_url"] = result_image_url
 
         if result_file_id is not None:
-            task.result_file_id = result_file_id
+            values["result_file_id"] = result_file_id
         
         if error_message is not None:
-            task.error_message = error_message
+            values["error_message"] = error_message
         
         if increment_retry:
-            task.retry_count += 1
+            values["retry_count"] = GenerationTask.retry_count + 1
         
         if api_tokens_spent is not None:
-            task.api_tokens_spent = api_tokens_spent
-        
-        await self.session.commit()
-        await self.session.refresh(task)
+            values["api_tokens_spent"] = api_tokens_spent
+        
+        task = await self.session.scalar(
+            update(GenerationTask)
+            .where(GenerationTask.id == task_id)
+            .values(**values)
+            .returning(GenerationTask)
+            .execution_options(**RETURNING_OPTIONS)
+        )
+        if task is not None:
+            await commit_unless_batched(self.session)
         
         return task
     
+    async def set_result_file_id(self, task_id: int, file_id: str) -> None:
+        """
+        Remember Telegram file_id of a task result.
+        
+        Args:
+            task_id: Task's database ID
+            file_id: Telegram file_id of the sent document
+        """
+        await self.session.execute(
+            update(GenerationTask)
+            .where(GenerationTask.id == task_id)
+            .values(result_file_id=file_id)
+        )
+        await commit_unless_batched(self.session)
+    
     async def get_user_history(
         self,
         user_id: int,
@@ -355,8 +654,25 @@ class TaskRepository:
         return result.scalar() or 0
 
 
+# Ledger row types the finance stats add up
+TOKENS_GIVEN_TYPES = ("welcome_bonus", "referral_bonus", "admin_grant")
+TOKENS_SPENT_TYPES = ("generation", "refund")
+
+
+def _generation_description(task_type: str) -> str:
+    """Ledger description of a task charge."""
+    return "Генерация" if task_type == "generate" else "Редактирование"
+
+
 class StatsRepository:
-    """Repository for statistics queries."""
+    """
+    Repository for statistics queries.
+    
+    Task, signup and activity counters read the rollup tables that
+    ``bot.services.stats_rollup`` refreshes in the background, so they lag
+    up to STATS_ROLLUP_INTERVAL behind. Live stats and the recent
+    generation/error lists still read generation_tasks along its indexes.
+    """
     
     def __init__(self, session: AsyncSession):
         self.session = session
@@ -371,7 +687,7 @@ class StatsRepository:
     async def get_total_tasks(self) -> int:
         """Get total number of tasks."""
         result = await self.session.execute(
-            select(func.count(GenerationTask.id))
+            select(func.sum(TaskStatsDaily.tasks))
         )
         return result.scalar() or 0
     
@@ -379,43 +695,44 @@ class StatsRepository:
         """Get task counts grouped by status."""
         result = await self.session.execute(
             select(
-                GenerationTask.status,
-                func.count(GenerationTask.id)
-            ).group_by(GenerationTask.status)
+                TaskStatsDaily.status,
+                func.sum(TaskStatsDaily.tasks)
+            ).group_by(TaskStatsDaily.status)
         )
         return {row[0]: row[1] for row in result.all()}
     
     async def get_total_tokens_spent(self) -> int:
-        """Get total tokens spent across all tasks."""
+        """Get tokens spent on generations (net of refunds) as of the last ledger compaction."""
         result = await self.session.execute(
-            select(func.sum(GenerationTask.tokens_spent))
+            select(func.sum(TokenBalance.spent))
         )
         return result.scalar() or 0
     
     async def get_tasks_today(self) -> int:
-        """Get number of tasks created today."""
-        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        """Get number of tasks created today (UTC)."""
+        today = datetime.now(timezone.utc).date()
         result = await self.session.execute(
-            select(func.count(GenerationTask.id))
-            .where(GenerationTask.created_at >= today)
+            select(func.sum(TaskStatsDaily.tasks))
+            .where(TaskStatsDaily.day == today)
         )
         return result.scalar() or 0
     
     async def get_users_today(self) -> int:
-        """Get number of users registered today."""
-        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        """Get number of users registered today (UTC)."""
+        today = datetime.now(timezone.utc).date()
         result = await self.session.execute(
-            select(func.count(User.id))
-            .where(User.created_at >= today)
+            select(SignupStatsDaily.users)
+            .where(SignupStatsDaily.day == today)
         )
         return result.scalar() or 0
     
     async def get_active_users_today(self) -> int:
-        """Get number of users who created tasks today."""
-        today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        """Get number of users who created tasks today (UTC)."""
+        today = datetime.now(timezone.utc).date()
         result = await self.session.execute(
-            select(func.count(func.distinct(GenerationTask.user_id)))
-            .where(GenerationTask.created_at >= today)
+            select(func.count())
+            .select_from(UserStatsDaily)
+            .where(UserStatsDaily.day == today)
         )
         return result.scalar() or 0
     
@@ -423,56 +740,36 @@ class StatsRepository:
         """
         Get top users by number of tasks with token information.
         
+        Tokens spent and purchased are the user's compacted ledger totals
+        (token_balances), as of the last compaction.
+        
         Returns:
             List of tuples: (telegram_id, username, first_name, task_count, current_tokens, tokens_spent, tokens_purchased)
         """
-        from bot.db.models import Payment
-        
-        # Subquery for tokens purchased
-        tokens_purchased_subquery = (
+        # Rank on the per-day rollup first, join users for the top rows only
+        top = (
             select(
-                Payment.user_id,
-                func.coalesce(func.sum(Payment.tokens_amount), 0).label("tokens_purchased")
+                UserStatsDaily.user_id,
+                func.sum(UserStatsDaily.tasks).label("task_count"),
             )
-            .where(Payment.status == "succeeded")
-            .group_by(Payment.user_id)
-            .subquery()
-        )
-        
-        # Subquery for tokens spent
-        tokens_spent_subquery = (
-            select(
-                GenerationTask.user_id,
-                func.coalesce(func.sum(GenerationTask.tokens_spent), 0).label("tokens_spent")
-            )
-            .group_by(GenerationTask.user_id)
+            .group_by(UserStatsDaily.user_id)
+            .order_by(desc("task_count"))
+            .limit(limit)
             .subquery()
         )
-        
         result = await self.session.execute(
             select(
                 User.telegram_id,
                 User.username,
                 User.first_name,
-                func.count(GenerationTask.id).label("task_count"),
+                top.c.task_count,
                 User.tokens.label("current_tokens"),
-                func.coalesce(tokens_spent_subquery.c.tokens_spent, 0).label("tokens_spent"),
-                func.coalesce(tokens_purchased_subquery.c.tokens_purchased, 0).label("tokens_purchased")
-            )
-            .join(GenerationTask, User.id == GenerationTask.user_id)
-            .outerjoin(tokens_spent_subquery, User.id == tokens_spent_subquery.c.user_id)
-            .outerjoin(tokens_purchased_subquery, User.id == tokens_purchased_subquery.c.user_id)
-            .group_by(
-                User.id,
-                User.telegram_id,
-                User.username,
-                User.first_name,
-                User.tokens,
-                tokens_spent_subquery.c.tokens_spent,
-                tokens_purchased_subquery.c.tokens_purchased
+                func.coalesce(TokenBalance.spent, 0).label("tokens_spent"),
+                func.coalesce(TokenBalance.purchased, 0).label("tokens_purchased")
             )
-            .order_by(desc("task_count"))
-            .limit(limit)
+            .join(top, User.id == top.c.user_id)
+            .outerjoin(TokenBalance, User.id == TokenBalance.user_id)
+            .order_by(desc(top.c.task_count), User.id)
         )
         return result.all()
     
@@ -480,9 +777,9 @@ class StatsRepository:
         """Get task counts grouped by model."""
         result = await self.session.execute(
             select(
-                GenerationTask.model,
-                func.count(GenerationTask.id)
-            ).group_by(GenerationTask.model)
+                TaskStatsDaily.model,
+                func.sum(TaskStatsDaily.tasks)
+            ).group_by(TaskStatsDaily.model)
         )
         return {row[0]: row[1] for row in result.all()}
     
@@ -560,11 +857,12 @@ class StatsRepository:
         else:  # week
             time_ago = datetime.now(timezone.utc) - timedelta(days=7)
         
-        # Total errors
+        # Total errors, in whole hours from the hourly rollup
+        since_hour = time_ago.replace(tzinfo=None, minute=0, second=0, microsecond=0)
         total_errors_result = await self.session.execute(
-            select(func.count(GenerationTask.id))
-            .where(GenerationTask.status == "failed")
-            .where(GenerationTask.created_at >= time_ago)
+            select(func.sum(TaskStatsHourly.tasks))
+            .where(TaskStatsHourly.status == "failed")
+            .where(TaskStatsHourly.hour >= since_hour)
         )
         total_errors = total_errors_result.scalar() or 0
         
@@ -593,7 +891,7 @@ class StatsRepository:
     
     async def get_financial_stats(self, days: int = 30) -> dict:
         """
-        Get financial statistics.
+        Get financial statistics from the token ledger.
         
         Args:
             days: Number of days to look back
@@ -605,37 +903,30 @@ class StatsRepository:
         
         time_ago = datetime.now(timezone.utc) - timedelta(days=days)
         
-        # Total tokens given (initial + referral bonuses)
         total_users_result = await self.session.execute(
-            select(func.count(User.id))
-            .where(User.created_at >= time_ago)
+            select(func.sum(SignupStatsDaily.users))
+            .where(SignupStatsDaily.day >= time_ago.date())
         )
         new_users = total_users_result.scalar() or 0
-        tokens_given = new_users * config.initial_tokens
         
-        # Tokens spent
-        tokens_spent_result = await self.session.execute(
-            select(func.sum(GenerationTask.tokens_spent))
-            .where(GenerationTask.created_at >= time_ago)
-        )
-        tokens_spent = tokens_spent_result.scalar() or 0
-        
-        # Tokens purchased (from payments)
-        from bot.db.models import Payment
-        tokens_purchased_result = await self.session.execute(
-            select(func.sum(Payment.tokens_amount))
-            .where(Payment.status == "succeeded")
-            .where(Payment.created_at >= time_ago)
+        # One pass over the period's rows along ix_transactions_type_created_at
+        ledger_result = await self.session.execute(
+            select(
+                Transaction.type,
+                func.sum(Transaction.tokens_amount),
+                func.count(Transaction.id),
+            )
+            .where(Transaction.type.in_([*TOKENS_GIVEN_TYPES, *TOKENS_SPENT_TYPES, "purchase"]))
+            .where(Transaction.created_at >= time_ago)
+            .group_by(Transaction.type)
         )
-        tokens_purchased = tokens_purchased_result.scalar() or 0
+        totals = {type_: (amount or 0, count) for type_, amount, count in ledger_result.all()}
         
-        # Number of purchases
-        purchases_count_result = await self.session.execute(
-            select(func.count(Payment.id))
-            .where(Payment.status == "succeeded")
-            .where(Payment.created_at >= time_ago)
-        )
-        purchases_count = purchases_count_result.scalar() or 0
+        # Initial tokens, referral bonuses and admin grants
+        tokens_given = sum(totals.get(type_, (0, 0))[0] for type_ in TOKENS_GIVEN_TYPES)
+        # Generation charges are negative, refunds positive
+        tokens_spent = -sum(totals.get(type_, (0, 0))[0] for type_ in TOKENS_SPENT_TYPES)
+        tokens_purchased, purchases_count = totals.get("purchase", (0, 0))
         
         # Average purchase
         avg_purchase = tokens_purchased // purchases_count if purchases_count > 0 else 0
@@ -726,18 +1017,20 @@ class PaymentRepository:
         """Create a new payment record."""
         from bot.db.models import Payment
         
-        payment = Payment(
-            user_id=user_id,
-            yookassa_payment_id=yookassa_payment_id,
-            package=package,
-            tokens_amount=tokens_amount,
-            amount_value=amount_value,
-            confirmation_url=confirmation_url,
-            status=status,
+        payment = await self.session.scalar(
+            insert(Payment)
+            .values(
+                user_id=user_id,
+                yookassa_payment_id=yookassa_payment_id,
+                package=package,
+                tokens_amount=tokens_amount,
+                amount_value=amount_value,
+                confirmation_url=confirmation_url,
+                status=status,
+            )
+            .returning(Payment)
         )
-        self.session.add(payment)
-        await self.session.commit()
-        await self.session.refresh(payment)
+        await commit_unless_batched(self.session)
         
         return payment
     
@@ -773,7 +1066,19 @@ class PaymentRepository:
             .limit(1)
         )
         return result.scalar_one_or_none()
-    
+
+    async def has_succeeded_payment(self, user_id: int) -> bool:
+        """Check whether the user has at least one succeeded payment."""
+        from bot.db.models import Payment
+
+        result = await self.session.execute(
+            select(Payment.id)
+            .where(Payment.user_id == user_id)
+            .where(Payment.status == "succeeded")
+            .limit(1)
+        )
+        return result.scalar_one_or_none() is not None
+
     async def update_status(
         self,
         payment_id: int,
@@ -783,18 +1088,15 @@ class PaymentRepository:
         """Update payment status."""
         from bot.db.models import Payment
         
-        result = await self.session.execute(
-            select(Payment).where(Payment.id == payment_id)
+        payment = await self.session.scalar(
+            update(Payment)
+            .where(Payment.id == payment_id)
+            .values(status=status, paid=paid)
+            .returning(Payment)
+            .execution_options(**RETURNING_OPTIONS)
         )
-        payment = result.scalar_one_or_none()
-        
-        if payment is None:
-            return None
-        
-        payment.status = status
-        payment.paid = paid
-        await self.session.commit()
-        await self.session.refresh(payment)
+        if payment is not None:
+            await commit_unless_batched(self.session)
         
         return payment
 
@@ -820,17 +1122,19 @@ class GiftRepository:
         # Remove @ if present
         recipient_username = recipient_username.lstrip("@")
         
-        gift = Gift(
-            sender_id=sender_id,
-            recipient_username=recipient_username,
-            package=package,
-            tokens_amount=tokens_amount,
-            payment_id=payment_id,
-            status=status,
+        gift = await self.session.scalar(
+            insert(Gift)
+            .values(
+                sender_id=sender_id,
+                recipient_username=recipient_username,
+                package=package,
+                tokens_amount=tokens_amount,
+                payment_id=payment_id,
+                status=status,
+            )
+            .returning(Gift)
         )
-        self.session.add(gift)
-        await self.session.commit()
-        await self.session.refresh(gift)
+        await commit_unless_batched(self.session)
         
         return gift
     
@@ -869,24 +1173,22 @@ class GiftRepository:
     ) -> Optional["Gift"]:
         """Update gift status."""
         from bot.db.models import Gift
-        from datetime import datetime
-        
-        result = await self.session.execute(
-            select(Gift).where(Gift.id == gift_id)
-        )
-        gift = result.scalar_one_or_none()
-        
-        if gift is None:
-            return None
         
-        gift.status = status
+        values = {"status": status}
         if recipient_id:
-            gift.recipient_id = recipient_id
+            values["recipient_id"] = recipient_id
         if status == "claimed":
-            gift.claimed_at = datetime.now(timezone.utc)
-        
-        await self.session.commit()
-        await self.session.refresh(gift)
+            values["claimed_at"] = datetime.now(timezone.utc)
+        
+        gift = await self.session.scalar(
+            update(Gift)
+            .where(Gift.id == gift_id)
+            .values(**values)
+            .returning(Gift)
+            .execution_options(**RETURNING_OPTIONS)
+        )
+        if gift is not None:
+            await commit_unless_batched(self.session)
         
         return gift
     
@@ -903,41 +1205,102 @@ class GiftRepository:
         return list(result.scalars().all())
 
 
+@dataclass
+class LedgerEntry:
+    """One token movement for TransactionRepository.post."""
+
+    user_id: int
+    amount: int  # positive = credit, negative = debit
+    type: str
+    description: str
+    payment_id: Optional[int] = None
+    gift_id: Optional[int] = None
+    task_id: Optional[int] = None
+    related_user_id: Optional[int] = None
+
+
 class TransactionRepository:
-    """Repository for Transaction CRUD operations."""
+    """Repository of the token ledger (Transaction rows).
+    
+    Rows are only ever inserted. ``users.tokens`` is the balance the ledger
+    adds up to, changed in the same transaction as the rows (``post``).
+    """
     
     def __init__(self, session: AsyncSession):
         self.session = session
     
-    async def create(
-        self,
-        user_id: int,
-        type: str,
-        tokens_amount: int,
-        description: str,
-        payment_id: Optional[int] = None,
-        gift_id: Optional[int] = None,
-        task_id: Optional[int] = None,
-        related_user_id: Optional[int] = None,
-    ) -> "Transaction":
-        """Create a new transaction record."""
-        from bot.db.models import Transaction
-        
-        transaction = Transaction(
-            user_id=user_id,
-            type=type,
-            tokens_amount=tokens_amount,
-            description=description,
-            payment_id=payment_id,
-            gift_id=gift_id,
-            task_id=task_id,
-            related_user_id=related_user_id,
-        )
-        self.session.add(transaction)
-        await self.session.commit()
-        await self.session.refresh(transaction)
-        
-        return transaction
+    async def post(self, entries: Sequence[LedgerEntry]) -> Dict[int, User]:
+        """
+        Apply entries to the balances and append them to the ledger.
+        
+        One UPDATE ... RETURNING per user (debits first, guarded against a
+        negative balance) and one multi-row INSERT for all entries.
+        
+        Args:
+            entries: Token movements, possibly of several users
+        
+        Returns:
+            Dict user ID -> updated user
+        
+        Raises:
+            InsufficientBalanceError: A debit exceeds the balance or the user
+                doesn't exist. Balances of other users in the same call may
+                already be updated - post multi-user debits in a unit of work.
+        """
+        from bot.services.balance import InsufficientBalanceError
+
+        deltas: Dict[int, int] = {}
+        for entry in entries:
+            deltas[entry.user_id] = deltas.get(entry.user_id, 0) + entry.amount
+
+        users: Dict[int, User] = {}
+        for user_id, delta in sorted(deltas.items(), key=lambda item: (item[1] >= 0, item[0])):
+            stmt = (
+                update(User)
+                .where(User.id == user_id)
+                .values(tokens=User.tokens + delta)
+            )
+            if delta < 0:
+                stmt = stmt.where(User.tokens + delta >= 0)
+            user = await self.session.scalar(
+                stmt.returning(User).execution_options(**RETURNING_OPTIONS)
+            )
+            if user is None:
+                available = await self.session.scalar(
+                    select(User.tokens).where(User.id == user_id)
+                )
+                raise InsufficientBalanceError(required=-delta, available=available or 0)
+            users[user_id] = user
+
+        await self.append(entries)
+        await commit_unless_batched(self.session)
+        return users
+    
+    async def append(self, entries: Sequence[LedgerEntry]) -> None:
+        """
+        Insert ledger rows without touching balances.
+        
+        Only for movements whose balance change the caller already wrote
+        in the same transaction (new user's initial tokens).
+        """
+        if not entries:
+            return
+        await self.session.execute(
+            insert(Transaction),
+            [
+                {
+                    "user_id": entry.user_id,
+                    "type": entry.type,
+                    "tokens_amount": entry.amount,
+                    "description": entry.description,
+                    "payment_id": entry.payment_id,
+                    "gift_id": entry.gift_id,
+                    "task_id": entry.task_id,
+                    "related_user_id": entry.related_user_id,
+                }
+                for entry in entries
+            ],
+        )
     
     async def get_user_transactions(
         self,
@@ -952,14 +1315,13 @@ class TransactionRepository:
             limit: Maximum number of transactions
             only_credits: If True, only return positive transactions (purchases, bonuses)
         """
-        from bot.db.models import Transaction
-        
         query = select(Transaction).where(Transaction.user_id == user_id)
         
         if only_credits:
             query = query.where(Transaction.tokens_amount > 0)
         
+        # Newest first along ix_transactions_user_id_id
         result = await self.session.execute(
-            query.order_by(desc(Transaction.created_at)).limit(limit)
+            query.order_by(desc(Transaction.id)).limit(limit)
         )
         return list(result.scalars().all())
@@ -7,7 +7,6 @@ Commands:
 - /addtokens <user_id> <amount> - Add tokens to user
 """
 
-import asyncio
 import logging
 from datetime import datetime
 
@@ -19,8 +18,8 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
 
 from bot.config import config
-from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, StatsRepository
+from bot.db.database import ROLE_ANALYTICS, get_session_maker, unit_of_work
+from bot.db.repositories import USER_PROFILE_LOAD, UserRepository, StatsRepository
 from bot.states.admin import BroadcastStates
 
 logger = logging.getLogger(__name__)
@@ -257,7 +256,7 @@ async def stats_command(message: Message) -> None:
 
 async def _send_stats(message_or_callback) -> None:
     """Send statistics message."""
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -324,7 +323,7 @@ async def admin_top_users_callback(callback: CallbackQuery) -> None:
         await callback.answer("❌ Нет доступа")
         return
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -371,7 +370,7 @@ async def admin_model_usage_callback(callback: CallbackQuery) -> None:
         await callback.answer("❌ Нет доступа")
         return
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -464,8 +463,13 @@ async def add_tokens_command(message: Message) -> None:
             return
         
         old_balance = user.tokens
-        await user_repo.update_tokens(user.id, amount)
-        new_balance = old_balance + amount
+        credited = await user_repo.update_tokens(
+            user.id, amount, type="admin_grant", description="Начисление от администратора"
+        )
+        if credited is None:
+            await message.answer(f"❌ Не удалось начислить токены пользователю {identifier}")
+            return
+        new_balance = credited.tokens
     
     await message.answer(
         f"✅ <b>Токены добавлены</b>\n\n"
@@ -505,11 +509,11 @@ async def user_info_command(message: Message) -> None:
         
         # Search by username or telegram_id
         if identifier.startswith("@"):
-            user = await user_repo.get_by_username(identifier[1:])
+            user = await user_repo.get_by_username(identifier[1:], load=USER_PROFILE_LOAD)
         else:
             try:
                 telegram_id = int(identifier)
-                user = await user_repo.get_by_telegram_id(telegram_id)
+                user = await user_repo.get_by_telegram_id(telegram_id, load=USER_PROFILE_LOAD)
             except ValueError:
                 await message.answer("❌ Неверный формат ID")
                 return
@@ -526,6 +530,12 @@ async def user_info_command(message: Message) -> None:
         done_count = sum(1 for t in history if t.status == "done")
         failed_count = sum(1 for t in history if t.status == "failed")
     
+    referrer = user.referrer
+    if referrer is None:
+        referrer_text = "—"
+    else:
+        referrer_text = f"@{referrer.username}" if referrer.username else f"<code>{referrer.telegram_id}</code>"
+    
     await message.answer(
         f"👤 <b>Информация о пользователе</b>\n\n"
         f"<b>Telegram ID:</b> <code>{user.telegram_id}</code>\n"
@@ -534,7 +544,8 @@ async def user_info_command(message: Message) -> None:
         f"<b>Баланс:</b> {user.tokens} 🪙\n"
         f"<b>Модель:</b> {user.selected_model}\n"
         f"<b>Качество:</b> {user.image_quality}\n"
-        f"<b>Размер:</b> {user.image_size}\n\n"
+        f"<b>Размер:</b> {user.image_size}\n"
+        f"<b>Пригласил:</b> {referrer_text}\n\n"
         f"<b>Задачи:</b>\n"
         f"  • Всего: {len(history)}\n"
         f"  • Успешных: {done_count}\n"
@@ -626,17 +637,40 @@ async def reset_user_command(message: Message) -> None:
             return
         
         # Save old values for report
-        old_tokens = user.tokens
         old_model = user.selected_model
         old_quality = user.image_quality
         old_size = user.image_size
         
-        # Reset to defaults
-        user.tokens = config.initial_tokens
-        user.selected_model = "gpt-image-1.5"
-        user.image_quality = "medium"
-        user.image_size = "1024x1024"
-        await session.commit()
+        # Reset to defaults, the balance through the ledger, in one commit
+        refused = False
+        async with unit_of_work(session):
+            from sqlalchemy import select
+            from bot.db.models import User
+            
+            # Lock the row: a credit or debit landing after the read would skew the delta
+            old_tokens = await session.scalar(
+                select(User.tokens).where(User.id == user.id).with_for_update()
+            )
+            if old_tokens is None:
+                # Deleted meanwhile
+                refused = True
+            elif old_tokens != config.initial_tokens:
+                refused = await user_repo.update_tokens(
+                    user.id,
+                    config.initial_tokens - old_tokens,
+                    type="adjustment",
+                    description="Сброс баланса администратором",
+                ) is None
+            if not refused:
+                user.selected_model = "gpt-image-1.5"
+                user.image_quality = "medium"
+                user.image_size = "1024x1024"
+    
+    if refused:
+        await message.answer(
+            f"❌ Не удалось сбросить баланс пользователя {identifier}, попробуйте ещё раз"
+        )
+        return
     
     await message.answer(
         f"✅ <b>Пользователь сброшен</b>\n\n"
@@ -695,7 +729,7 @@ async def admin_generations_filter_callback(callback: CallbackQuery) -> None:
 
 async def _send_generations(callback_or_message, filter_val: str = "last20") -> None:
     """Send generations list."""
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -794,7 +828,7 @@ async def admin_errors_filter_callback(callback: CallbackQuery) -> None:
 
 async def _send_errors(callback_or_message, period: str = "24h") -> None:
     """Send error statistics."""
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -840,7 +874,7 @@ async def admin_finance_callback(callback: CallbackQuery) -> None:
         await callback.answer("❌ Нет доступа")
         return
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -874,7 +908,7 @@ async def admin_live_callback(callback: CallbackQuery) -> None:
         await callback.answer("❌ Нет доступа")
         return
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -931,7 +965,7 @@ async def admin_export_callback(callback: CallbackQuery) -> None:
     
     await callback.answer("📥 Генерирую Excel файл...")
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -1243,64 +1277,20 @@ async def broadcast_confirm(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.message.edit_text("❌ Ошибка: сообщение не найдено")
         return
     
-    await callback.message.edit_text("📤 Начинаю рассылку...")
-    
-    # Get all users
-    session_maker = get_session_maker()
-    async with session_maker() as session:
-        user_repo = UserRepository(session)
-        users = await user_repo.get_all_users()
-    
-    total = len(users)
-    success = 0
-    failed = 0
+    from bot.services.broadcast import create_broadcast
     
-    # Send progress updates every 50 users
-    progress_message = await callback.message.answer(
-        f"📤 Рассылка: 0/{total} (0%)"
-    )
-    
-    from aiogram import Bot
-    bot = Bot(token=config.bot_token)
-    
-    for i, user in enumerate(users):
-        try:
-            await bot.copy_message(
-                chat_id=user.telegram_id,
-                from_chat_id=chat_id,
-                message_id=message_id,
-            )
-            success += 1
-        except Exception as e:
-            failed += 1
-            logger.warning(f"Failed to send broadcast to {user.telegram_id}: {e}")
-        
-        # Update progress every 50 users
-        if (i + 1) % 50 == 0 or (i + 1) == total:
-            percent = (i + 1) * 100 // total
-            try:
-                await progress_message.edit_text(
-                    f"📤 Рассылка: {i + 1}/{total} ({percent}%)\n"
-                    f"✅ Успешно: {success}\n"
-                    f"❌ Ошибок: {failed}"
-                )
-            except Exception:
-                pass
-        
-        # Small delay to avoid rate limits
-        await asyncio.sleep(0.05)
-    
-    await bot.session.close()
-    
-    # Final report
-    await progress_message.edit_text(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📊 <b>Итоги:</b>\n"
-        f"  • Всего: {total}\n"
-        f"  • Успешно: {success}\n"
-        f"  • Ошибок: {failed}\n\n"
-        f"<i>Ошибки обычно означают, что пользователь заблокировал бота.</i>"
+    await callback.message.edit_text("📤 Начинаю рассылку...")
+    progress_message = await callback.message.answer("📤 Рассылка: подготовка...")
+    
+    # Sent in the background: the webhook returns at once, and the broadcast
+    # resumes from its checkpoint if the app restarts
+    broadcast = await create_broadcast(
+        from_chat_id=chat_id,
+        message_id=message_id,
+        admin_chat_id=progress_message.chat.id,
+        progress_message_id=progress_message.message_id,
     )
+    logger.info(f"Admin {callback.from_user.id} started broadcast {broadcast.id}")
 
 
 # ============== File ID helper for admins ==============
@@ -8,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 
 from bot.config import config
 from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.db.repositories import UserRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import (
     estimate_image_tokens,
@@ -792,23 +792,20 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     
     async with session_maker() as session:
         balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
         
         try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-            
             # Create task with source image (store all file_ids as JSON if multiple)
             source_data = source_file_id
             if source_file_ids and len(source_file_ids) > 1:
                 import json
                 source_data = json.dumps(source_file_ids)
             
-            task = await task_repo.create(
-                user_id=user_id,
+            # Deduct tokens, create the task and its ledger row atomically
+            task = await balance_service.create_paid_task(
+                user_id,
+                cost,
                 task_type="edit",
                 prompt=prompt,
-                tokens_spent=cost,
                 model=model,
                 image_quality=quality,
                 image_size=size,
@@ -836,64 +833,11 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     state_data = await state.get_data()  # Save data before clearing
     await state.clear()
     
-    # Forward source photos to monitoring channel
-    photo_message_ids = state_data.get("photo_message_ids", [])
-    photo_chat_id = state_data.get("photo_chat_id")
-    
-    logger.info(f"Monitoring check: channel_id={config.monitoring_channel_id}, photo_msgs={len(photo_message_ids)}, chat_id={photo_chat_id}")
-    
-    if photo_message_ids and photo_chat_id and config.monitoring_channel_id:
-        try:
-            from aiogram import Bot
-            
-            bot = Bot(token=config.bot_token)
-            
-            logger.info(f"Forwarding {len(photo_message_ids)} photos to monitoring channel {config.monitoring_channel_id}")
-            
-            # Get user info for monitoring
-            session_maker_mon = get_session_maker()
-            async with session_maker_mon() as session_mon:
-                user_repo_mon = UserRepository(session_mon)
-                user_mon = await user_repo_mon.get_by_id(user_id)
-                
-                if user_mon:
-                    # Forward photos directly using bot
-                    for msg_id in photo_message_ids:
-                        await bot.forward_message(
-                            chat_id=config.monitoring_channel_id,
-                            from_chat_id=photo_chat_id,
-                            message_id=msg_id,
-                        )
-                        logger.info(f"Forwarded message {msg_id} to monitoring channel")
-                    
-                    # Send info message
-                    user_display = f"@{user_mon.username}" if user_mon.username else user_mon.first_name or f"ID:{user_mon.telegram_id}"
-                    
-                    info_text = (
-                        f"📸 <b>Исходные фото (edit)</b>\n\n"
-                        f"<b>Пользователь:</b> {user_display}\n"
-                        f"<b>Telegram ID:</b> <code>{user_mon.telegram_id}</code>\n"
-                        f"<b>Количество фото:</b> {len(photo_message_ids)}\n\n"
-                        f"<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
-                    )
-                    
-                    await bot.send_message(
-                        chat_id=config.monitoring_channel_id,
-                        text=info_text,
-                        parse_mode="HTML",
-                    )
-                    
-                    logger.info(f"Sent monitoring info message for user {user_mon.telegram_id}")
-            
-            await bot.session.close()
-            
-        except Exception as e:
-            logger.error(f"Failed to forward photos to monitoring: {e}")
-    
     # Start progress animation immediately
     from bot.utils.progress_animation import ProgressAnimator
     
     progress_animator = ProgressAnimator(
+        task_id=task.id,
         telegram_id=callback.from_user.id,
         bot_token=config.bot_token,
         task_type="edit",
@@ -903,8 +847,8 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     
     # Enqueue task to RQ
     try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
+        from bot.tasks.generation import enqueue_task
+        await enqueue_task(task)
     except Exception as e:
         logger.error(f"Failed to enqueue task {task.id}: {e}")
     
@@ -912,6 +856,22 @@ async def confirm_edit(callback: CallbackQuery, state: FSMContext) -> None:
     await callback.message.delete()
     await callback.answer("Редактирование запущено! ⏳")
 
+    # Copy the sources to the monitoring channel last: it waits for the channel's
+    # rate limit (bounded) and must not delay the task or the callback answer
+    from bot.bot import get_bot
+    from bot.services.monitoring import forward_source_message_ids_to_monitoring
+    
+    await forward_source_message_ids_to_monitoring(
+        get_bot(),
+        state_data.get("photo_chat_id"),
+        state_data.get("photo_message_ids", []),
+        callback.from_user.id,
+        callback.from_user.username,
+        callback.from_user.first_name,
+        prompt,
+        task_type="edit",
+    )
+
 
 @router.callback_query(
     EditStates.confirm_edit,
@@ -949,22 +909,20 @@ async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) ->
     session_maker = get_session_maker()
     async with session_maker() as session:
         balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
 
         try:
-            await balance_service.deduct_tokens(user_id, cost)
-
             # Store all file_ids as JSON if multiple
             source_data = source_file_id
             if source_file_ids and len(source_file_ids) > 1:
                 import json
                 source_data = json.dumps(source_file_ids)
 
-            task = await task_repo.create(
-                user_id=user_id,
+            # Deduct tokens, create the task and its ledger row atomically
+            task = await balance_service.create_paid_task(
+                user_id,
+                cost,
                 task_type="edit",
                 prompt=prompt,
-                tokens_spent=cost,
                 model=model,
                 image_quality=quality,
                 image_size=size,
@@ -991,64 +949,11 @@ async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) ->
     state_data = await state.get_data()  # Save data before clearing
     await state.clear()
 
-    # Forward source photos to monitoring channel
-    photo_message_ids = state_data.get("photo_message_ids", [])
-    photo_chat_id = state_data.get("photo_chat_id")
-    
-    logger.info(f"Monitoring check (expensive): channel_id={config.monitoring_channel_id}, photo_msgs={len(photo_message_ids)}, chat_id={photo_chat_id}")
-    
-    if photo_message_ids and photo_chat_id and config.monitoring_channel_id:
-        try:
-            from aiogram import Bot
-            
-            bot = Bot(token=config.bot_token)
-            
-            logger.info(f"Forwarding {len(photo_message_ids)} photos to monitoring channel {config.monitoring_channel_id}")
-            
-            # Get user info for monitoring
-            session_maker_mon = get_session_maker()
-            async with session_maker_mon() as session_mon:
-                user_repo_mon = UserRepository(session_mon)
-                user_mon = await user_repo_mon.get_by_id(user_id)
-                
-                if user_mon:
-                    # Forward photos directly using bot
-                    for msg_id in photo_message_ids:
-                        await bot.forward_message(
-                            chat_id=config.monitoring_channel_id,
-                            from_chat_id=photo_chat_id,
-                            message_id=msg_id,
-                        )
-                        logger.info(f"Forwarded message {msg_id} to monitoring channel")
-                    
-                    # Send info message
-                    user_display = f"@{user_mon.username}" if user_mon.username else user_mon.first_name or f"ID:{user_mon.telegram_id}"
-                    
-                    info_text = (
-                        f"📸 <b>Исходные фото (edit - expensive)</b>\n\n"
-                        f"<b>Пользователь:</b> {user_display}\n"
-                        f"<b>Telegram ID:</b> <code>{user_mon.telegram_id}</code>\n"
-                        f"<b>Количество фото:</b> {len(photo_message_ids)}\n\n"
-                        f"<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
-                    )
-                    
-                    await bot.send_message(
-                        chat_id=config.monitoring_channel_id,
-                        text=info_text,
-                        parse_mode="HTML",
-                    )
-                    
-                    logger.info(f"Sent monitoring info message for user {user_mon.telegram_id}")
-            
-            await bot.session.close()
-            
-        except Exception as e:
-            logger.error(f"Failed to forward photos to monitoring: {e}", exc_info=True)
-
     # Start progress animation immediately
     from bot.utils.progress_animation import ProgressAnimator
     
     progress_animator = ProgressAnimator(
+        task_id=task.id,
         telegram_id=callback.from_user.id,
         bot_token=config.bot_token,
         task_type="edit",
@@ -1057,8 +962,8 @@ async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) ->
     await progress_animator.start()
 
     try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
+        from bot.tasks.generation import enqueue_task
+        await enqueue_task(task)
     except Exception as e:
         logger.error(f"Failed to enqueue task {task.id}: {e}")
 
@@ -1066,6 +971,22 @@ async def confirm_edit_expensive(callback: CallbackQuery, state: FSMContext) ->
     await callback.message.delete()
     await callback.answer("Редактирование запущено! ⏳")
 
+    # Copy the sources to the monitoring channel last: it waits for the channel's
+    # rate limit (bounded) and must not delay the task or the callback answer
+    from bot.bot import get_bot
+    from bot.services.monitoring import forward_source_message_ids_to_monitoring
+    
+    await forward_source_message_ids_to_monitoring(
+        get_bot(),
+        state_data.get("photo_chat_id"),
+        state_data.get("photo_message_ids", []),
+        callback.from_user.id,
+        callback.from_user.username,
+        callback.from_user.first_name,
+        prompt,
+        task_type="edit - expensive",
+    )
+
 
 @router.callback_query(EditStates.confirm_edit, F.data == CallbackData.CANCEL)
 async def cancel_edit(callback: CallbackQuery, state: FSMContext) -> None:
@@ -8,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 
 from bot.config import config
 from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.db.repositories import UserRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.services.image_tokens import (
     estimate_image_tokens, 
@@ -330,22 +330,18 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
     
     async with session_maker() as session:
         balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
         user_repo = UserRepository(session)
 
         try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-
             user = await user_repo.get_by_telegram_id(callback.from_user.id)
             model = user.selected_model if user else "gpt-image-1"
             
-            # Create task
-            task = await task_repo.create(
-                user_id=user_id,
+            # Deduct tokens, create the task and its ledger row atomically
+            task = await balance_service.create_paid_task(
+                user_id,
+                cost,
                 task_type="generate",
                 prompt=prompt,
-                tokens_spent=cost,
                 model=model,
                 image_quality=quality,
                 image_size=size,
@@ -372,6 +368,7 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
     from bot.utils.progress_animation import ProgressAnimator
     
     progress_animator = ProgressAnimator(
+        task_id=task.id,
         telegram_id=callback.from_user.id,
         bot_token=config.bot_token,
         task_type="generate",
@@ -381,8 +378,8 @@ async def confirm_generation(callback: CallbackQuery, state: FSMContext) -> None
     
     # Enqueue task to RQ (import here to avoid circular imports)
     try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
+        from bot.tasks.generation import enqueue_task
+        await enqueue_task(task)
     except Exception as e:
         logger.error(f"Failed to enqueue task {task.id}: {e}")
         # Task is created, worker will pick it up eventually
@@ -419,20 +416,18 @@ async def confirm_generation_expensive(callback: CallbackQuery, state: FSMContex
     session_maker = get_session_maker()
     async with session_maker() as session:
         balance_service = BalanceService(session)
-        task_repo = TaskRepository(session)
         user_repo = UserRepository(session)
 
         try:
-            await balance_service.deduct_tokens(user_id, cost)
-
             user = await user_repo.get_by_telegram_id(callback.from_user.id)
             model = user.selected_model if user else "gpt-image-1"
 
-            task = await task_repo.create(
-                user_id=user_id,
+            # Deduct tokens, create the task and its ledger row atomically
+            task = await balance_service.create_paid_task(
+                user_id,
+                cost,
                 task_type="generate",
                 prompt=prompt,
-                tokens_spent=cost,
                 model=model,
                 image_quality=quality,
                 image_size=size,
@@ -458,6 +453,7 @@ async def confirm_generation_expensive(callback: CallbackQuery, state: FSMContex
     from bot.utils.progress_animation import ProgressAnimator
     
     progress_animator = ProgressAnimator(
+        task_id=task.id,
         telegram_id=callback.from_user.id,
         bot_token=config.bot_token,
         task_type="generate",
@@ -466,8 +462,8 @@ async def confirm_generation_expensive(callback: CallbackQuery, state: FSMContex
     await progress_animator.start()
 
     try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
+        from bot.tasks.generation import enqueue_task
+        await enqueue_task(task)
     except Exception as e:
         logger.error(f"Failed to enqueue task {task.id}: {e}")
 
@@ -370,7 +370,16 @@ async def check_gift_payment(callback: CallbackQuery) -> None:
                 
                 if recipient:
                     # Recipient exists - add tokens immediately
-                    await user_repo.update_tokens(recipient.id, gift.tokens_amount)
+                    sender = await user_repo.get_by_id(gift.sender_id)
+                    sender_name = f"@{sender.username}" if sender and sender.username else "друга"
+                    await user_repo.update_tokens(
+                        recipient.id,
+                        gift.tokens_amount,
+                        type="gift_received",
+                        description=f"Подарок от {sender_name}",
+                        gift_id=gift.id,
+                        related_user_id=gift.sender_id,
+                    )
                     gift.status = "claimed"
                     gift.recipient_id = recipient.id
                     
@@ -383,8 +392,6 @@ async def check_gift_payment(callback: CallbackQuery) -> None:
                     try:
                         from bot.bot import get_bot
                         bot = get_bot()
-                        sender = await user_repo.get_by_id(gift.sender_id)
-                        sender_name = f"@{sender.username}" if sender and sender.username else "друга"
                         
                         await bot.send_message(
                             chat_id=recipient.telegram_id,
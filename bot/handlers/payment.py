@@ -175,7 +175,14 @@ async def check_payment_status(callback: CallbackQuery) -> None:
         if yookassa_payment.status == "succeeded" and yookassa_payment.paid:
             # Payment successful - add tokens
             if old_status != "succeeded":
-                await user_repo.update_tokens(user.id, payment.tokens_amount)
+                package_name = SHOP_PACKAGES.get(payment.package, {}).get("name", payment.package)
+                await user_repo.update_tokens(
+                    user.id,
+                    payment.tokens_amount,
+                    type="purchase",
+                    description=f"{package_name} пакет",
+                    payment_id=payment.id,
+                )
                 logger.info(
                     f"Payment {payment.yookassa_payment_id} succeeded, "
                     f"added {payment.tokens_amount} tokens to user {user_tg.id}"
@@ -194,7 +201,8 @@ async def check_payment_status(callback: CallbackQuery) -> None:
             
             await session.commit()
             
-            new_balance = user.tokens + payment.tokens_amount
+            # update_tokens refreshed the session's user
+            new_balance = user.tokens
             await callback.message.edit_text(
                 text=(
                     "✅ <b>Оплата прошла успешно!</b>\n\n"
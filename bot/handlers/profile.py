@@ -12,6 +12,7 @@ from bot.keyboards.inline import (
     CallbackData,
     main_menu_keyboard,
 )
+from bot.services.delivery import send_task_result
 from bot.services.image_tokens import IMAGE_QUALITY_LABELS
 from bot.utils.messages import (
     PROFILE_HEADER,
@@ -168,17 +169,14 @@ async def show_history_image(callback: CallbackQuery) -> None:
             date=format_date(task.created_at),
         )
 
-        if task.result_file_id:
-            await callback.message.answer_document(
-                document=task.result_file_id,
-                caption=caption,
-            )
-        elif task.result_image_url:
-            await callback.message.answer_document(
-                document=task.result_image_url,
-                caption=caption,
-            )
-        else:
+        # file_id first (no upload), URL only once - its file_id is stored
+        sent = await send_task_result(
+            callback.bot,
+            callback.message.chat.id,
+            task,
+            caption=caption,
+        )
+        if sent is None:
             await callback.answer(ERROR_IMAGE_UNAVAILABLE)
             return
 
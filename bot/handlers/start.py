@@ -9,7 +9,7 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 
 from bot.config import config
-from bot.db.database import get_session_maker
+from bot.db.database import get_session_maker, unit_of_work
 from bot.db.repositories import UserRepository
 from bot.keyboards.inline import main_menu_keyboard, subscription_keyboard
 from bot.utils.messages import (
@@ -150,39 +150,40 @@ async def cmd_start(message: Message, state: FSMContext, command: CommandObject,
         # Process pending gifts for new users
         gift_message = ""
         if is_new_user and user_tg.username:
-            from bot.db.repositories import GiftRepository, TransactionRepository
+            from bot.db.repositories import GiftRepository, LedgerEntry, TransactionRepository
             gift_repo = GiftRepository(session)
-            tx_repo = TransactionRepository(session)
             pending_gifts = await gift_repo.get_pending_gifts_for_username(user_tg.username)
             
             total_gift_tokens = 0
             gift_senders = []
-            for gift in pending_gifts:
-                total_gift_tokens += gift.tokens_amount
-                # Get sender info
-                sender = await user_repo.get_by_id(gift.sender_id)
-                sender_name = f"@{sender.username}" if sender and sender.username else "Аноним"
-                if sender:
-                    gift_senders.append(sender_name)
-                # Mark gift as claimed
-                gift.recipient_id = user.id
-                gift.status = "claimed"
+            entries = []
+            # Gift claims, their ledger rows and the balance in one commit
+            async with unit_of_work(session):
+                for gift in pending_gifts:
+                    total_gift_tokens += gift.tokens_amount
+                    # Get sender info
+                    sender = await user_repo.get_by_id(gift.sender_id)
+                    sender_name = f"@{sender.username}" if sender and sender.username else "Аноним"
+                    if sender:
+                        gift_senders.append(sender_name)
+                    # Mark gift as claimed
+                    gift.recipient_id = user.id
+                    gift.status = "claimed"
+                    
+                    entries.append(LedgerEntry(
+                        user_id=user.id,
+                        amount=gift.tokens_amount,
+                        type="gift_received",
+                        description=f"Подарок от {sender_name}",
+                        gift_id=gift.id,
+                        related_user_id=sender.id if sender else None,
+                    ))
                 
-                # Create transaction for this gift
-                await tx_repo.create(
-                    user_id=user.id,
-                    type="gift_received",
-                    tokens_amount=gift.tokens_amount,
-                    description=f"Подарок от {sender_name}",
-                    gift_id=gift.id,
-                    related_user_id=sender.id if sender else None,
-                )
+                if entries:
+                    # One row per gift; updates the session's user instance as well
+                    await TransactionRepository(session).post(entries)
             
             if total_gift_tokens > 0:
-                await user_repo.update_tokens(user.id, total_gift_tokens)
-                user.tokens += total_gift_tokens
-                await session.commit()
-                
                 senders_text = ", ".join(gift_senders) if gift_senders else "друга"
                 gift_message = f"\n\n🎁 <b>Вам подарили {total_gift_tokens} токенов от {senders_text}!</b>"
         
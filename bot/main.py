@@ -10,6 +10,7 @@ import asyncio
 import logging
 import secrets
 from contextlib import asynccontextmanager
+from functools import partial
 
 from aiogram.types import Update
 from fastapi import FastAPI, Request, Response
@@ -17,6 +18,12 @@ from fastapi import FastAPI, Request, Response
 from bot.bot import get_bot, get_dispatcher, close_bot
 from bot.config import config
 from bot.db.database import init_db, close_db, get_session_maker
+from bot.redis_pool import close_redis
+from bot.services.broadcast import start_broadcast_supervisor, stop_broadcast_supervisor
+from bot.services.fair_dispatch import start_fair_sweeper, stop_fair_sweeper
+from bot.services.ledger import start_ledger_compactor, stop_ledger_compactor
+from bot.services.stats_rollup import start_stats_rollup, stop_stats_rollup
+from bot.utils.progress_animation import start_progress_scheduler, stop_progress_scheduler
 from bot.handlers import register_all_handlers
 from sqlalchemy import select, desc
 
@@ -38,11 +45,14 @@ async def lifespan(app: FastAPI):
     - Register handlers
     - Set bot commands menu
     - Set Telegram webhook
+    - Start progress animation scheduler
     
     Shutdown:
     - Delete Telegram webhook
+    - Stop progress animation scheduler
     - Close bot session
     - Close database connections
+    - Close Redis pool
     """
     # Startup
     logger.info("Starting application...")
@@ -114,6 +124,21 @@ async def lifespan(app: FastAPI):
     else:
         logger.warning("WEBHOOK_URL not configured, webhook not set")
     
+    # One scheduler drives all progress animations (resumes ones left in Redis)
+    start_progress_scheduler()
+    
+    # Dispatches tasks that wait behind expired in-flight slots
+    start_fair_sweeper()
+    
+    # Resumes broadcasts interrupted by a restart
+    start_broadcast_supervisor()
+    
+    # Folds new ledger rows into balance snapshots and reconciles balances
+    start_ledger_compactor()
+    
+    # Keeps the admin statistics rollups fresh
+    start_stats_rollup()
+    
     yield
     
     # Shutdown
@@ -127,6 +152,13 @@ async def lifespan(app: FastAPI):
         except Exception as e:
             logger.error(f"Failed to delete webhook: {e}")
     
+    # Stop progress animations (state stays in Redis for the next start)
+    await stop_progress_scheduler()
+    await stop_fair_sweeper()
+    await stop_broadcast_supervisor()
+    await stop_ledger_compactor()
+    await stop_stats_rollup()
+    
     # Close bot session
     await close_bot()
     logger.info("Bot session closed")
@@ -134,6 +166,9 @@ async def lifespan(app: FastAPI):
     # Close database connections
     await close_db()
     logger.info("Database connections closed")
+    
+    # Close shared Redis pool (FSM storage, progress animation)
+    await close_redis()
 
 
 # Create FastAPI application
@@ -216,9 +251,10 @@ async def admin_stats(request: Request):
     if not verify_admin_api_key(request):
         return Response(status_code=403, content="Forbidden")
     
+    from bot.db.database import ROLE_ANALYTICS
     from bot.db.repositories import StatsRepository
     
-    session_maker = get_session_maker()
+    session_maker = get_session_maker(ROLE_ANALYTICS)
     
     async with session_maker() as session:
         stats_repo = StatsRepository(session)
@@ -240,21 +276,47 @@ async def admin_queue_stats(request: Request):
     try:
         from redis import Redis
         from rq import Queue
+        from bot.services.eta import get_eta_service
         
         redis_conn = Redis.from_url(config.redis_url)
-        queue = Queue(connection=redis_conn)
+        eta_service = get_eta_service()
+        
+        # Every generation queue (gen:<provider>:<lane>) and the legacy default queue
+        queues = {}
+        for name in eta_service.queue_names:
+            queue = Queue(name=name, connection=redis_conn)
+            queues[name] = {
+                "pending_jobs": len(queue),
+                "running_jobs": queue.started_job_registry.count,
+                "failed_jobs": queue.failed_job_registry.count,
+                "finished_jobs": queue.finished_job_registry.count,
+            }
         
         return {
-            "queue_name": queue.name,
-            "pending_jobs": len(queue),
-            "failed_jobs": queue.failed_job_registry.count,
-            "finished_jobs": queue.finished_job_registry.count,
+            "queues": queues,
+            "pending_jobs": sum(queue["pending_jobs"] for queue in queues.values()),
+            "eta": await eta_service.queue_snapshot(),
         }
     except Exception as e:
         logger.error(f"Failed to get queue stats: {e}")
         return {"error": str(e)}
 
 
+@app.get("/admin/db")
+async def admin_db_stats(request: Request):
+    """
+    Get database pool statistics of the app process.
+    
+    Requires X-Admin-API-Key header.
+    """
+    if not verify_admin_api_key(request):
+        return Response(status_code=403, content="Forbidden")
+    
+    from bot.db.database import pool_stats
+    
+    return {"pools": pool_stats()}
+
+
 @app.get("/admin/users/{telegram_id}")
 async def admin_get_user(request: Request, telegram_id: int):
     """
@@ -327,13 +389,18 @@ async def admin_add_tokens(request: Request, telegram_id: int):
             return Response(status_code=404, content="User not found")
         
         old_balance = user.tokens
-        await user_repo.update_tokens(user.id, amount)
+        credited = await user_repo.update_tokens(
+            user.id, amount, type="admin_grant", description="Начисление от администратора"
+        )
+        
+        if credited is None:
+            return Response(status_code=409, content="Balance update refused")
         
         return {
             "telegram_id": telegram_id,
             "old_balance": old_balance,
             "added": amount,
-            "new_balance": old_balance + amount,
+            "new_balance": credited.tokens,
         }
 
 
@@ -371,9 +438,16 @@ async def yookassa_webhook(request: Request):
         
         logger.info(f"YooKassa payment {payment_id}: event={event}, status={status}, paid={paid}")
         
-        session_maker = get_session_maker()
+        from bot.db.database import unit_of_work
+        from bot.services.admin_notify import notify_admins
         
-        async with session_maker() as session:
+        # Messages are sent after the commit: Telegram calls never hold the payment
+        # and balance row locks, and nobody hears about a credit that was rolled back
+        notifications = []  # (what, send) pairs
+        bot = get_bot()
+        
+        # One transaction: the payment row stays locked until every credit is written
+        async with unit_of_work() as session:
             payment_repo = PaymentRepository(session)
             user_repo = UserRepository(session)
             
@@ -426,22 +500,17 @@ async def yookassa_webhook(request: Request):
                         
                         if recipient:
                             # Recipient exists - add tokens immediately
-                            await user_repo.update_tokens(recipient.id, gift.tokens_amount)
-                            gift.status = "claimed"
-                            gift.recipient_id = recipient.id
-                            
-                            # Create transaction for recipient
-                            from bot.db.repositories import TransactionRepository
-                            tx_repo = TransactionRepository(session)
                             sender_name = f"@{sender.username}" if sender and sender.username else "друга"
-                            await tx_repo.create(
-                                user_id=recipient.id,
+                            credited = await user_repo.update_tokens(
+                                recipient.id,
+                                gift.tokens_amount,
                                 type="gift_received",
-                                tokens_amount=gift.tokens_amount,
                                 description=f"Подарок от {sender_name}",
                                 gift_id=gift.id,
                                 related_user_id=sender.id if sender else None,
                             )
+                            gift.status = "claimed"
+                            gift.recipient_id = recipient.id
                             
                             logger.info(
                                 f"Gift payment {payment_id} succeeded: "
@@ -449,12 +518,11 @@ async def yookassa_webhook(request: Request):
                             )
                             
                             # Notify recipient
-                            try:
-                                bot = get_bot()
-                                sender_name = f"@{sender.username}" if sender and sender.username else "друга"
-                                new_balance = recipient.tokens + gift.tokens_amount
-                                
-                                await bot.send_message(
+                            new_balance = credited.tokens if credited else recipient.tokens
+                            notifications.append((
+                                "notify gift recipient",
+                                partial(
+                                    bot.send_message,
                                     chat_id=recipient.telegram_id,
                                     text=(
                                         f"🎁 <b>Вам подарили токены!</b>\n\n"
@@ -465,9 +533,8 @@ async def yookassa_webhook(request: Request):
                                         "Токены уже на вашем балансе! 🎉"
                                     ),
                                     parse_mode="HTML",
-                                )
-                            except Exception as e:
-                                logger.error(f"Failed to notify gift recipient: {e}")
+                                ),
+                            ))
                         else:
                             logger.info(
                                 f"Gift payment {payment_id} succeeded: "
@@ -475,11 +542,11 @@ async def yookassa_webhook(request: Request):
                             )
                         
                         # Notify sender
-                        try:
-                            bot = get_bot()
-                            status_text = "уже получил токены! 🎉" if gift.status == "claimed" else "получит токены при входе в бота 📩"
-                            
-                            await bot.send_message(
+                        status_text = "уже получил токены! 🎉" if gift.status == "claimed" else "получит токены при входе в бота 📩"
+                        notifications.append((
+                            "notify gift sender",
+                            partial(
+                                bot.send_message,
                                 chat_id=sender.telegram_id if sender else payment.user_id,
                                 text=(
                                     f"✅ <b>Подарок оплачен!</b>\n\n"
@@ -490,122 +557,119 @@ async def yookassa_webhook(request: Request):
                                     "Спасибо за подарок! 💝"
                                 ),
                                 parse_mode="HTML",
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to notify gift sender: {e}")
+                            ),
+                        ))
                         
                         # Notify admins
-                        try:
-                            from bot.services.admin_notify import notify_admins
-                            await notify_admins(
+                        notifications.append((
+                            "notify admins about gift",
+                            partial(
+                                notify_admins,
                                 f"🎁 <b>Новый подарок!</b>\n\n"
-                                f"От: @{sender.username or '—'} ({sender.telegram_id if sender else '—'})\n"
+                                f"От: @{sender.username if sender and sender.username else '—'} ({sender.telegram_id if sender else '—'})\n"
                                 f"Кому: @{gift.recipient_username}\n"
                                 f"Пакет: {SHOP_PACKAGES.get(gift.package, {}).get('name', gift.package)}\n"
                                 f"Сумма: {payment.amount_value} ₽\n"
                                 f"Токены: {gift.tokens_amount} 🪙\n"
                                 f"Статус: {'Получен' if gift.status == 'claimed' else 'Ожидает'}",
-                                title="Подарок"
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to notify admins about gift: {e}")
+                                title="Подарок",
+                            ),
+                        ))
                 else:
                     # Regular payment - add tokens to user
                     user = await user_repo.get_by_id(payment.user_id)
                     
                     if user:
-                        await user_repo.update_tokens(user.id, payment.tokens_amount)
+                        from bot.db.repositories import LedgerEntry, TransactionRepository
+                        
+                        package_name = SHOP_PACKAGES.get(payment.package, {}).get("name", payment.package)
+                        entries = [
+                            LedgerEntry(
+                                user_id=user.id,
+                                amount=payment.tokens_amount,
+                                type="purchase",
+                                description=f"{package_name} пакет",
+                                payment_id=payment.id,
+                            )
+                        ]
+                        
+                        # Referral bonus: give 20% to referrer
+                        referrer = await user_repo.get_by_id(user.referrer_id) if user.referrer_id else None
+                        referral_bonus = int(payment.tokens_amount * 0.2) if referrer else 0  # 20% bonus
+                        referral_name = f"@{user.username}" if user.username else "реферала"
+                        if referral_bonus > 0:
+                            entries.append(
+                                LedgerEntry(
+                                    user_id=referrer.id,
+                                    amount=referral_bonus,
+                                    type="referral_bonus",
+                                    description=f"Бонус от {referral_name}",
+                                    related_user_id=user.id,
+                                )
+                            )
+                        
+                        # Purchase and bonus rows in one insert, balances alongside
+                        credited_users = await TransactionRepository(session).post(entries)
+                        credited = credited_users[user.id]
                         logger.info(
                             f"Payment {payment_id} succeeded: added {payment.tokens_amount} tokens "
                             f"to user {user.telegram_id}"
                         )
                         
-                        # Create transaction record
-                        from bot.db.repositories import TransactionRepository
-                        tx_repo = TransactionRepository(session)
-                        package_name = SHOP_PACKAGES.get(payment.package, {}).get("name", payment.package)
-                        await tx_repo.create(
-                            user_id=user.id,
-                            type="purchase",
-                            tokens_amount=payment.tokens_amount,
-                            description=f"{package_name} пакет",
-                            payment_id=payment.id,
-                        )
-                        
-                        # Referral bonus: give 20% to referrer
-                        if user.referrer_id:
-                            referrer = await user_repo.get_by_id(user.referrer_id)
-                            if referrer:
-                                referral_bonus = int(payment.tokens_amount * 0.2)  # 20% bonus
-                                if referral_bonus > 0:
-                                    await user_repo.update_tokens(referrer.id, referral_bonus)
-                                    logger.info(
-                                        f"Referral bonus: added {referral_bonus} tokens "
-                                        f"to referrer {referrer.telegram_id} (from user {user.telegram_id})"
-                                    )
-                                    
-                                    # Create transaction for referrer
-                                    referral_name = f"@{user.username}" if user.username else "реферала"
-                                    await tx_repo.create(
-                                        user_id=referrer.id,
-                                        type="referral_bonus",
-                                        tokens_amount=referral_bonus,
-                                        description=f"Бонус от {referral_name}",
-                                        related_user_id=user.id,
-                                    )
-                                    
-                                    # Notify referrer about bonus
-                                    try:
-                                        bot = get_bot()
-                                        new_balance = referrer.tokens + referral_bonus
-                                        
-                                        await bot.send_message(
-                                            chat_id=referrer.telegram_id,
-                                            text=(
-                                                f"🎉 <b>Реферальный бонус!</b>\n\n"
-                                                f"Ваш реферал {referral_name} пополнил баланс!\n\n"
-                                                f"<b>Вы получили:</b> +{referral_bonus} 🪙 (20% от покупки)\n"
-                                                f"<b>Ваш баланс:</b> {new_balance} 🪙\n\n"
-                                                "Продолжайте приглашать друзей! 🚀"
-                                            ),
-                                            parse_mode="HTML",
-                                        )
-                                    except Exception as e:
-                                        logger.error(f"Failed to notify referrer about bonus: {e}")
+                        if referral_bonus > 0:
+                            bonus_credited = credited_users[referrer.id]
+                            logger.info(
+                                f"Referral bonus: added {referral_bonus} tokens "
+                                f"to referrer {referrer.telegram_id} (from user {user.telegram_id})"
+                            )
+                            
+                            # Notify referrer about bonus
+                            notifications.append((
+                                "notify referrer about bonus",
+                                partial(
+                                    bot.send_message,
+                                    chat_id=referrer.telegram_id,
+                                    text=(
+                                        f"🎉 <b>Реферальный бонус!</b>\n\n"
+                                        f"Ваш реферал {referral_name} пополнил баланс!\n\n"
+                                        f"<b>Вы получили:</b> +{referral_bonus} 🪙 (20% от покупки)\n"
+                                        f"<b>Ваш баланс:</b> {bonus_credited.tokens} 🪙\n\n"
+                                        "Продолжайте приглашать друзей! 🚀"
+                                    ),
+                                    parse_mode="HTML",
+                                ),
+                            ))
                         
                         # Send notification to user
-                        try:
-                            bot = get_bot()
-                            package_name = SHOP_PACKAGES.get(payment.package, {}).get("name", payment.package)
-                            new_balance = user.tokens + payment.tokens_amount
-                            
-                            await bot.send_message(
+                        notifications.append((
+                            "send payment notification to user",
+                            partial(
+                                bot.send_message,
                                 chat_id=user.telegram_id,
                                 text=(
                                     "✅ <b>Оплата прошла успешно!</b>\n\n"
                                     f"<b>Пакет:</b> {package_name}\n"
                                     f"<b>Зачислено:</b> +{payment.tokens_amount} 🪙\n"
-                                    f"<b>Ваш баланс:</b> {new_balance} 🪙\n\n"
+                                    f"<b>Ваш баланс:</b> {credited.tokens} 🪙\n\n"
                                     "Спасибо за покупку! Теперь можно творить магию 🎨"
                                 ),
                                 parse_mode="HTML",
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to send payment notification to user: {e}")
+                            ),
+                        ))
                         
                         # Notify admins
-                        try:
-                            from bot.services.admin_notify import notify_admins
-                            await notify_admins(
+                        notifications.append((
+                            "notify admins",
+                            partial(
+                                notify_admins,
                                 f"💰 <b>Новая оплата!</b>\n\n"
                                 f"Пользователь: @{user.username or '—'} ({user.telegram_id})\n"
                                 f"Пакет: {SHOP_PACKAGES.get(payment.package, {}).get('name', payment.package)}\n"
                                 f"Сумма: {payment.amount_value} ₽\n"
                                 f"Токены: +{payment.tokens_amount} 🪙",
-                                title="Оплата"
-                            )
-                        except Exception as e:
-                            logger.error(f"Failed to notify admins: {e}")
+                                title="Оплата",
+                            ),
+                        ))
             
             # If payment was canceled
             elif event == "payment.canceled" and old_status != "canceled":
@@ -617,11 +681,12 @@ async def yookassa_webhook(request: Request):
                     )
                     
                     # Send notification to user with shop buttons
-                    try:
-                        bot = get_bot()
-                        from bot.keyboards.inline import tokens_keyboard
-                        
-                        await bot.send_message(
+                    from bot.keyboards.inline import tokens_keyboard
+                    
+                    notifications.append((
+                        "send cancel notification to user",
+                        partial(
+                            bot.send_message,
                             chat_id=user.telegram_id,
                             text=(
                                 "❌ <b>Платеж не завершен</b>\n\n"
@@ -630,11 +695,15 @@ async def yookassa_webhook(request: Request):
                             ),
                             reply_markup=tokens_keyboard(),
                             parse_mode="HTML",
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to send cancel notification to user: {e}")
-            
-            await session.commit()
+                        ),
+                    ))
+        
+        # Committed - now tell the users and admins
+        for what, send in notifications:
+            try:
+                await send()
+            except Exception as e:
+                logger.error(f"Failed to {what}: {e}")
         
         return Response(status_code=200)
         
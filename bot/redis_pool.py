@@ -0,0 +1,44 @@
+"""Shared async Redis client.
+
+One connection pool per process for everything async that talks to Redis:
+FSM storage, progress animation, the source image cache. The pool is bound
+to the event loop of the process (uvicorn loop in the app, the runtime loop
+in the worker). RQ keeps its own synchronous connection (``bot.tasks``).
+"""
+
+import logging
+from typing import Optional
+
+import redis.asyncio as aioredis
+
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+_redis: Optional[aioredis.Redis] = None
+
+
+def get_redis() -> aioredis.Redis:
+    """Get or create the shared async Redis client."""
+    global _redis
+    if _redis is None:
+        # Blocking pool: when all connections are busy, callers wait for a free
+        # one instead of failing with "Too many connections"
+        pool = aioredis.BlockingConnectionPool.from_url(
+            config.redis_url,
+            max_connections=config.redis_pool_size,
+            timeout=10,
+            health_check_interval=30,
+        )
+        _redis = aioredis.Redis.from_pool(pool)
+        logger.info(f"Async Redis pool created (max connections: {config.redis_pool_size})")
+    return _redis
+
+
+async def close_redis() -> None:
+    """Close the shared Redis pool."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
+        logger.info("Async Redis pool closed")
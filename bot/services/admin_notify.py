@@ -30,9 +30,9 @@ async def notify_admins(
         return
     
     try:
-        from aiogram import Bot
+        from bot.bot import get_bot
         
-        bot = Bot(token=config.bot_token)
+        bot = get_bot()
         
         full_message = f"<b>{title}</b>\n\n{message}"
         
@@ -46,8 +46,6 @@ async def notify_admins(
                 logger.info(f"Admin {admin_id} notified: {title}")
             except Exception as e:
                 logger.error(f"Failed to notify admin {admin_id}: {e}")
-        
-        await bot.session.close()
     
     except Exception as e:
         logger.error(f"Failed to send admin notification: {e}")
@@ -1,12 +1,17 @@
-"""Balance service for token operations."""
+"""Balance service for token operations.
+
+Every balance change is a ledger row (``TransactionRepository.post``); the
+service picks the row type and description.
+"""
 
 import logging
 from typing import Optional
 
-from sqlalchemy import select, update
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from bot.db.models import User, GenerationTask
+from bot.db.models import User, GenerationTask, Transaction
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +59,7 @@ class BalanceService:
         user_id: int,
         amount: int,
         raise_on_insufficient: bool = True,
+        description: str = "Списание токенов",
     ) -> Optional[User]:
         """
         Deduct tokens from user's balance.
@@ -62,6 +68,7 @@ class BalanceService:
             user_id: User's database ID
             amount: Number of tokens to deduct
             raise_on_insufficient: If True, raise InsufficientBalanceError
+            description: Ledger row description
         
         Returns:
             Updated user or None if not found
@@ -69,75 +76,129 @@ class BalanceService:
         Raises:
             InsufficientBalanceError: If user doesn't have enough tokens
         """
-        # Atomic update: deduct only if balance is sufficient
-        stmt = (
-            update(User)
-            .where(User.id == user_id)
-            .where(User.tokens >= amount)
-            .values(tokens=User.tokens - amount)
-        )
-        result = await self.session.execute(stmt)
+        from bot.db.repositories import LedgerEntry, TransactionRepository
 
-        if result.rowcount == 0:
+        try:
+            # Atomic update: deduct only if balance is sufficient
+            users = await TransactionRepository(self.session).post([
+                LedgerEntry(user_id, -amount, "generation", description)
+            ])
+        except InsufficientBalanceError:
             # Either user not found or insufficient balance
-            user_result = await self.session.execute(
-                select(User).where(User.id == user_id)
+            exists = await self.session.scalar(
+                select(User.id).where(User.id == user_id)
             )
-            existing = user_result.scalar_one_or_none()
-            if existing is None:
+            if exists is None or not raise_on_insufficient:
                 return None
-            if raise_on_insufficient:
-                raise InsufficientBalanceError(required=amount, available=existing.tokens)
-            return None
+            raise
+        return users[user_id]
+    
+    async def create_paid_task(
+        self,
+        user_id: int,
+        cost: int,
+        **task_fields,
+    ) -> GenerationTask:
+        """
+        Deduct the cost and create the task with its ledger row in one atomic operation.
+        
+        Args:
+            user_id: User's database ID
+            cost: Number of tokens to deduct
+            **task_fields: task_type, prompt, model, image_quality, image_size,
+                source_image_url, images_count (see TaskRepository.create_charged)
+        
+        Returns:
+            Created task
+        
+        Raises:
+            InsufficientBalanceError: If user doesn't have enough tokens (or doesn't exist)
+        """
+        from bot.db.repositories import TaskRepository
 
-        await self.session.commit()
-        # Refresh to get updated state
-        user_result = await self.session.execute(
-            select(User).where(User.id == user_id)
+        charged = await TaskRepository(self.session).create_charged(
+            user_id=user_id,
+            tokens_spent=cost,
+            **task_fields,
         )
-        return user_result.scalar_one_or_none()
+        if charged.task is None:
+            raise InsufficientBalanceError(required=cost, available=charged.balance or 0)
+        return charged.task
     
-    async def refund_tokens(self, user_id: int, amount: int) -> Optional[User]:
+    async def refund_tokens(
+        self,
+        user_id: int,
+        amount: int,
+        description: str = "Возврат токенов",
+    ) -> Optional[User]:
         """
         Refund tokens to user's balance.
         
         Args:
             user_id: User's database ID
             amount: Number of tokens to refund
+            description: Ledger row description
         
         Returns:
             Updated user or None if not found
         """
-        result = await self.session.execute(
-            select(User).where(User.id == user_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user is None:
+        from bot.db.repositories import LedgerEntry, TransactionRepository
+
+        try:
+            users = await TransactionRepository(self.session).post([
+                LedgerEntry(user_id, amount, "refund", description)
+            ])
+        except InsufficientBalanceError:
             return None
-        
-        user.tokens += amount
-        await self.session.commit()
-        await self.session.refresh(user)
-        
-        return user
+        return users[user_id]
     
     async def refund_task(self, task_id: int) -> Optional[User]:
         """
         Refund tokens for a failed task.
         
+        The refund row references the task, so a task is refunded at most
+        once: a retried failure handler finds the row and does nothing, and
+        a concurrent one hits the unique refund index and does nothing too.
+        
         Args:
             task_id: Task's database ID
         
         Returns:
-            Updated user or None if task not found
+            Updated user, or None if task not found or already refunded
         """
-        result = await self.session.execute(
-            select(GenerationTask).where(GenerationTask.id == task_id)
+        from bot.db.database import commit_unless_batched, unit_of_work
+        from bot.db.repositories import LedgerEntry, TransactionRepository
+
+        refunded = (
+            select(Transaction.id)
+            .where(Transaction.task_id == task_id)
+            .where(Transaction.type == "refund")
+            .exists()
         )
-        task = result.scalar_one_or_none()
-        
-        if task is None:
+        row = (await self.session.execute(
+            select(GenerationTask.user_id, GenerationTask.tokens_spent, refunded)
+            .where(GenerationTask.id == task_id)
+        )).first()
+        if row is None:
             return None
-        
-        return await self.refund_tokens(task.user_id, task.tokens_spent)
+
+        user_id, tokens_spent, already_refunded = row
+        if already_refunded:
+            logger.warning(f"Task {task_id} is already refunded")
+            return None
+
+        # Savepoint: losing the race to another refund leaves the caller's transaction usable
+        try:
+            async with self.session.begin_nested():
+                async with unit_of_work(self.session):
+                    users = await TransactionRepository(self.session).post([
+                        LedgerEntry(
+                            user_id, tokens_spent, "refund", "Возврат за неудачную генерацию",
+                            task_id=task_id,
+                        )
+                    ])
+        except IntegrityError:
+            logger.warning(f"Task {task_id} is already refunded")
+            return None
+        await commit_unless_batched(self.session)
+        return users[user_id]
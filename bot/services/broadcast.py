@@ -0,0 +1,453 @@
+"""Background broadcast of an admin message to all users.
+
+The admin handler used to load every User (with their tasks and referrals)
+and copy the message to them one by one, with a fixed sleep, inside the
+webhook request. A broadcast is now a background job of the app:
+
+- recipients are read in keyset pages of ``(id, telegram_id)`` - no ORM
+  objects, no open transaction between pages;
+- each page is sent concurrently, paced by the shared Bot API rate limiter
+  in the broadcast priority class (``bot.services.telegram_rate_limit``);
+- progress is checkpointed in Redis after every page, so a broadcast
+  interrupted by a restart resumes where it stopped;
+- users who blocked the bot are marked in the database and skipped by
+  later broadcasts.
+
+Redis keys:
+
+- ``broadcast:<id>``        -> hash: source message, admin progress message,
+  status, ``last_user_id`` checkpoint and counters
+- ``broadcast:<id>:batch``  -> user IDs of the current page already sent
+  (so a resumed page doesn't send them twice)
+- ``broadcast:<id>:lease``  -> owner token of the process running the broadcast
+- ``broadcast:active``      -> IDs of broadcasts not finished yet
+
+Every app replica runs a supervisor that picks up active broadcasts whose
+lease has expired. The owner renews its lease on a heartbeat while pages are
+sending; renewals, checkpoints and the final status are written only while
+the lease still holds the owner's token (WATCH/MULTI). An owner that lost the
+lease stops sending and leaves the broadcast to the new one.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Callable, Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "broadcast"
+ACTIVE_KEY = f"{KEY_PREFIX}:active"
+
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+
+# Recipients per page (one checkpoint per page)
+BATCH_SIZE = 500
+
+# Copies in flight at the same time; the rate limiter sets the actual pace
+SEND_CONCURRENCY = 25
+
+# Lease of the running process
+LEASE_SECONDS = 60
+
+# Seconds between lease renewals while the broadcast runs
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+
+# Seconds between supervisor checks for broadcasts to resume
+SUPERVISE_INTERVAL = 30
+
+# Finished broadcasts are kept this long for the admin
+FINISHED_TTL = 7 * 24 * 3600
+
+# Errors that mean the user can't be reached by the bot any more
+UNREACHABLE_ERRORS = (
+    "bot was blocked by the user",
+    "user is deactivated",
+    "chat not found",
+    "bot can't initiate conversation",
+)
+
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _decode(raw: dict) -> Dict[str, str]:
+    return {
+        (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+        for k, v in raw.items()
+    }
+
+
+class Broadcast:
+    """One broadcast: its Redis state and the send loop."""
+
+    def __init__(self, broadcast_id: int, redis: Optional[aioredis.Redis] = None):
+        self.id = broadcast_id
+        self._redis = redis
+        self.key = f"{KEY_PREFIX}:{broadcast_id}"
+        self.batch_key = f"{self.key}:batch"
+        self.lease_key = f"{self.key}:lease"
+        # Lease value of this process; unique per Broadcast, so a restarted run never passes for the old one
+        self.token = f"{_worker_id()}:{uuid.uuid4().hex}"
+        self.lease_lost = asyncio.Event()
+
+    @property
+    def redis(self) -> aioredis.Redis:
+        return self._redis or get_redis()
+
+    async def get_state(self) -> Dict[str, str]:
+        """Stored state of the broadcast (empty if unknown)."""
+        return _decode(await self.redis.hgetall(self.key))
+
+    async def acquire_lease(self) -> bool:
+        """Become the process that runs the broadcast."""
+        self.lease_lost.clear()
+        return bool(await self.redis.set(self.lease_key, self.token, nx=True, ex=LEASE_SECONDS))
+
+    async def _if_owner(self, write: Callable[[aioredis.client.Pipeline], None]) -> bool:
+        """
+        Run writes in one transaction if the lease still holds this process's token.
+
+        The lease is extended in the same transaction. Returns False (and
+        sets ``lease_lost``) if another process owns the broadcast now.
+        """
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self.lease_key)
+                    owner = await pipe.get(self.lease_key)
+                    if isinstance(owner, bytes):
+                        owner = owner.decode()
+                    if owner != self.token:
+                        await pipe.unwatch()
+                        self.lease_lost.set()
+                        return False
+                    pipe.multi()
+                    write(pipe)
+                    pipe.expire(self.lease_key, LEASE_SECONDS)
+                    await pipe.execute()
+                    return True
+                except WatchError:
+                    continue
+
+    async def renew_lease(self) -> bool:
+        """Extend the lease if this process still holds it."""
+        return await self._if_owner(lambda pipe: None)
+
+    async def release_lease(self) -> None:
+        """Give the lease up if this process holds it."""
+        await self._if_owner(lambda pipe: pipe.delete(self.lease_key))
+
+    async def _heartbeat(self) -> None:
+        """Renew the lease while a page is sending; stop on lost ownership."""
+        while not self.lease_lost.is_set():
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            try:
+                if not await self.renew_lease():
+                    logger.warning(f"Broadcast {self.id}: lease taken over by another process, stopping")
+            except Exception as e:
+                logger.warning(f"Broadcast {self.id}: failed to renew lease: {e}")
+
+    async def _send_one(self, bot, state: Dict[str, str], user_id: int, telegram_id: int) -> str:
+        """Copy the message to one user; returns "sent", "blocked" or "failed"."""
+        from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+
+        try:
+            await bot.copy_message(
+                chat_id=telegram_id,
+                from_chat_id=int(state["from_chat_id"]),
+                message_id=int(state["message_id"]),
+            )
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            if isinstance(e, TelegramForbiddenError) or any(
+                error in str(e).lower() for error in UNREACHABLE_ERRORS
+            ):
+                return "blocked"
+            logger.warning(f"Broadcast {self.id}: failed to send to {telegram_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logger.warning(f"Broadcast {self.id}: failed to send to {telegram_id}: {e}")
+            return "failed"
+
+        await self.redis.sadd(self.batch_key, user_id)
+        return "sent"
+
+    async def _send_batch(
+        self, bot, state: Dict[str, str], recipients: List[Tuple[int, int]]
+    ) -> Dict[str, List[int]]:
+        """Send a page concurrently, skipping users the page already reached."""
+        done = {int(user_id) for user_id in await self.redis.smembers(self.batch_key)}
+        semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        outcomes: Dict[str, List[int]] = {"sent": [], "blocked": [], "failed": []}
+
+        async def send(user_id: int, telegram_id: int) -> None:
+            async with semaphore:
+                # Another process owns the broadcast now and sends the rest
+                if self.lease_lost.is_set():
+                    return
+                outcome = await self._send_one(bot, state, user_id, telegram_id)
+            outcomes[outcome].append(user_id)
+
+        await asyncio.gather(*(
+            send(user_id, telegram_id)
+            for user_id, telegram_id in recipients
+            if user_id not in done
+        ))
+        outcomes["sent"].extend(user_id for user_id, _ in recipients if user_id in done)
+        return outcomes
+
+    async def _report_progress(self, bot, state: Dict[str, str], final: bool = False) -> None:
+        """Edit the admin's progress message."""
+        total = int(state.get("total", 0))
+        sent = int(state.get("sent", 0))
+        blocked = int(state.get("blocked", 0))
+        failed = int(state.get("failed", 0))
+        processed = sent + blocked + failed
+
+        if final:
+            text = (
+                f"✅ <b>Рассылка завершена!</b>\n\n"
+                f"📊 <b>Итоги:</b>\n"
+                f"  • Всего: {processed}\n"
+                f"  • Успешно: {sent}\n"
+                f"  • Заблокировали бота: {blocked}\n"
+                f"  • Ошибок: {failed}\n\n"
+                f"<i>Заблокировавшим бота пользователям следующие рассылки не отправляются.</i>"
+            )
+        else:
+            percent = processed * 100 // total if total else 100
+            text = (
+                f"📤 Рассылка: {processed}/{total} ({percent}%)\n"
+                f"✅ Успешно: {sent}\n"
+                f"🚫 Заблокировали бота: {blocked}\n"
+                f"❌ Ошибок: {failed}"
+            )
+
+        try:
+            await bot.edit_message_text(
+                chat_id=int(state["admin_chat_id"]),
+                message_id=int(state["progress_message_id"]),
+                text=text,
+            )
+        except Exception as e:
+            logger.debug(f"Broadcast {self.id}: failed to update progress message: {e}")
+
+    async def run(self) -> None:
+        """Send the broadcast from its checkpoint to the end (lease must be held)."""
+        from bot.bot import get_bot
+        from bot.db.database import get_session_maker
+        from bot.db.repositories import UserRepository
+        from bot.services.telegram_rate_limit import PRIORITY_BROADCAST, telegram_priority
+
+        state = await self.get_state()
+        if state.get("status") != STATUS_RUNNING:
+            await self.redis.srem(ACTIVE_KEY, self.id)
+            return
+
+        bot = get_bot()
+        session_maker = get_session_maker()
+        last_user_id = int(state.get("last_user_id", 0))
+        logger.info(f"Broadcast {self.id}: sending from user {last_user_id}")
+
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            with telegram_priority(PRIORITY_BROADCAST):
+                while True:
+                    async with session_maker() as session:
+                        recipients = await UserRepository(session).get_broadcast_recipients(
+                            last_user_id, BATCH_SIZE
+                        )
+                    if not recipients:
+                        break
+
+                    outcomes = await self._send_batch(bot, state, recipients)
+                    if outcomes["blocked"]:
+                        async with session_maker() as session:
+                            await UserRepository(session).mark_bot_blocked(outcomes["blocked"])
+                    if self.lease_lost.is_set():
+                        return
+
+                    # Checkpoint: the page is done, a restart continues after it
+                    last_user_id = recipients[-1][0]
+
+                    def checkpoint(pipe, outcomes=outcomes, last_user_id=last_user_id):
+                        pipe.hset(self.key, "last_user_id", last_user_id)
+                        pipe.hincrby(self.key, "sent", len(outcomes["sent"]))
+                        pipe.hincrby(self.key, "blocked", len(outcomes["blocked"]))
+                        pipe.hincrby(self.key, "failed", len(outcomes["failed"]))
+                        pipe.hset(self.key, "updated_at", time.time())
+                        pipe.delete(self.batch_key)
+
+                    if not await self._if_owner(checkpoint):
+                        logger.warning(f"Broadcast {self.id}: lease lost, leaving the page to its new owner")
+                        return
+
+                    state = await self.get_state()
+                    await self._report_progress(bot, state)
+
+                def finish(pipe):
+                    pipe.hset(self.key, mapping={"status": STATUS_DONE, "updated_at": time.time()})
+                    pipe.expire(self.key, FINISHED_TTL)
+                    pipe.srem(ACTIVE_KEY, self.id)
+                    pipe.delete(self.lease_key)
+
+                if not await self._if_owner(finish):
+                    return
+
+                state = await self.get_state()
+                await self._report_progress(bot, state, final=True)
+        finally:
+            heartbeat.cancel()
+            try:
+                await heartbeat
+            except asyncio.CancelledError:
+                pass
+
+        logger.info(
+            f"Broadcast {self.id} finished: {state.get('sent', 0)} sent, "
+            f"{state.get('blocked', 0)} blocked, {state.get('failed', 0)} failed"
+        )
+
+
+async def create_broadcast(
+    from_chat_id: int,
+    message_id: int,
+    admin_chat_id: int,
+    progress_message_id: int,
+    redis: Optional[aioredis.Redis] = None,
+) -> Broadcast:
+    """
+    Store a new broadcast and start sending it in the background.
+
+    Args:
+        from_chat_id: Chat of the message to copy
+        message_id: Message to copy
+        admin_chat_id: Chat of the admin's progress message
+        progress_message_id: Message edited with the progress
+        redis: Async Redis client (default: shared pool)
+
+    Returns:
+        The started Broadcast
+    """
+    from bot.db.database import get_session_maker
+    from bot.db.repositories import UserRepository
+
+    redis = redis or get_redis()
+    session_maker = get_session_maker()
+    async with session_maker() as session:
+        total = await UserRepository(session).count_broadcast_recipients()
+
+    broadcast_id = await redis.incr(f"{KEY_PREFIX}:next_id")
+    broadcast = Broadcast(broadcast_id, redis)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(broadcast.key, mapping={
+            "from_chat_id": from_chat_id,
+            "message_id": message_id,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "status": STATUS_RUNNING,
+            "total": total,
+            "last_user_id": 0,
+            "sent": 0,
+            "blocked": 0,
+            "failed": 0,
+            "created_at": time.time(),
+        })
+        pipe.sadd(ACTIVE_KEY, broadcast_id)
+        await pipe.execute()
+
+    logger.info(f"Broadcast {broadcast_id} created for {total} recipients")
+    await _start_if_free(broadcast)
+    return broadcast
+
+
+_running: Dict[int, asyncio.Task] = {}
+
+
+async def _run_and_forget(broadcast: Broadcast) -> None:
+    try:
+        await broadcast.run()
+    except asyncio.CancelledError:
+        # Shutdown: let the next start resume without waiting for the lease
+        try:
+            await broadcast.release_lease()
+        except Exception:
+            pass
+        raise
+    except Exception as e:
+        # The lease expires and the supervisor resumes from the checkpoint
+        logger.error(f"Broadcast {broadcast.id} interrupted: {e}")
+    finally:
+        _running.pop(broadcast.id, None)
+
+
+async def _start_if_free(broadcast: Broadcast) -> bool:
+    """Run the broadcast in this process unless another one holds it."""
+    task = _running.get(broadcast.id)
+    if task is not None and not task.done():
+        return False
+    if not await broadcast.acquire_lease():
+        return False
+    _running[broadcast.id] = asyncio.create_task(_run_and_forget(broadcast))
+    return True
+
+
+async def resume_broadcasts() -> int:
+    """
+    Resume active broadcasts that no process is running.
+
+    Returns:
+        Number of broadcasts resumed here
+    """
+    redis = get_redis()
+    resumed = 0
+    for broadcast_id in await redis.smembers(ACTIVE_KEY):
+        if await _start_if_free(Broadcast(int(broadcast_id), redis)):
+            logger.info(f"Resuming broadcast {int(broadcast_id)}")
+            resumed += 1
+    return resumed
+
+
+_supervisor: Optional[asyncio.Task] = None
+
+
+async def _supervise_forever() -> None:
+    while True:
+        try:
+            await resume_broadcasts()
+        except Exception as e:
+            logger.error(f"Broadcast supervisor failed: {e}")
+        await asyncio.sleep(SUPERVISE_INTERVAL)
+
+
+def start_broadcast_supervisor() -> None:
+    """Start resuming interrupted broadcasts (app startup)."""
+    global _supervisor
+    if _supervisor is None or _supervisor.done():
+        _supervisor = asyncio.create_task(_supervise_forever())
+
+
+async def stop_broadcast_supervisor() -> None:
+    """Stop the supervisor and running broadcasts; they resume from the checkpoint on the next start."""
+    global _supervisor
+    tasks = list(_running.values())
+    if _supervisor is not None:
+        tasks.append(_supervisor)
+        _supervisor = None
+    for task in tasks:
+        task.cancel()
+    for task in tasks:
+        try:
+            await task
+        except (asyncio.CancelledError, Exception):
+            pass
@@ -0,0 +1,108 @@
+"""Delivery of generation results to Telegram.
+
+A result is re-shown (history, repeated sends) using the cheapest media
+reference available for the task:
+
+1. ``result_file_id`` - Telegram already has the file, nothing is uploaded;
+2. image bytes the caller still holds (the worker right after generation);
+3. ``result_image_url`` - streamed once, after which the returned file_id
+   is stored so the URL is never fetched again.
+"""
+
+import logging
+from typing import Optional, Union
+
+from aiogram import Bot
+from aiogram.types import InputFile, Message
+
+from bot.db.models import GenerationTask
+from bot.utils.streaming_upload import StreamingUploadFile
+
+logger = logging.getLogger(__name__)
+
+
+def result_filename(task: GenerationTask) -> str:
+    """Filename of a result document, based on the task model."""
+    if task.model and task.model.startswith("seedream"):
+        return "SeeDream-4.5.png"
+    return "GPT_Image.png"
+
+
+def resolve_result_media(
+    task: GenerationTask,
+    image_bytes: Optional[bytes] = None,
+    image_url: Optional[str] = None,
+) -> Optional[Union[str, InputFile]]:
+    """
+    Get the cheapest media reference for a task result.
+
+    Args:
+        task: Generation task
+        image_bytes: Result bytes held in memory, if any
+        image_url: Result URL not yet stored in the task, if any
+
+    Returns:
+        file_id string, InputFile to upload, or None if the result is unavailable
+    """
+    if task.result_file_id:
+        return task.result_file_id
+    if image_bytes is not None:
+        return StreamingUploadFile(result_filename(task), data=image_bytes)
+    url = image_url or task.result_image_url
+    if url:
+        return StreamingUploadFile(result_filename(task), url=url)
+    return None
+
+
+async def send_task_result(
+    bot: Bot,
+    chat_id: Union[int, str],
+    task: GenerationTask,
+    caption: Optional[str] = None,
+    image_bytes: Optional[bytes] = None,
+    image_url: Optional[str] = None,
+    save_file_id: bool = True,
+    **kwargs,
+) -> Optional[Message]:
+    """
+    Send a task result as a document using the cheapest media reference.
+
+    Args:
+        bot: Bot instance
+        chat_id: Target chat
+        task: Generation task
+        caption: Document caption
+        image_bytes: Result bytes held in memory, if any
+        image_url: Result URL not yet stored in the task, if any
+        save_file_id: Store the file_id of an uploaded result in the task
+        **kwargs: Extra send_document arguments (reply_markup, parse_mode, ...)
+
+    Returns:
+        Sent message or None if the task has no result to send
+    """
+    media = resolve_result_media(task, image_bytes, image_url)
+    if media is None:
+        return None
+
+    sent = await bot.send_document(
+        chat_id=chat_id,
+        document=media,
+        caption=caption,
+        **kwargs,
+    )
+
+    if isinstance(media, StreamingUploadFile):
+        logger.info(
+            f"Task {task.id}: result uploaded ({media.bytes_sent} bytes in "
+            f"{media.elapsed:.2f}s, {media.bytes_per_second / 1024:.0f} KB/s)"
+        )
+        if save_file_id and sent.document:
+            from bot.db.database import get_session_maker
+            from bot.db.repositories import TaskRepository
+
+            session_maker = get_session_maker()
+            async with session_maker() as session:
+                await TaskRepository(session).set_result_file_id(task.id, sent.document.file_id)
+            task.result_file_id = sent.document.file_id
+
+    return sent
@@ -0,0 +1,309 @@
+"""Queue position and ETA estimates for generation tasks.
+
+An estimate combines three numbers that are all O(1) to read from Redis:
+
+- queue depth - LLEN of the RQ queue list of the task's route
+  (``bot.tasks.routing``);
+- worker slots and busy slots - SCARD of the RQ worker set and ZCARD of the
+  started job registries;
+- a rolling latency histogram of task processing time per model/quality.
+
+The histogram is written by the worker when a task is done:
+
+- ``eta:latency:<label>:<window>``  -> hash, bucket upper bound -> count,
+  plus ``count`` and ``sum``
+- ``eta:latency:labels``            -> set of known labels ("<model>:<quality>")
+
+Windows are ``LATENCY_WINDOW_SECONDS`` long; reads merge the current and the
+previous window, so the estimate follows provider latency within an hour or two.
+"""
+
+import logging
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import redis.asyncio as aioredis
+
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "eta:latency"
+
+# Label of the histogram of all tasks (used for the throughput of the queue)
+ALL_LABEL = "all"
+
+# Histogram bucket upper bounds in seconds (last bucket is open-ended)
+LATENCY_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+
+LATENCY_WINDOW_SECONDS = 3600
+
+# Used until the histogram has data
+DEFAULT_SERVICE_SECONDS = 45.0
+
+# RQ key names (see rq.queue / rq.worker_registration / rq.registry)
+RQ_QUEUE_KEY = "rq:queue:{0}"
+RQ_WORKERS_KEY = "rq:workers:{0}"
+RQ_STARTED_KEY = "rq:wip:{0}"
+
+
+@dataclass
+class LatencyStats:
+    """Processing time statistics of one histogram label."""
+
+    count: int
+    mean: float
+    p50: float
+    p90: float
+
+
+@dataclass
+class TaskEta:
+    """Expected start and finish of a task submitted now."""
+
+    ahead: int  # Queued jobs in front of the task
+    workers: int  # Worker slots listening on the queue
+    start_in: float  # Seconds until a worker takes the task
+    finish_in: float  # Seconds until the result is ready
+
+    @property
+    def start_at(self) -> float:
+        return time.time() + self.start_in
+
+    @property
+    def finish_at(self) -> float:
+        return time.time() + self.finish_in
+
+
+def latency_label(model: Optional[str], quality: Optional[str]) -> str:
+    """Histogram label of a model/quality pair (model is resolved to its API name)."""
+    from bot.services.provider_registry import resolve_provider_key
+
+    _, api_model = resolve_provider_key(model)
+    return f"{api_model}:{quality or 'default'}"
+
+
+def format_eta(seconds: float) -> str:
+    """Human readable duration for user messages."""
+    seconds = max(0, int(math.ceil(seconds)))
+    if seconds < 60:
+        return f"~{seconds} с"
+    return f"~{int(math.ceil(seconds / 60))} мин"
+
+
+class EtaService:
+    """ETA estimates from RQ queue state and the latency histogram."""
+
+    def __init__(self, redis: aioredis.Redis, queue_names: Optional[List[str]] = None):
+        """
+        Initialize service.
+
+        Args:
+            redis: Async Redis client
+            queue_names: RQ queues the generation tasks go to (default: all routed queues)
+        """
+        from bot.tasks.routing import LEGACY_QUEUE, generation_queue_names
+
+        self.redis = redis
+        self.queue_names = queue_names or generation_queue_names() + [LEGACY_QUEUE]
+
+    @staticmethod
+    def _window(now: float) -> int:
+        return int(now // LATENCY_WINDOW_SECONDS)
+
+    @staticmethod
+    def _bucket(seconds: float) -> str:
+        for bound in LATENCY_BUCKETS:
+            if seconds <= bound:
+                return str(bound)
+        return "inf"
+
+    async def record(self, model: Optional[str], quality: Optional[str], seconds: float) -> None:
+        """
+        Add a processing time to the histogram of the model/quality and of all tasks.
+
+        Args:
+            model: Task model
+            quality: Task image quality
+            seconds: Processing time (worker start to delivered result)
+        """
+        label = latency_label(model, quality)
+        window = self._window(time.time())
+        bucket = self._bucket(seconds)
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name in (label, ALL_LABEL):
+                key = f"{KEY_PREFIX}:{name}:{window}"
+                pipe.hincrby(key, bucket, 1)
+                pipe.hincrby(key, "count", 1)
+                pipe.hincrbyfloat(key, "sum", seconds)
+                pipe.expire(key, LATENCY_WINDOW_SECONDS * 2)
+            pipe.sadd(f"{KEY_PREFIX}:labels", label)
+            await pipe.execute()
+
+    async def latency(self, label: str) -> Optional[LatencyStats]:
+        """
+        Get processing time statistics of a label over the last two windows.
+
+        Args:
+            label: Histogram label (see latency_label) or ALL_LABEL
+
+        Returns:
+            LatencyStats or None if there is no data yet
+        """
+        window = self._window(time.time())
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(f"{KEY_PREFIX}:{label}:{window}")
+            pipe.hgetall(f"{KEY_PREFIX}:{label}:{window - 1}")
+            current, previous = await pipe.execute()
+
+        merged: Dict[str, float] = {}
+        for raw in (current, previous):
+            for field, value in raw.items():
+                field = field.decode() if isinstance(field, bytes) else field
+                merged[field] = merged.get(field, 0.0) + float(value)
+
+        count = int(merged.get("count", 0))
+        if count == 0:
+            return None
+
+        bounds = [str(bound) for bound in LATENCY_BUCKETS] + ["inf"]
+
+        def percentile(fraction: float) -> float:
+            threshold = count * fraction
+            cumulative = 0.0
+            for bound in bounds:
+                cumulative += merged.get(bound, 0.0)
+                if cumulative >= threshold:
+                    return float(bound) if bound != "inf" else float(LATENCY_BUCKETS[-1]) * 2
+            return float(LATENCY_BUCKETS[-1]) * 2
+
+        return LatencyStats(
+            count=count,
+            mean=merged.get("sum", 0.0) / count,
+            p50=percentile(0.5),
+            p90=percentile(0.9),
+        )
+
+    async def service_seconds(self, model: Optional[str] = None, quality: Optional[str] = None) -> float:
+        """
+        Expected processing time of a task (median of its model/quality).
+
+        Falls back to all tasks and then to DEFAULT_SERVICE_SECONDS.
+        """
+        if model is not None or quality is not None:
+            stats = await self.latency(latency_label(model, quality))
+            if stats is not None:
+                return stats.p50
+        stats = await self.latency(ALL_LABEL)
+        return stats.p50 if stats is not None else DEFAULT_SERVICE_SECONDS
+
+    async def queue_state(self) -> Dict[str, Dict[str, int]]:
+        """
+        Depth, worker slots and running jobs of every queue (one round trip).
+
+        Returns:
+            Queue name -> {"depth", "workers", "busy"}
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name in self.queue_names:
+                pipe.llen(RQ_QUEUE_KEY.format(name))
+                pipe.scard(RQ_WORKERS_KEY.format(name))
+                pipe.zcard(RQ_STARTED_KEY.format(name))
+            values = await pipe.execute()
+
+        return {
+            name: {
+                "depth": values[i * 3],
+                "workers": values[i * 3 + 1],
+                "busy": values[i * 3 + 2],
+            }
+            for i, name in enumerate(self.queue_names)
+        }
+
+    async def estimate(
+        self,
+        model: Optional[str] = None,
+        quality: Optional[str] = None,
+        queue_name: Optional[str] = None,
+        enqueued: bool = False,
+    ) -> Optional[TaskEta]:
+        """
+        Estimate when a task submitted now starts and finishes.
+
+        Args:
+            model: Task model (None - any queue, average over all tasks)
+            quality: Task image quality
+            queue_name: Queue the task went to (default: route of a non-paying user)
+            enqueued: The task's own job is already in the queue
+
+        Returns:
+            TaskEta or None if no worker is listening on the queue
+        """
+        state = await self.queue_state()
+        # Slots are shared by the queues of a worker, so busy slots are counted over all queues
+        busy = sum(queue["busy"] for queue in state.values())
+        if queue_name is None and (model is not None or quality is not None):
+            from bot.tasks.routing import route_generation_task
+
+            queue_name = route_generation_task(model, quality)
+        if queue_name is not None:
+            route = state.get(queue_name, {})
+            depth = route.get("depth", 0)
+            workers = route.get("workers", 0)
+        else:
+            depth = sum(queue["depth"] for queue in state.values())
+            workers = max((queue["workers"] for queue in state.values()), default=0)
+
+        if workers == 0:
+            return None
+
+        ahead = max(0, depth - 1) if enqueued else depth
+        # Queue throughput is driven by the average task, not by this one
+        throughput_seconds = await self.service_seconds()
+        own_seconds = await self.service_seconds(model, quality)
+
+        # Jobs that have to finish before a slot frees up for this task
+        blocking = ahead + min(busy, workers) - workers + 1
+        start_in = max(0, blocking) / workers * throughput_seconds
+
+        return TaskEta(
+            ahead=ahead,
+            workers=workers,
+            start_in=start_in,
+            finish_in=start_in + own_seconds,
+        )
+
+    async def queue_snapshot(self) -> dict:
+        """Per-queue state, next-task ETA and latency per label (admin API)."""
+        state = await self.queue_state()
+        labels = await self.redis.smembers(f"{KEY_PREFIX}:labels")
+
+        latency: Dict[str, dict] = {}
+        names: List[str] = [ALL_LABEL] + sorted(
+            label.decode() if isinstance(label, bytes) else label for label in labels
+        )
+        for name in names:
+            stats = await self.latency(name)
+            if stats is not None:
+                latency[name] = {
+                    "count": stats.count,
+                    "mean_seconds": round(stats.mean, 1),
+                    "p50_seconds": stats.p50,
+                    "p90_seconds": stats.p90,
+                }
+
+        eta = await self.estimate()
+        return {
+            "queues": state,
+            "next_task_start_seconds": round(eta.start_in, 1) if eta else None,
+            "next_task_finish_seconds": round(eta.finish_in, 1) if eta else None,
+            "latency": latency,
+        }
+
+
+def get_eta_service() -> EtaService:
+    """Get the ETA service on the shared Redis pool."""
+    return EtaService(get_redis())
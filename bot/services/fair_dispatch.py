@@ -0,0 +1,294 @@
+"""Per-user fair dispatch of generation tasks to RQ.
+
+RQ queues are FIFO, so a user who submits 20 tasks in a few seconds used to
+push everybody else behind them. Tasks now pass through a dispatcher that
+lets each user have at most ``MAX_INFLIGHT_TASKS_PER_USER`` jobs in RQ
+(queued or running); the rest wait in the user's own pending list:
+
+- ``fair:inflight:<user_id>``  -> sorted set, task_id by dispatch time
+- ``fair:pending:<user_id>``   -> list of waiting tasks (JSON task_id + queue)
+- ``fair:owner:<task_id>``     -> user_id of a dispatched task
+- ``fair:users``               -> set of users with pending tasks
+
+When the worker finishes a task (success or final failure), the user's slot is
+released and their next pending task goes to the tail of the RQ queue - behind
+the tasks other users submitted meanwhile. This is round-robin across users
+with a quantum of the in-flight cap: a new task waits for at most
+``cap x active users`` jobs, however deep one user's backlog is.
+
+Slot checks use WATCH/MULTI transactions, so app replicas and worker slots
+never put more than the cap of a user's tasks in RQ. Slots of jobs that died
+without a release (worker crash, RQ giving up on retries) expire after
+``STALE_INFLIGHT_SECONDS``; the app sweeper then dispatches what was waiting.
+A task deferred by the provider guard refreshes its slot, so a long wait for
+the circuit doesn't let the slot expire under it.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Callable, Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from bot.config import config
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "fair"
+
+# Longer than a job with all its RQ retries (timeouts + retry intervals)
+STALE_INFLIGHT_SECONDS = 30 * 60
+
+# Seconds between sweeps of users with pending tasks
+SWEEP_INTERVAL = 30
+
+
+class FairDispatcher:
+    """Caps in-flight tasks per user and dispatches the rest in turn."""
+
+    def __init__(
+        self,
+        redis: aioredis.Redis,
+        max_inflight: int,
+        enqueue: Optional[Callable[[int, str], None]] = None,
+    ):
+        """
+        Initialize dispatcher.
+
+        Args:
+            redis: Async Redis client
+            max_inflight: Max tasks of one user in RQ at the same time
+            enqueue: Puts a task on an RQ queue - (task_id, queue_name);
+                defaults to bot.tasks.generation.enqueue_to_queue
+        """
+        self.redis = redis
+        self.max_inflight = max(1, max_inflight)
+        self._enqueue = enqueue
+
+    @staticmethod
+    def _inflight_key(user_id: int) -> str:
+        return f"{KEY_PREFIX}:inflight:{user_id}"
+
+    @staticmethod
+    def _pending_key(user_id: int) -> str:
+        return f"{KEY_PREFIX}:pending:{user_id}"
+
+    @staticmethod
+    def _owner_key(task_id: int) -> str:
+        return f"{KEY_PREFIX}:owner:{task_id}"
+
+    def _dispatch(self, task_id: int, queue_name: str) -> None:
+        enqueue = self._enqueue
+        if enqueue is None:
+            from bot.tasks.generation import enqueue_to_queue
+
+            enqueue = enqueue_to_queue
+        enqueue(task_id, queue_name)
+
+    async def _prune_stale(self, user_id: int) -> None:
+        await self.redis.zremrangebyscore(
+            self._inflight_key(user_id), "-inf", time.time() - STALE_INFLIGHT_SECONDS
+        )
+
+    async def submit(self, task_id: int, user_id: int, queue_name: str) -> bool:
+        """
+        Dispatch a task to RQ if the user has a free slot, otherwise make it wait.
+
+        Args:
+            task_id: Task database ID
+            user_id: Owner's database ID
+            queue_name: RQ queue the task is routed to
+
+        Returns:
+            True if the task went to RQ right away
+        """
+        inflight_key = self._inflight_key(user_id)
+        pending_key = self._pending_key(user_id)
+        await self._prune_stale(user_id)
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(inflight_key, pending_key)
+                    inflight = await pipe.zcard(inflight_key)
+                    waiting = await pipe.llen(pending_key)
+                    # Tasks that already wait go first, new ones queue up behind them
+                    dispatch = inflight < self.max_inflight and waiting == 0
+                    pipe.multi()
+                    if dispatch:
+                        pipe.zadd(inflight_key, {str(task_id): time.time()})
+                        pipe.set(self._owner_key(task_id), user_id, ex=STALE_INFLIGHT_SECONDS)
+                    else:
+                        pipe.rpush(pending_key, json.dumps({"task_id": task_id, "queue": queue_name}))
+                        pipe.sadd(f"{KEY_PREFIX}:users", user_id)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+        if not dispatch:
+            logger.info(
+                f"Task {task_id} waits for a free slot of user {user_id} "
+                f"({inflight} in flight, {waiting + 1} pending)"
+            )
+            return False
+
+        try:
+            self._dispatch(task_id, queue_name)
+        except Exception:
+            # Give the slot back, the caller reports the enqueue failure
+            await self.redis.zrem(inflight_key, str(task_id))
+            raise
+        return True
+
+    async def release(self, task_id: int) -> None:
+        """
+        Free the slot of a finished task and dispatch the owner's next task.
+
+        Args:
+            task_id: Task database ID
+        """
+        user_id = await self.redis.get(self._owner_key(task_id))
+        if user_id is None:
+            return
+        user_id = int(user_id)
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._inflight_key(user_id), str(task_id))
+            pipe.delete(self._owner_key(task_id))
+            await pipe.execute()
+
+        await self.dispatch_next(user_id)
+
+    async def refresh(self, task_id: int, delay: float = 0) -> None:
+        """
+        Keep the slot of a task that went back to RQ from going stale.
+
+        Args:
+            task_id: Task database ID
+            delay: Seconds until the task runs again
+        """
+        user_id = await self.redis.get(self._owner_key(task_id))
+        if user_id is None:
+            return
+
+        # Staleness counts from the next run instead of the first dispatch
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self._inflight_key(int(user_id)), {str(task_id): time.time() + delay}, xx=True)
+            pipe.expire(self._owner_key(task_id), int(STALE_INFLIGHT_SECONDS + delay))
+            await pipe.execute()
+
+    async def dispatch_next(self, user_id: int) -> int:
+        """
+        Dispatch pending tasks of a user while they have free slots.
+
+        Args:
+            user_id: User database ID
+
+        Returns:
+            Number of tasks dispatched
+        """
+        inflight_key = self._inflight_key(user_id)
+        pending_key = self._pending_key(user_id)
+        await self._prune_stale(user_id)
+
+        dispatched = 0
+        while True:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(inflight_key, pending_key)
+                    inflight = await pipe.zcard(inflight_key)
+                    head = await pipe.lindex(pending_key, 0)
+                    if head is None:
+                        await pipe.unwatch()
+                        await self.redis.srem(f"{KEY_PREFIX}:users", user_id)
+                        return dispatched
+                    if inflight >= self.max_inflight:
+                        await pipe.unwatch()
+                        return dispatched
+
+                    item = json.loads(head)
+                    pipe.multi()
+                    pipe.lpop(pending_key)
+                    pipe.zadd(inflight_key, {str(item["task_id"]): time.time()})
+                    pipe.set(self._owner_key(item["task_id"]), user_id, ex=STALE_INFLIGHT_SECONDS)
+                    await pipe.execute()
+                except WatchError:
+                    continue
+
+            try:
+                self._dispatch(item["task_id"], item["queue"])
+                dispatched += 1
+                logger.info(f"Dispatched waiting task {item['task_id']} of user {user_id}")
+            except Exception as e:
+                # Don't lose the task: put it back at the head of the user's list
+                logger.error(f"Failed to dispatch task {item['task_id']}: {e}")
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.zrem(inflight_key, str(item["task_id"]))
+                    pipe.lpush(pending_key, head)
+                    await pipe.execute()
+                return dispatched
+
+    async def sweep(self) -> int:
+        """
+        Dispatch pending tasks of every user whose stale slots expired.
+
+        Returns:
+            Number of tasks dispatched
+        """
+        dispatched = 0
+        for user_id in await self.redis.smembers(f"{KEY_PREFIX}:users"):
+            dispatched += await self.dispatch_next(int(user_id))
+        return dispatched
+
+
+def get_fair_dispatcher() -> Optional[FairDispatcher]:
+    """
+    Get the dispatcher on the shared Redis pool.
+
+    Returns:
+        FairDispatcher or None if disabled (MAX_INFLIGHT_TASKS_PER_USER=0)
+    """
+    if config.max_inflight_tasks_per_user <= 0:
+        return None
+    return FairDispatcher(get_redis(), max_inflight=config.max_inflight_tasks_per_user)
+
+
+_sweeper: Optional[asyncio.Task] = None
+
+
+async def _sweep_forever() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        dispatcher = get_fair_dispatcher()
+        if dispatcher is None:
+            continue
+        try:
+            dispatched = await dispatcher.sweep()
+            if dispatched:
+                logger.info(f"Fair dispatch sweep: dispatched {dispatched} task(s)")
+        except Exception as e:
+            logger.error(f"Fair dispatch sweep failed: {e}")
+
+
+def start_fair_sweeper() -> None:
+    """Start the background sweep of pending tasks (app startup)."""
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.create_task(_sweep_forever())
+
+
+async def stop_fair_sweeper() -> None:
+    """Stop the background sweep (app shutdown)."""
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
@@ -1,24 +1,94 @@
 """Image provider service for AI image generation."""
 
+import asyncio
 import base64
+import io
+import json
 import logging
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
+import httpx
+import openai
 from openai import AsyncOpenAI
 
+from bot.config import config
+from bot.services.progress_events import (
+    STAGE_MODEL_STARTED,
+    STAGE_SOURCES_DOWNLOADED,
+    report_stage,
+)
+
 logger = logging.getLogger(__name__)
 
 
 @dataclass
 class GenerationResult:
-    """Result of an image generation/edit operation."""
+    """Result of an image generation/edit operation.
+
+    ``image_bytes`` holds the decoded image: base64 from the API is decoded
+    once in the provider and the string is not kept around.
+    """
     
     success: bool
-    image_base64: Optional[str] = None
+    image_bytes: Optional[bytes] = None
     image_url: Optional[str] = None
     error: Optional[str] = None
+    # Set for failures of the upstream API itself (see failure_result)
+    status_code: Optional[int] = None
+    retry_after: Optional[float] = None
+    transient: bool = False  # 429, 5xx, timeout - the provider is overloaded
+    deferred: bool = False  # Not sent: the provider circuit is open (provider_guard)
+
+
+def _parse_retry_after(headers) -> Optional[float]:
+    """Parse Retry-After (seconds) or retry-after-ms response headers."""
+    if headers is None:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return float(value) / 1000
+        value = headers.get("retry-after")
+        if value is not None:
+            return float(value)
+    except (TypeError, ValueError):
+        # HTTP-date form is not used by OpenAI/ARK
+        pass
+    return None
+
+
+def failure_result(e: Exception) -> GenerationResult:
+    """
+    Build a failed result from a provider exception.
+
+    API errors keep their status code and Retry-After, so the provider guard
+    can tell overload (429, 5xx, timeouts) from bad requests and moderation.
+    """
+    status_code = getattr(e, "status_code", None)
+    response = getattr(e, "response", None)
+    # APIConnectionError includes APITimeoutError
+    transient = isinstance(e, openai.APIConnectionError) or (
+        isinstance(e, openai.APIStatusError) and (status_code == 429 or status_code >= 500)
+    )
+    return GenerationResult(
+        success=False,
+        error=str(e),
+        status_code=status_code,
+        retry_after=_parse_retry_after(response.headers) if response is not None else None,
+        transient=transient,
+    )
+
+
+def _guess_image_mime(data: bytes) -> str:
+    """Detect image MIME type by magic bytes (Telegram photos are JPEG)."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
 
 
 class ImageProvider(ABC):
@@ -60,13 +130,127 @@ AVAILABLE_MODELS = {
 DEFAULT_MODEL = "gpt-image-1"
 
 
+def parse_image_sources(image_source: str) -> List[str]:
+    """
+    Parse task source_image_url into a list of sources.
+
+    image_source can be:
+    - A single file_id or URL
+    - A JSON array of file_ids (for multiple images)
+    """
+    try:
+        parsed = json.loads(image_source)
+        if isinstance(parsed, list):
+            return parsed
+    except (json.JSONDecodeError, TypeError):
+        pass
+    return [image_source]
+
+
+async def _download_image_source(src: str, bot_token: Optional[str]) -> bytes:
+    """Download one source image by URL or Telegram file_id."""
+    if src.startswith(('http://', 'https://')):
+        # It's a URL - download directly
+        from bot.services.provider_registry import get_download_client
+
+        img_response = await get_download_client().get(src)
+        img_response.raise_for_status()
+        return img_response.content
+
+    # It's a Telegram file_id - download from Telegram
+    if not bot_token:
+        raise ValueError("bot_token required for Telegram file_id")
+
+    from bot.bot import get_bot
+    from bot.services.source_cache import get_source_cache
+
+    # Regenerations and retries re-submit the same file_ids
+    cache = get_source_cache()
+    if cache is not None:
+        try:
+            cached = await cache.get(src)
+            if cached is not None:
+                logger.info(f"Source image cache hit: {len(cached)} bytes")
+                return cached
+        except Exception as e:
+            logger.warning(f"Source image cache read failed: {e}")
+
+    bot = get_bot()
+    file = await bot.get_file(src)
+    file_buffer = io.BytesIO()
+    await bot.download_file(file.file_path, file_buffer)
+    image_bytes = file_buffer.getvalue()
+
+    if cache is not None:
+        try:
+            await cache.put(src, file.file_unique_id, image_bytes)
+        except Exception as e:
+            logger.warning(f"Source image cache write failed: {e}")
+
+    return image_bytes
+
+
+async def download_image_sources(
+    image_sources: List[str],
+    bot_token: Optional[str] = None,
+) -> List[bytes]:
+    """
+    Download edit source images concurrently.
+
+    At most ``config.source_download_concurrency`` downloads run at once and
+    each one is limited by ``config.download_timeout``. If any source fails
+    the whole edit fails, like the sequential loop did.
+
+    Args:
+        image_sources: URLs or Telegram file_ids
+        bot_token: Bot token (required for Telegram file_ids)
+
+    Returns:
+        Image bytes in the same order as image_sources
+    """
+    semaphore = asyncio.Semaphore(max(config.source_download_concurrency, 1))
+    started = time.monotonic()
+
+    async def _fetch(idx: int, src: str) -> bytes:
+        async with semaphore:
+            source_started = time.monotonic()
+            try:
+                image_bytes = await asyncio.wait_for(
+                    _download_image_source(src, bot_token),
+                    timeout=config.download_timeout,
+                )
+            except asyncio.TimeoutError:
+                raise TimeoutError(
+                    f"Source image {idx + 1} download timed out after {config.download_timeout:.0f}s"
+                )
+            logger.info(
+                f"Downloaded source image {idx + 1}/{len(image_sources)}: "
+                f"{len(image_bytes)} bytes in {time.monotonic() - source_started:.2f}s"
+            )
+            return image_bytes
+
+    results = await asyncio.gather(
+        *(_fetch(idx, src) for idx, src in enumerate(image_sources))
+    )
+    logger.info(
+        f"Downloaded {len(results)} source image(s) in {time.monotonic() - started:.2f}s"
+    )
+    await report_stage(STAGE_SOURCES_DOWNLOADED)
+    return list(results)
+
+
 class OpenAIImageProvider(ImageProvider):
     """OpenAI Images API implementation of ImageProvider."""
     
-    def __init__(self, api_key: str, model: str = DEFAULT_MODEL):
+    def __init__(
+        self,
+        api_key: str,
+        model: str = DEFAULT_MODEL,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         self.api_key = api_key
         self.model = model
-        self.client = AsyncOpenAI(api_key=api_key)
+        self.client = AsyncOpenAI(api_key=api_key, http_client=http_client)
     
     async def generate(
         self,
@@ -83,6 +267,8 @@ class OpenAIImageProvider(ImageProvider):
         logger.info(f"Generating image with model {use_model}, prompt: {prompt[:100]}...")
         
         try:
+            await report_stage(STAGE_MODEL_STARTED)
+            
             # GPT image models don't support response_format parameter
             # They always return b64_json
             response = await self.client.images.generate(
@@ -97,10 +283,11 @@ class OpenAIImageProvider(ImageProvider):
             
             # GPT image models return b64_json
             if hasattr(image_data, 'b64_json') and image_data.b64_json:
-                logger.info(f"Image generated successfully (base64)")
+                image_bytes = base64.b64decode(image_data.b64_json)
+                logger.info(f"Image generated successfully ({len(image_bytes)} bytes)")
                 return GenerationResult(
                     success=True,
-                    image_base64=image_data.b64_json,
+                    image_bytes=image_bytes,
                 )
             # DALL-E models may return URL
             elif hasattr(image_data, 'url') and image_data.url:
@@ -117,12 +304,8 @@ class OpenAIImageProvider(ImageProvider):
                 )
         
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"Image generation failed: {error_msg}")
-            return GenerationResult(
-                success=False,
-                error=error_msg,
-            )
+            logger.error(f"Image generation failed: {e}")
+            return failure_result(e)
     
     async def edit(
         self,
@@ -146,51 +329,14 @@ class OpenAIImageProvider(ImageProvider):
         logger.info(f"Editing image with model {use_model}, prompt: {prompt[:100]}...")
         
         try:
-            import httpx
-            import io
-            import json
-            
-            # Parse image_source - could be single file_id or JSON array
-            image_sources = []
-            try:
-                parsed = json.loads(image_source)
-                if isinstance(parsed, list):
-                    image_sources = parsed
-                else:
-                    image_sources = [image_source]
-            except (json.JSONDecodeError, TypeError):
-                image_sources = [image_source]
+            image_sources = parse_image_sources(image_source)
             
-            # Download all images
+            # Download all images concurrently
             image_files = []
             
-            for idx, src in enumerate(image_sources):
-                image_bytes: bytes
-                
-                if src.startswith(('http://', 'https://')):
-                    # It's a URL - download directly
-                    async with httpx.AsyncClient() as http_client:
-                        img_response = await http_client.get(src)
-                        img_response.raise_for_status()
-                        image_bytes = img_response.content
-                else:
-                    # It's a Telegram file_id - download from Telegram
-                    if not bot_token:
-                        raise ValueError("bot_token required for Telegram file_id")
-                    
-                    from aiogram import Bot
-                    
-                    bot = Bot(token=bot_token)
-                    
-                    try:
-                        file = await bot.get_file(src)
-                        file_buffer = io.BytesIO()
-                        await bot.download_file(file.file_path, file_buffer)
-                        image_bytes = file_buffer.getvalue()
-                        logger.info(f"Downloaded image {idx + 1} from Telegram: {len(image_bytes)} bytes")
-                    finally:
-                        await bot.session.close()
-                
+            for idx, image_bytes in enumerate(
+                await download_image_sources(image_sources, bot_token)
+            ):
                 # Create file-like object
                 image_file = io.BytesIO(image_bytes)
                 image_file.name = f"image_{idx}.png"
@@ -202,6 +348,8 @@ class OpenAIImageProvider(ImageProvider):
             # Pass array of images if multiple, single image otherwise
             image_param = image_files if len(image_files) > 1 else image_files[0]
             
+            await report_stage(STAGE_MODEL_STARTED)
+            
             response = await self.client.images.edit(
                 model=use_model,
                 image=image_param,
@@ -215,10 +363,11 @@ class OpenAIImageProvider(ImageProvider):
             
             # GPT image models return b64_json
             if hasattr(image_data, 'b64_json') and image_data.b64_json:
-                logger.info(f"Image edited successfully (base64)")
+                image_bytes = base64.b64decode(image_data.b64_json)
+                logger.info(f"Image edited successfully ({len(image_bytes)} bytes)")
                 return GenerationResult(
                     success=True,
-                    image_base64=image_data.b64_json,
+                    image_bytes=image_bytes,
                 )
             # DALL-E 2 may return URL
             elif hasattr(image_data, 'url') and image_data.url:
@@ -235,12 +384,8 @@ class OpenAIImageProvider(ImageProvider):
                 )
         
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"Image edit failed: {error_msg}")
-            return GenerationResult(
-                success=False,
-                error=error_msg,
-            )
+            logger.error(f"Image edit failed: {e}")
+            return failure_result(e)
 
 
 class SeeDreamImageProvider(ImageProvider):
@@ -252,13 +397,19 @@ class SeeDreamImageProvider(ImageProvider):
         "seedream-4-5-251128": "seedream-4-5-251128",  # Allow full name too
     }
 
-    def __init__(self, api_key: str, model: str = "seedream-4-5-251128"):
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "seedream-4-5-251128",
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
         self.api_key = api_key
         self.model = model
         # SeeDream uses OpenAI SDK with custom base_url
         self.client = AsyncOpenAI(
             api_key=api_key,
             base_url="https://ark.ap-southeast.bytepluses.com/api/v3",
+            http_client=http_client,
         )
 
     def _get_full_model_name(self, model: str | None) -> str:
@@ -315,6 +466,8 @@ class SeeDreamImageProvider(ImageProvider):
         logger.info(f"Generating image with SeeDream {use_model}, size: {use_size}, quality: {quality}, prompt: {prompt[:100]}...")
 
         try:
+            await report_stage(STAGE_MODEL_STARTED)
+
             # SeeDream supports response_format="url" and standard size format
             response = await self.client.images.generate(
                 model=use_model,
@@ -344,12 +497,8 @@ class SeeDreamImageProvider(ImageProvider):
                 )
 
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"SeeDream image generation failed: {error_msg}")
-            return GenerationResult(
-                success=False,
-                error=error_msg,
-            )
+            logger.error(f"SeeDream image generation failed: {e}")
+            return failure_result(e)
 
     async def edit(
         self,
@@ -377,55 +526,20 @@ class SeeDreamImageProvider(ImageProvider):
         logger.info(f"Editing image with SeeDream {use_model}, size: {use_size}, quality: {quality}, prompt: {prompt[:100]}...")
 
         try:
-            import httpx
-            import io
-            import json
-
-            # Parse image_source - could be single file_id or JSON array
-            image_sources = []
-            try:
-                parsed = json.loads(image_source)
-                if isinstance(parsed, list):
-                    image_sources = parsed
-                else:
-                    image_sources = [image_source]
-            except (json.JSONDecodeError, TypeError):
-                image_sources = [image_source]
+            image_sources = parse_image_sources(image_source)
 
             # Use first image for edit (SeeDream supports only one reference image)
-            src = image_sources[0]
-            image_base64 = None
-
-            if src.startswith(('http://', 'https://')):
-                # It's a URL - download and convert to base64
-                async with httpx.AsyncClient() as http_client:
-                    img_response = await http_client.get(src)
-                    img_response.raise_for_status()
-                    image_bytes = img_response.content
-                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                    logger.info(f"Downloaded image from URL: {len(image_bytes)} bytes")
-            else:
-                # It's a Telegram file_id - download from Telegram
-                if not bot_token:
-                    raise ValueError("bot_token required for Telegram file_id")
-
-                from aiogram import Bot
+            image_bytes = (await download_image_sources(image_sources[:1], bot_token))[0]
 
-                bot = Bot(token=bot_token)
-
-                try:
-                    file = await bot.get_file(src)
-                    file_buffer = io.BytesIO()
-                    await bot.download_file(file.file_path, file_buffer)
-                    image_bytes = file_buffer.getvalue()
-                    image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-                    logger.info(f"Downloaded image from Telegram: {len(image_bytes)} bytes")
-                finally:
-                    await bot.session.close()
+            # Create data URL for SeeDream API in one step and drop the raw bytes
+            image_data_url = (
+                f"data:{_guess_image_mime(image_bytes)};base64,"
+                + base64.b64encode(image_bytes).decode('ascii')
+            )
+            del image_bytes
+            logger.info(f"Sending edit request to SeeDream with base64 image ({len(image_data_url)} chars)")
 
-            # Create data URL for SeeDream API
-            image_data_url = f"data:image/jpeg;base64,{image_base64}"
-            logger.info(f"Sending edit request to SeeDream with base64 image ({len(image_base64)} chars)")
+            await report_stage(STAGE_MODEL_STARTED)
 
             # SeeDream uses extra_body for image parameter in edit
             response = await self.client.images.generate(
@@ -457,9 +571,5 @@ class SeeDreamImageProvider(ImageProvider):
                 )
 
         except Exception as e:
-            error_msg = str(e)
-            logger.error(f"SeeDream image edit failed: {error_msg}")
-            return GenerationResult(
-                success=False,
-                error=error_msg,
-            )
+            logger.error(f"SeeDream image edit failed: {e}")
+            return failure_result(e)
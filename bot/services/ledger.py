@@ -0,0 +1,267 @@
+"""Compaction and reconciliation of the token ledger.
+
+Every balance change is an append-only ``transactions`` row written by
+``TransactionRepository.post`` in the same transaction as ``users.tokens``,
+which stays the balance the request path reads. ``token_balances`` keeps a
+compacted snapshot per user:
+
+- ``balance``   -> sum of the user's rows up to ``last_transaction_id``
+- ``spent``     -> generation charges minus refunds
+- ``purchased`` -> purchased tokens
+
+Compaction folds only the rows appended since the previous run into the
+snapshots (one INSERT ... SELECT ... ON CONFLICT), so its cost follows the
+traffic, not the ledger size. Rows younger than ``SETTLE_SECONDS`` wait for
+the next run: ids are taken before commit, and a row that commits late
+under a lower id must not be skipped.
+
+Reconciliation checks ``users.tokens == snapshot + rows after it`` for every
+user in one statement: a join of users with their snapshot and the short
+tail of rows after the highest folded id, never a SUM over the whole
+ledger. A mismatch means the balance was changed outside the ledger.
+
+The app runs both every ``LEDGER_COMPACTION_INTERVAL`` seconds; replicas
+take a PostgreSQL advisory lock so only one compacts at a time. One-off run::
+
+    python -m bot.services.ledger
+"""
+
+import asyncio
+import logging
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from sqlalchemy import case, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.config import config
+from bot.db.database import ROLE_ANALYTICS, get_session_maker
+from bot.db.models import TokenBalance, Transaction, User
+
+logger = logging.getLogger(__name__)
+
+# Rows are folded once they are this old (seconds)
+SETTLE_SECONDS = 60
+
+# pg_try_advisory_xact_lock key of the compaction
+ADVISORY_LOCK_ID = 0x1ED6E7
+
+# Mismatches logged per run
+MAX_REPORTED_MISMATCHES = 10
+
+
+@dataclass(frozen=True)
+class BalanceMismatch:
+    """A user whose materialized balance disagrees with the ledger."""
+
+    user_id: int
+    telegram_id: int
+    tokens: int  # users.tokens
+    ledger_balance: int  # snapshot + newer rows
+
+
+def _unfolded_rows():
+    """Condition of ledger rows not folded into their user's snapshot yet.
+
+    Every row up to the highest folded id is folded, so the index range
+    after it bounds the scan; the snapshot join checks the rest per user.
+    """
+    watermark = select(func.coalesce(func.max(TokenBalance.last_transaction_id), 0)).scalar_subquery()
+    return (
+        (Transaction.id > watermark)
+        & (Transaction.id > func.coalesce(TokenBalance.last_transaction_id, 0))
+    )
+
+
+def _upsert(dialect: str):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+async def compact_balances(session: AsyncSession, settle_seconds: float = SETTLE_SECONDS) -> int:
+    """
+    Fold ledger rows appended since the last compaction into the snapshots.
+
+    Args:
+        session: Session (committed by the caller)
+        settle_seconds: Leave rows younger than this for the next run
+
+    Returns:
+        Number of users whose snapshot moved
+    """
+    upper = select(func.max(Transaction.id))
+    if settle_seconds > 0:
+        settled = datetime.now(timezone.utc) - timedelta(seconds=settle_seconds)
+        upper = upper.where(Transaction.created_at < settled)
+    upper_id = await session.scalar(upper)
+    if upper_id is None:
+        return 0
+
+    spent = case(
+        (Transaction.type.in_(("generation", "refund")), -Transaction.tokens_amount),
+        else_=0,
+    )
+    purchased = case((Transaction.type == "purchase", Transaction.tokens_amount), else_=0)
+    new_rows = (
+        select(
+            Transaction.user_id,
+            func.sum(Transaction.tokens_amount),
+            func.sum(spent),
+            func.sum(purchased),
+            func.max(Transaction.id),
+        )
+        .outerjoin(TokenBalance, TokenBalance.user_id == Transaction.user_id)
+        .where(_unfolded_rows())
+        .where(Transaction.id <= upper_id)
+        .group_by(Transaction.user_id)
+    )
+
+    insert = _upsert(session.get_bind().dialect.name)
+    stmt = insert(TokenBalance).from_select(
+        ["user_id", "balance", "spent", "purchased", "last_transaction_id"],
+        new_rows,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[TokenBalance.user_id],
+        set_={
+            "balance": TokenBalance.balance + stmt.excluded.balance,
+            "spent": TokenBalance.spent + stmt.excluded.spent,
+            "purchased": TokenBalance.purchased + stmt.excluded.purchased,
+            "last_transaction_id": stmt.excluded.last_transaction_id,
+            "updated_at": func.now(),
+        },
+    )
+    result = await session.execute(stmt)
+    return max(result.rowcount, 0)
+
+
+async def reconcile(session: AsyncSession) -> List[BalanceMismatch]:
+    """
+    Compare every user's balance with their snapshot plus the newer ledger rows.
+
+    Returns:
+        Users whose users.tokens differs from the ledger
+    """
+    tail = (
+        select(
+            Transaction.user_id,
+            func.sum(Transaction.tokens_amount).label("amount"),
+        )
+        .outerjoin(TokenBalance, TokenBalance.user_id == Transaction.user_id)
+        .where(_unfolded_rows())
+        .group_by(Transaction.user_id)
+        .subquery()
+    )
+    ledger_balance = func.coalesce(TokenBalance.balance, 0) + func.coalesce(tail.c.amount, 0)
+    result = await session.execute(
+        select(User.id, User.telegram_id, User.tokens, ledger_balance)
+        .outerjoin(TokenBalance, TokenBalance.user_id == User.id)
+        .outerjoin(tail, tail.c.user_id == User.id)
+        .where(User.tokens != ledger_balance)
+        .order_by(User.id)
+    )
+    return [BalanceMismatch(*row) for row in result.all()]
+
+
+async def run_compaction(settle_seconds: float = SETTLE_SECONDS) -> Optional[List[BalanceMismatch]]:
+    """
+    Compact the ledger and reconcile balances.
+
+    Returns:
+        Mismatches found, or None if another process is compacting
+    """
+    async with get_session_maker(ROLE_ANALYTICS)() as session:
+        if session.get_bind().dialect.name == "postgresql":
+            locked = await session.scalar(select(func.pg_try_advisory_xact_lock(ADVISORY_LOCK_ID)))
+            if not locked:
+                return None
+        compacted = await compact_balances(session, settle_seconds)
+        await session.commit()
+        mismatches = await reconcile(session)
+
+    if compacted:
+        logger.info(f"Ledger compaction: {compacted} balance snapshot(s) updated")
+    for mismatch in mismatches[:MAX_REPORTED_MISMATCHES]:
+        logger.error(
+            f"Balance of user {mismatch.user_id} ({mismatch.telegram_id}) is {mismatch.tokens}, "
+            f"ledger says {mismatch.ledger_balance}"
+        )
+    return mismatches
+
+
+_compactor: Optional[asyncio.Task] = None
+_reported: frozenset = frozenset()
+
+
+async def _compact_forever() -> None:
+    global _reported
+    while True:
+        await asyncio.sleep(config.ledger_compaction_interval)
+        try:
+            mismatches = await run_compaction()
+        except Exception as e:
+            logger.error(f"Ledger compaction failed: {e}")
+            continue
+        if mismatches is None:
+            continue
+        # Tell admins once per new set of mismatching users, not every run
+        user_ids = frozenset(m.user_id for m in mismatches)
+        if user_ids and user_ids != _reported:
+            from bot.services.admin_notify import notify_admins
+            await notify_admins(
+                f"⚠️ <b>Расхождение баланса с журналом токенов</b>\n\n"
+                f"Пользователей: {len(user_ids)}\n"
+                f"ID: {', '.join(str(m.user_id) for m in mismatches[:MAX_REPORTED_MISMATCHES])}",
+                title="Баланс",
+            )
+        _reported = user_ids
+
+
+def start_ledger_compactor() -> None:
+    """Start the periodic compaction and reconciliation (app startup)."""
+    global _compactor
+    if config.ledger_compaction_interval <= 0:
+        return
+    if _compactor is None or _compactor.done():
+        _compactor = asyncio.create_task(_compact_forever())
+
+
+async def stop_ledger_compactor() -> None:
+    """Stop the compaction (app shutdown)."""
+    global _compactor
+    if _compactor is not None:
+        _compactor.cancel()
+        try:
+            await _compactor
+        except asyncio.CancelledError:
+            pass
+        _compactor = None
+
+
+async def _main() -> int:
+    from bot.db.database import close_db
+
+    try:
+        mismatches = await run_compaction()
+    finally:
+        await close_db()
+    if mismatches is None:
+        print("Another process is compacting the ledger")
+        return 1
+    print(f"{len(mismatches)} balance mismatch(es)")
+    for mismatch in mismatches:
+        print(
+            f"  user {mismatch.user_id} ({mismatch.telegram_id}): "
+            f"tokens {mismatch.tokens}, ledger {mismatch.ledger_balance}"
+        )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main()))
@@ -7,9 +7,14 @@ from aiogram import Bot
 from aiogram.types import Message
 
 from bot.config import config
+from bot.services.telegram_rate_limit import PRIORITY_BROADCAST, telegram_priority
 
 logger = logging.getLogger(__name__)
 
+# Monitoring copies are skipped rather than holding a worker for the channel's
+# per-minute Bot API limit
+MONITORING_MAX_WAIT = 10.0
+
 
 async def forward_source_photos_to_monitoring(
     bot: Bot,
@@ -25,43 +30,81 @@ async def forward_source_photos_to_monitoring(
     
     Args:
         bot: Bot instance
-        messages: List of photo messages to forward
+        messages: List of photo messages to forward (of one chat)
         user_telegram_id: User's Telegram ID
         username: User's username
         first_name: User's first name
         prompt: User's prompt
         task_type: Type of task (edit/generate)
     """
-    if not config.monitoring_channel_id:
+    if not messages:
+        return
+    await forward_source_message_ids_to_monitoring(
+        bot,
+        messages[0].chat.id,
+        [msg.message_id for msg in messages],
+        user_telegram_id,
+        username,
+        first_name,
+        prompt,
+        task_type,
+    )
+
+
+async def forward_source_message_ids_to_monitoring(
+    bot: Bot,
+    from_chat_id: int,
+    message_ids: List[int],
+    user_telegram_id: int,
+    username: Optional[str],
+    first_name: Optional[str],
+    prompt: str,
+    task_type: str = "edit",
+) -> None:
+    """
+    Forward source photos, known by their message IDs, to monitoring channel with user info.
+    
+    Args:
+        bot: Bot instance
+        from_chat_id: Chat the photos were sent to
+        message_ids: IDs of the photo messages
+        user_telegram_id: User's Telegram ID
+        username: User's username
+        first_name: User's first name
+        prompt: User's prompt
+        task_type: Type of task shown in the info message
+    """
+    if not config.monitoring_channel_id or not from_chat_id or not message_ids:
         return
     
     try:
-        # Forward all photos
-        for msg in messages:
-            await bot.forward_message(
-                chat_id=config.monitoring_channel_id,
-                from_chat_id=msg.chat.id,
-                message_id=msg.message_id,
-            )
+        with telegram_priority(PRIORITY_BROADCAST, max_wait=MONITORING_MAX_WAIT):
+            # Forward all photos
+            for message_id in message_ids:
+                await bot.forward_message(
+                    chat_id=config.monitoring_channel_id,
+                    from_chat_id=from_chat_id,
+                    message_id=message_id,
+                )
         
-        # Send info message
-        user_display = f"@{username}" if username else first_name or f"ID:{user_telegram_id}"
+            # Send info message
+            user_display = f"@{username}" if username else first_name or f"ID:{user_telegram_id}"
         
-        info_text = (
-            f"📸 <b>Исходные фото ({task_type})</b>\n\n"
-            f"<b>Пользователь:</b> {user_display}\n"
-            f"<b>Telegram ID:</b> <code>{user_telegram_id}</code>\n"
-            f"<b>Количество фото:</b> {len(messages)}\n\n"
-            f"<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
-        )
+            info_text = (
+                f"📸 <b>Исходные фото ({task_type})</b>\n\n"
+                f"<b>Пользователь:</b> {user_display}\n"
+                f"<b>Telegram ID:</b> <code>{user_telegram_id}</code>\n"
+                f"<b>Количество фото:</b> {len(message_ids)}\n\n"
+                f"<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
+            )
         
-        await bot.send_message(
-            chat_id=config.monitoring_channel_id,
-            text=info_text,
-            parse_mode="HTML",
-        )
+            await bot.send_message(
+                chat_id=config.monitoring_channel_id,
+                text=info_text,
+                parse_mode="HTML",
+            )
         
-        logger.info(f"Forwarded {len(messages)} source photos to monitoring channel for user {user_telegram_id}")
+            logger.info(f"Forwarded {len(message_ids)} source photos to monitoring channel for user {user_telegram_id}")
         
     except Exception as e:
         logger.error(f"Failed to forward source photos to monitoring channel: {e}")
@@ -104,40 +147,41 @@ async def forward_result_to_monitoring(
         return
     
     try:
-        # Forward result message
-        await bot.forward_message(
-            chat_id=config.monitoring_channel_id,
-            from_chat_id=result_message.chat.id,
-            message_id=result_message.message_id,
-        )
+        with telegram_priority(PRIORITY_BROADCAST, max_wait=MONITORING_MAX_WAIT):
+            # Forward result message
+            await bot.forward_message(
+                chat_id=config.monitoring_channel_id,
+                from_chat_id=result_message.chat.id,
+                message_id=result_message.message_id,
+            )
         
-        # Send details message
-        user_display = f"@{username}" if username else first_name or f"ID:{user_telegram_id}"
-        type_emoji = "🎨" if task_type == "generate" else "🪄"
+            # Send details message
+            user_display = f"@{username}" if username else first_name or f"ID:{user_telegram_id}"
+            type_emoji = "🎨" if task_type == "generate" else "🪄"
         
-        details_text = (
-            f"{type_emoji} <b>Результат генерации</b>\n\n"
-            f"<b>Task ID:</b> {task_id}\n"
-            f"<b>Пользователь:</b> {user_display}\n"
-            f"<b>Telegram ID:</b> <code>{user_telegram_id}</code>\n\n"
-            f"<b>Модель:</b> {model}\n"
-            f"<b>Качество:</b> {quality}\n"
-            f"<b>Размер:</b> {size}\n"
-            f"<b>Токены:</b> {tokens_spent} 🪙\n"
-        )
+            details_text = (
+                f"{type_emoji} <b>Результат генерации</b>\n\n"
+                f"<b>Task ID:</b> {task_id}\n"
+                f"<b>Пользователь:</b> {user_display}\n"
+                f"<b>Telegram ID:</b> <code>{user_telegram_id}</code>\n\n"
+                f"<b>Модель:</b> {model}\n"
+                f"<b>Качество:</b> {quality}\n"
+                f"<b>Размер:</b> {size}\n"
+                f"<b>Токены:</b> {tokens_spent} 🪙\n"
+            )
         
-        if generation_time:
-            details_text += f"<b>Время:</b> {generation_time:.1f}с\n"
+            if generation_time:
+                details_text += f"<b>Время:</b> {generation_time:.1f}с\n"
         
-        details_text += f"\n<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
+            details_text += f"\n<b>Промпт:</b>\n<i>{prompt[:500]}{'...' if len(prompt) > 500 else ''}</i>"
         
-        await bot.send_message(
-            chat_id=config.monitoring_channel_id,
-            text=details_text,
-            parse_mode="HTML",
-        )
+            await bot.send_message(
+                chat_id=config.monitoring_channel_id,
+                text=details_text,
+                parse_mode="HTML",
+            )
         
-        logger.info(f"Forwarded result to monitoring channel for task {task_id}")
+            logger.info(f"Forwarded result to monitoring channel for task {task_id}")
         
     except Exception as e:
         logger.error(f"Failed to forward result to monitoring channel: {e}")
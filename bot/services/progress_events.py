@@ -0,0 +1,119 @@
+"""Generation stage events published by the worker.
+
+The worker reports what it is actually doing with a task as stage events on
+the Redis stream ``progress:events``. The progress scheduler in the app
+(``bot.utils.progress_animation``) consumes them through a consumer group
+and renders them in the user's progress message. Every event carries the time
+spent since the previous stage, so the stream doubles as per-stage latency data.
+
+Code deep inside a job (source downloads, provider calls) reports stages via
+``report_stage()``. The reporter of the current job is kept in a context
+variable, so nothing has to be passed through provider signatures.
+"""
+
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+STREAM_KEY = "progress:events"
+
+# Approximate stream length cap (XADD MAXLEN ~)
+STREAM_MAXLEN = 10000
+
+# Stages in the order a task goes through them
+STAGE_QUEUED = "queued"
+STAGE_STARTED = "started"
+STAGE_SOURCES_DOWNLOADED = "sources_downloaded"
+STAGE_MODEL_STARTED = "model_started"
+STAGE_RESULT_RECEIVED = "result_received"
+STAGE_UPLOADING = "uploading"
+STAGE_DELIVERED = "delivered"
+
+STAGES = (
+    STAGE_QUEUED,
+    STAGE_STARTED,
+    STAGE_SOURCES_DOWNLOADED,
+    STAGE_MODEL_STARTED,
+    STAGE_RESULT_RECEIVED,
+    STAGE_UPLOADING,
+    STAGE_DELIVERED,
+)
+
+# From these stages on the result message is about to replace the progress
+# message, so animation edits are pointless
+DELIVERY_STAGES = (STAGE_RESULT_RECEIVED, STAGE_UPLOADING, STAGE_DELIVERED)
+
+_current_reporter: contextvars.ContextVar[Optional["StageReporter"]] = contextvars.ContextVar(
+    "stage_reporter", default=None
+)
+
+
+class StageReporter:
+    """Publishes stage events of one task."""
+
+    def __init__(self, task_id: int, telegram_id: int, task_type: str = "generate"):
+        """
+        Initialize reporter.
+
+        Args:
+            task_id: Task database ID
+            telegram_id: Telegram ID of the task owner (progress messages are per user)
+            task_type: "generate" or "edit"
+        """
+        self.task_id = task_id
+        self.telegram_id = telegram_id
+        self.task_type = task_type
+        self._last_stage_at = time.monotonic()
+
+    async def report(self, stage: str, **extra) -> None:
+        """
+        Publish a stage event. Errors are logged and never fail the task.
+
+        Args:
+            stage: One of STAGES
+            **extra: Additional event fields (e.g. expected_s on start)
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_stage_at
+        self._last_stage_at = now
+        logger.info(f"Task {self.task_id}: stage {stage} (+{elapsed:.2f}s)")
+
+        try:
+            await get_redis().xadd(
+                STREAM_KEY,
+                {
+                    "task_id": self.task_id,
+                    "telegram_id": self.telegram_id,
+                    "task_type": self.task_type,
+                    "stage": stage,
+                    "elapsed_ms": int(elapsed * 1000),
+                    "ts": f"{time.time():.3f}",
+                    **extra,
+                },
+                maxlen=STREAM_MAXLEN,
+                approximate=True,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to publish stage {stage} for task {self.task_id}: {e}")
+
+
+def bind_stage_reporter(reporter: Optional[StageReporter]) -> contextvars.Token:
+    """Make the reporter current for the running job (returns a token for reset)."""
+    return _current_reporter.set(reporter)
+
+
+def reset_stage_reporter(token: contextvars.Token) -> None:
+    """Restore the previous reporter."""
+    _current_reporter.reset(token)
+
+
+async def report_stage(stage: str, **extra) -> None:
+    """Report a stage of the current job, if any reporter is bound."""
+    reporter = _current_reporter.get()
+    if reporter is not None:
+        await reporter.report(stage, **extra)
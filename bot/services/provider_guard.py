@@ -0,0 +1,326 @@
+"""Adaptive concurrency limit and circuit breaker per upstream provider.
+
+Every worker used to send as many requests as it had slots, also while the
+provider answered 429/5xx, and failed jobs came back through RQ retries on top
+of that. ``GuardedImageProvider`` wraps each provider of the registry and
+keeps its calls near the capacity the provider actually has. State is shared
+by all workers through Redis, per ``<provider>:<model>``:
+
+- ``provider_guard:<key>:state``  -> hash: ``limit``, ``failures``,
+  ``open_until``, ``cooldown``, ``last_decrease``
+- ``provider_guard:<key>:slots``  -> sorted set of running calls by lease expiry
+- ``provider_guard:<key>:probe``  -> the half-open probe is in progress
+
+Concurrency limit is AIMD: each success adds ``1/limit`` (so +1 per ``limit``
+successes), an overload (429, 5xx, timeout) halves it, at most once per
+``DECREASE_INTERVAL`` so one burst of failures counts as one signal.
+
+Circuit breaker: ``PROVIDER_BREAKER_THRESHOLD`` overloads in a row, or any
+response with Retry-After, open the circuit for ``max(Retry-After, cooldown)``.
+The cooldown doubles with every re-opening. After it one probe call is let
+through (half-open): its success closes the circuit, its failure re-opens it.
+Calls that hit an open circuit wait if it closes soon, otherwise return a
+``deferred`` result: the worker re-enqueues the job for when the circuit
+closes, without using up one of its retries.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from bot.config import config
+from bot.redis_pool import get_redis
+from bot.services.image_provider import GenerationResult, ImageProvider
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "provider_guard"
+
+# Lowest concurrency the limit can fall to
+MIN_LIMIT = 1
+
+# Halve the limit at most this often (seconds)
+DECREASE_INTERVAL = 5.0
+
+# Longest circuit cooldown (seconds)
+MAX_COOLDOWN = 300.0
+
+# A call waits this long for an open circuit to close instead of failing
+MAX_OPEN_WAIT = 15.0
+
+# A call waits this long for a free slot before failing
+SLOT_WAIT_SECONDS = 60.0
+
+POLL_INTERVAL = 0.25
+
+
+class ProviderUnavailableError(Exception):
+    """The provider circuit is open or no slot was freed in time."""
+
+    def __init__(self, key: str, retry_after: float):
+        super().__init__(f"Провайдер {key} временно перегружен, повторите через {retry_after:.0f} с")
+        self.key = key
+        self.retry_after = retry_after
+
+
+@dataclass
+class GuardState:
+    """Shared limiter and breaker state of a provider."""
+
+    limit: float
+    failures: int = 0
+    open_until: float = 0.0  # 0 - closed; in the past - half-open
+    cooldown: float = 0.0
+    last_decrease: float = 0.0
+
+
+class ProviderGuard:
+    """Redis-backed AIMD limiter and circuit breaker of one provider/model."""
+
+    def __init__(
+        self,
+        key: str,
+        max_limit: int,
+        failure_threshold: int,
+        base_cooldown: float,
+        lease_seconds: float,
+        redis: Optional[aioredis.Redis] = None,
+    ):
+        """
+        Initialize guard.
+
+        Args:
+            key: Provider/model key, e.g. "openai:gpt-image-1"
+            max_limit: Upper bound of the concurrency limit (initial value)
+            failure_threshold: Overloads in a row that open the circuit
+            base_cooldown: First circuit cooldown in seconds
+            lease_seconds: Slot lifetime if a worker dies mid-call
+            redis: Async Redis client (default: shared pool)
+        """
+        self.key = key
+        self.max_limit = max_limit
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.lease_seconds = lease_seconds
+        self._redis = redis
+        self._state_key = f"{KEY_PREFIX}:{key}:state"
+        self._slots_key = f"{KEY_PREFIX}:{key}:slots"
+        self._probe_key = f"{KEY_PREFIX}:{key}:probe"
+
+    @property
+    def redis(self) -> aioredis.Redis:
+        return self._redis or get_redis()
+
+    async def get_state(self) -> GuardState:
+        """Read the shared state (defaults for a provider seen for the first time)."""
+        raw = await self.redis.hgetall(self._state_key)
+        raw = {
+            (k.decode() if isinstance(k, bytes) else k): float(v)
+            for k, v in raw.items()
+        }
+        return GuardState(
+            limit=min(raw.get("limit", self.max_limit), self.max_limit),
+            failures=int(raw.get("failures", 0)),
+            open_until=raw.get("open_until", 0.0),
+            cooldown=raw.get("cooldown", 0.0),
+            last_decrease=raw.get("last_decrease", 0.0),
+        )
+
+    async def _try_take_slot(self, limit: int) -> Optional[str]:
+        """Take a slot if fewer than ``limit`` calls are running."""
+        token = uuid.uuid4().hex
+        now = time.time()
+        # Leases of dead workers
+        await self.redis.zremrangebyscore(self._slots_key, "-inf", now)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self._slots_key)
+                    running = await pipe.zcard(self._slots_key)
+                    if running >= limit:
+                        return None
+                    pipe.multi()
+                    pipe.zadd(self._slots_key, {token: now + self.lease_seconds})
+                    await pipe.execute()
+                    return token
+                except WatchError:
+                    continue
+
+    async def acquire(self) -> str:
+        """
+        Wait for a slot of the provider.
+
+        Returns:
+            Slot token for release()
+
+        Raises:
+            ProviderUnavailableError: Circuit is open for long or no slot got free in time
+        """
+        deadline = time.monotonic() + SLOT_WAIT_SECONDS
+        while True:
+            state = await self.get_state()
+            now = time.time()
+
+            if state.open_until > now:
+                wait = state.open_until - now
+                if wait > MAX_OPEN_WAIT or time.monotonic() + wait > deadline:
+                    raise ProviderUnavailableError(self.key, wait)
+                await asyncio.sleep(wait)
+                continue
+
+            # Half-open: only one probe call until the circuit closes
+            half_open = state.open_until > 0
+            if half_open and not await self.redis.set(
+                self._probe_key, "1", nx=True, ex=int(self.lease_seconds)
+            ):
+                token = None
+            else:
+                token = await self._try_take_slot(max(MIN_LIMIT, int(state.limit)))
+                if token is None and half_open:
+                    await self.redis.delete(self._probe_key)
+
+            if token is not None:
+                return token
+            if time.monotonic() >= deadline:
+                raise ProviderUnavailableError(self.key, POLL_INTERVAL)
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def release(self, token: str, result: Optional[GenerationResult]) -> None:
+        """
+        Free the slot and feed the call outcome to the limiter and breaker.
+
+        Args:
+            token: Slot token from acquire()
+            result: Provider result (None if the call was interrupted)
+        """
+        await self.redis.zrem(self._slots_key, token)
+        if result is not None and result.success:
+            await self._on_success()
+        elif result is not None and result.transient:
+            await self._on_overload(result.retry_after)
+        else:
+            # Other failures (bad request, moderation) say nothing about provider
+            # health - a half-open circuit lets the next call probe instead
+            await self.redis.delete(self._probe_key)
+
+    async def _on_success(self) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self._state_key)
+                    state = await self.get_state()
+                    if state.open_until > time.time():
+                        # Opened by a failure while this call ran - only the probe closes it
+                        await pipe.unwatch()
+                        return
+
+                    pipe.multi()
+                    # Additive increase: +1 after `limit` successful calls
+                    pipe.hset(self._state_key, "limit", min(self.max_limit, state.limit + 1 / state.limit))
+                    if state.failures or state.open_until:
+                        pipe.hset(self._state_key, mapping={"failures": 0, "open_until": 0, "cooldown": 0})
+                        pipe.delete(self._probe_key)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+        if state.open_until:
+            logger.info(f"Provider {self.key}: circuit closed")
+
+    async def _on_overload(self, retry_after: Optional[float]) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(self._state_key)
+                    state = await self.get_state()
+                    now = time.time()
+                    update = {"failures": state.failures + 1}
+
+                    # Multiplicative decrease, once per burst of failures
+                    if now - state.last_decrease >= DECREASE_INTERVAL:
+                        update["limit"] = max(MIN_LIMIT, state.limit / 2)
+                        update["last_decrease"] = now
+
+                    half_open = 0 < state.open_until <= now
+                    if retry_after or half_open or update["failures"] >= self.failure_threshold:
+                        cooldown = min(
+                            MAX_COOLDOWN,
+                            state.cooldown * 2 if state.cooldown else self.base_cooldown,
+                        )
+                        update["cooldown"] = cooldown
+                        update["open_until"] = now + max(retry_after or 0, cooldown)
+
+                    pipe.multi()
+                    pipe.hset(self._state_key, mapping=update)
+                    pipe.delete(self._probe_key)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+        if "open_until" in update:
+            logger.warning(
+                f"Provider {self.key}: circuit open for {update['open_until'] - now:.0f}s "
+                f"(failures: {update['failures']}, retry-after: {retry_after})"
+            )
+        elif "limit" in update:
+            logger.warning(f"Provider {self.key}: overloaded, concurrency limit {update['limit']:.1f}")
+
+
+class GuardedImageProvider(ImageProvider):
+    """ImageProvider that runs every call through a ProviderGuard."""
+
+    def __init__(self, provider: ImageProvider, guard: ProviderGuard):
+        self.provider = provider
+        self.guard = guard
+
+    @property
+    def client(self):
+        """API client of the wrapped provider (closed by the registry)."""
+        return self.provider.client
+
+    async def _call(self, method, *args, **kwargs) -> GenerationResult:
+        try:
+            token = await self.guard.acquire()
+        except ProviderUnavailableError as e:
+            logger.warning(str(e))
+            return GenerationResult(
+                success=False,
+                error=str(e),
+                retry_after=e.retry_after,
+                deferred=True,
+            )
+
+        result = None
+        try:
+            result = await method(*args, **kwargs)
+            return result
+        finally:
+            try:
+                await self.guard.release(token, result)
+            except Exception as e:
+                logger.warning(f"Provider {self.guard.key}: failed to update guard state: {e}")
+
+    async def generate(self, *args, **kwargs) -> GenerationResult:
+        return await self._call(self.provider.generate, *args, **kwargs)
+
+    async def edit(self, *args, **kwargs) -> GenerationResult:
+        return await self._call(self.provider.edit, *args, **kwargs)
+
+
+def build_provider_guard(key: str) -> ProviderGuard:
+    """Create a guard for a provider/model from config."""
+    return ProviderGuard(
+        key,
+        max_limit=config.provider_max_concurrency,
+        failure_threshold=config.provider_breaker_threshold,
+        base_cooldown=config.provider_breaker_cooldown,
+        lease_seconds=config.provider_request_timeout + 30,
+    )
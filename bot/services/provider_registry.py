@@ -0,0 +1,145 @@
+"""Registry of long-lived image provider clients.
+
+Every generation used to build a new ``AsyncOpenAI`` client (and a new httpx
+pool with it), and every edit source was downloaded with a throwaway
+``httpx.AsyncClient``. Here providers are cached per (provider, model) and
+the HTTP clients are created once per process with tuned pools and explicit
+timeouts, so DNS lookups and TLS handshakes are paid only on the first task.
+Every provider is wrapped in a ``GuardedImageProvider`` (``bot.services.provider_guard``).
+
+Clients are bound to the event loop they were created on - in the worker this
+is the persistent runtime loop (see ``bot.tasks.runtime``).
+"""
+
+import logging
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+from bot.config import config
+from bot.services.image_provider import (
+    DEFAULT_MODEL,
+    ImageProvider,
+    OpenAIImageProvider,
+    SeeDreamImageProvider,
+)
+from bot.services.provider_guard import GuardedImageProvider, build_provider_guard
+
+logger = logging.getLogger(__name__)
+
+SEEDREAM_MODEL = "seedream-4-5-251128"
+
+# Idle connections are kept this long between tasks
+_KEEPALIVE_EXPIRY = 120.0
+
+_providers: Dict[Tuple[str, str], ImageProvider] = {}
+_download_client: Optional[httpx.AsyncClient] = None
+
+
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional ``h2`` package (``httpx[http2]``)."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _build_http_client(read_timeout: float, pool_limit: int) -> httpx.AsyncClient:
+    """Create an httpx client with a bounded keep-alive pool and explicit timeouts."""
+    return httpx.AsyncClient(
+        http2=_http2_available(),
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=pool_limit,
+            max_keepalive_connections=pool_limit,
+            keepalive_expiry=_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            read_timeout,
+            connect=config.provider_connect_timeout,
+            pool=config.provider_connect_timeout,
+        ),
+    )
+
+
+def resolve_provider_key(model: Optional[str]) -> Tuple[str, str]:
+    """
+    Map a task model name to a registry key.
+
+    Args:
+        model: Model name stored in the task (may be None for old tasks)
+
+    Returns:
+        Tuple of (provider, model)
+    """
+    if model and model.startswith("seedream"):
+        return "seedream", SEEDREAM_MODEL
+    return "openai", model or DEFAULT_MODEL
+
+
+def get_image_provider(model: Optional[str]) -> ImageProvider:
+    """
+    Get a cached image provider for the model.
+
+    Args:
+        model: Model name from the task
+
+    Returns:
+        ImageProvider instance shared by generate and edit
+    """
+    key = resolve_provider_key(model)
+    provider = _providers.get(key)
+    if provider is None:
+        provider_name, provider_model = key
+        http_client = _build_http_client(
+            config.provider_request_timeout,
+            config.provider_pool_limit,
+        )
+        if provider_name == "seedream":
+            provider = SeeDreamImageProvider(
+                api_key=config.ark_api_key,
+                model=provider_model,
+                http_client=http_client,
+            )
+        else:
+            provider = OpenAIImageProvider(
+                api_key=config.openai_api_key,
+                model=provider_model,
+                http_client=http_client,
+            )
+        # Shared adaptive limit and circuit breaker per provider/model
+        provider = GuardedImageProvider(provider, build_provider_guard(f"{provider_name}:{provider_model}"))
+        _providers[key] = provider
+        logger.info(
+            f"Image provider created: {provider_name}/{provider_model} "
+            f"(http2: {_http2_available()})"
+        )
+    return provider
+
+
+def get_download_client() -> httpx.AsyncClient:
+    """Get the shared client for downloading source and result images by URL."""
+    global _download_client
+    if _download_client is None or _download_client.is_closed:
+        _download_client = _build_http_client(
+            config.download_timeout,
+            config.provider_pool_limit,
+        )
+    return _download_client
+
+
+async def close_providers() -> None:
+    """Close all provider clients and the download client (shutdown hook)."""
+    global _download_client
+    for (provider_name, provider_model), provider in list(_providers.items()):
+        try:
+            await provider.client.close()
+        except Exception as e:
+            logger.error(f"Failed to close {provider_name}/{provider_model} client: {e}")
+    _providers.clear()
+
+    if _download_client is not None:
+        await _download_client.aclose()
+        _download_client = None
+    logger.info("Image provider clients closed")
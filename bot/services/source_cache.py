@@ -0,0 +1,169 @@
+"""Shared cache of edit source images downloaded from Telegram.
+
+Regenerations, feedback retries, template edits and RQ retries re-submit the
+same Telegram file_ids, and each of them used to download the photos again.
+Downloaded bytes are stored in Redis (shared by all worker processes):
+
+- ``source_cache:id:<file_id>``      -> file_unique_id
+- ``source_cache:blob:<unique_id>``  -> image bytes
+- ``source_cache:lru``               -> sorted set, unique_id by last access time
+- ``source_cache:sizes``             -> hash, unique_id -> size in bytes
+- ``source_cache:total``             -> total size of cached blobs
+
+Blobs are keyed by ``file_unique_id`` so the same photo sent with different
+file_ids is stored once. When the total size exceeds the limit, least
+recently used blobs are evicted.
+"""
+
+import logging
+import time
+from typing import Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import WatchError
+
+from bot.config import config
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "source_cache"
+
+# file_id -> file_unique_id mappings are tiny, keep them for a week
+_ID_TTL_SECONDS = 7 * 24 * 3600
+
+# How many LRU entries are popped per eviction round
+_EVICT_BATCH = 16
+
+
+class SourceImageCache:
+    """Size-bounded LRU cache of source images in Redis."""
+
+    def __init__(self, redis: aioredis.Redis, max_bytes: int):
+        """
+        Initialize cache.
+
+        Args:
+            redis: Async Redis client
+            max_bytes: Maximum total size of cached images
+        """
+        self.redis = redis
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _id_key(file_id: str) -> str:
+        return f"{KEY_PREFIX}:id:{file_id}"
+
+    @staticmethod
+    def _blob_key(file_unique_id: str) -> str:
+        return f"{KEY_PREFIX}:blob:{file_unique_id}"
+
+    async def get(self, file_id: str) -> Optional[bytes]:
+        """
+        Get cached image bytes for a Telegram file_id.
+
+        Args:
+            file_id: Telegram file_id
+
+        Returns:
+            Image bytes or None on cache miss
+        """
+        unique_id = await self.redis.get(self._id_key(file_id))
+        if unique_id is None:
+            return None
+        unique_id = unique_id.decode() if isinstance(unique_id, bytes) else unique_id
+
+        data = await self.redis.get(self._blob_key(unique_id))
+        if data is None:
+            # Blob was evicted - the mapping is useless now
+            await self.redis.delete(self._id_key(file_id))
+            return None
+
+        await self.redis.zadd(f"{KEY_PREFIX}:lru", {unique_id: time.time()})
+        return data
+
+    async def put(self, file_id: str, file_unique_id: str, data: bytes) -> None:
+        """
+        Store image bytes and evict old entries if the cache is over the limit.
+
+        Args:
+            file_id: Telegram file_id used by the task
+            file_unique_id: Telegram file_unique_id of the same file
+            data: Image bytes
+        """
+        size = len(data)
+        if size > self.max_bytes:
+            return
+
+        # The old size is read under WATCH: concurrent puts of the same image
+        # must not both add their delta to the total
+        async with self.redis.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(f"{KEY_PREFIX}:sizes")
+                    old_size = await pipe.hget(f"{KEY_PREFIX}:sizes", file_unique_id)
+                    delta = size - int(old_size or 0)
+
+                    pipe.multi()
+                    pipe.set(self._blob_key(file_unique_id), data)
+                    pipe.set(self._id_key(file_id), file_unique_id, ex=_ID_TTL_SECONDS)
+                    pipe.zadd(f"{KEY_PREFIX}:lru", {file_unique_id: time.time()})
+                    pipe.hset(f"{KEY_PREFIX}:sizes", file_unique_id, size)
+                    pipe.incrby(f"{KEY_PREFIX}:total", delta)
+                    results = await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+
+        total = int(results[-1])
+        if total > self.max_bytes:
+            await self._evict(total)
+
+    async def _evict(self, total: int) -> None:
+        """Remove least recently used blobs until the cache fits the limit."""
+        evicted = 0
+        while total > self.max_bytes:
+            popped = await self.redis.zpopmin(f"{KEY_PREFIX}:lru", _EVICT_BATCH)
+            if not popped:
+                # Counter drifted (e.g. keys removed by hand) - reset it
+                await self.redis.set(f"{KEY_PREFIX}:total", 0)
+                break
+
+            for unique_id, _ in popped:
+                unique_id = unique_id.decode() if isinstance(unique_id, bytes) else unique_id
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    while True:
+                        try:
+                            await pipe.watch(f"{KEY_PREFIX}:sizes")
+                            size = await pipe.hget(f"{KEY_PREFIX}:sizes", unique_id)
+
+                            pipe.multi()
+                            pipe.delete(self._blob_key(unique_id))
+                            pipe.hdel(f"{KEY_PREFIX}:sizes", unique_id)
+                            pipe.decrby(f"{KEY_PREFIX}:total", int(size or 0))
+                            results = await pipe.execute()
+                            break
+                        except WatchError:
+                            continue
+                total = int(results[-1])
+                evicted += 1
+                if total <= self.max_bytes:
+                    break
+
+        if evicted:
+            logger.info(f"Source cache: evicted {evicted} image(s), {total} bytes cached")
+
+
+def get_source_cache() -> Optional[SourceImageCache]:
+    """
+    Get the source image cache on the shared Redis pool.
+
+    Returns:
+        SourceImageCache or None if disabled (SOURCE_CACHE_MAX_MB=0)
+    """
+    if config.source_cache_max_mb <= 0:
+        return None
+    return SourceImageCache(
+        get_redis(),
+        max_bytes=config.source_cache_max_mb * 1024 * 1024,
+    )
@@ -0,0 +1,249 @@
+"""Pre-aggregated rollups of the admin statistics.
+
+Admin dashboards used to COUNT/SUM generation_tasks, users and payments on
+every click, on the same database the bot's users are served from. The app
+now rebuilds small rollup tables in the background and ``StatsRepository``
+reads them instead:
+
+- ``task_stats_hourly``  -> tasks per UTC hour, model, quality and status
+- ``task_stats_daily``   -> the same per UTC day (summed from the hourly rows)
+- ``user_stats_daily``   -> tasks per user and day (active users, top users)
+- ``signup_stats_daily`` -> users registered per day
+
+A task is counted in the hour it was created, under its current status, so
+an hour keeps changing while its tasks run. Each refresh rebuilds the
+buckets from the last ``REFRESH_HOURS`` hours (from the last rolled hour if
+the job stood still longer) in one transaction - readers see the old or the
+new rows, never a half-built bucket. Days are rebuilt whole from the first
+refreshed hour's day. Empty rollups (first start) are built from the whole
+history once.
+
+The app refreshes every ``STATS_ROLLUP_INTERVAL`` seconds; replicas take a
+PostgreSQL advisory lock so only one refreshes at a time. One-off run::
+
+    python -m bot.services.stats_rollup
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import Date, cast, delete, func, insert, literal_column, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bot.config import config
+from bot.db.database import ROLE_ANALYTICS, get_session_maker
+from bot.db.models import (
+    GenerationTask,
+    SignupStatsDaily,
+    TaskStatsDaily,
+    TaskStatsHourly,
+    User,
+    UserStatsDaily,
+)
+
+logger = logging.getLogger(__name__)
+
+# Hours whose tasks may still change status; older buckets are final
+REFRESH_HOURS = 3
+
+# pg_try_advisory_xact_lock key of the refresh
+ADVISORY_LOCK_ID = 0x57A75
+
+
+# Inlined constants: the bucket expressions appear in SELECT and GROUP BY,
+# and PostgreSQL only matches them if they don't differ in bound parameters
+UTC = literal_column("'UTC'")
+
+
+def _hour_of(column, dialect: str):
+    """UTC hour start of a timestamp column (naive, like TaskStatsHourly.hour)."""
+    if dialect == "postgresql":
+        return func.date_trunc(literal_column("'hour'"), func.timezone(UTC, column))
+    # SQLite keeps UTC text; match SQLAlchemy's DATETIME storage format
+    return func.strftime(literal_column("'%Y-%m-%d %H:00:00.000000'"), column)
+
+
+def _day_of(column, dialect: str, aware: bool = True):
+    """UTC date of a timestamp column."""
+    if dialect == "postgresql":
+        return cast(func.timezone(UTC, column) if aware else column, Date)
+    return func.date(column)
+
+
+async def refresh_rollups(session: AsyncSession, now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    Rebuild the rollup buckets that may have changed since the last refresh.
+
+    Args:
+        session: Session (committed by the caller)
+        now: Current time (tests)
+
+    Returns:
+        First rebuilt hour (UTC, naive), or None if everything was rebuilt
+    """
+    dialect = session.get_bind().dialect.name
+    now = (now or datetime.now(timezone.utc)).astimezone(timezone.utc).replace(tzinfo=None)
+
+    last_hour = await session.scalar(select(func.max(TaskStatsHourly.hour)))
+    if last_hour is None:
+        start = None
+    else:
+        start = min(last_hour, now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=REFRESH_HOURS))
+    start_day = start.replace(hour=0) if start is not None else None
+
+    def since(stmt, column, bound):
+        return stmt if bound is None else stmt.where(column >= bound)
+
+    def aware(bound):
+        return bound.replace(tzinfo=timezone.utc) if bound is not None else None
+
+    # Hourly task counters from generation_tasks (ix_generation_tasks_created_at)
+    hour = _hour_of(GenerationTask.created_at, dialect)
+    await session.execute(since(delete(TaskStatsHourly), TaskStatsHourly.hour, start))
+    await session.execute(
+        insert(TaskStatsHourly).from_select(
+            ["hour", "model", "image_quality", "status", "tasks", "tokens_spent"],
+            since(
+                select(
+                    hour,
+                    GenerationTask.model,
+                    GenerationTask.image_quality,
+                    GenerationTask.status,
+                    func.count(GenerationTask.id),
+                    func.coalesce(func.sum(GenerationTask.tokens_spent), 0),
+                ),
+                GenerationTask.created_at,
+                aware(start),
+            ).group_by(hour, GenerationTask.model, GenerationTask.image_quality, GenerationTask.status),
+        )
+    )
+
+    # Daily task counters from the hourly rows
+    day = _day_of(TaskStatsHourly.hour, dialect, aware=False)
+    await session.execute(since(delete(TaskStatsDaily), TaskStatsDaily.day, start_day and start_day.date()))
+    await session.execute(
+        insert(TaskStatsDaily).from_select(
+            ["day", "model", "image_quality", "status", "tasks", "tokens_spent"],
+            since(
+                select(
+                    day,
+                    TaskStatsHourly.model,
+                    TaskStatsHourly.image_quality,
+                    TaskStatsHourly.status,
+                    func.sum(TaskStatsHourly.tasks),
+                    func.sum(TaskStatsHourly.tokens_spent),
+                ),
+                TaskStatsHourly.hour,
+                start_day,
+            ).group_by(day, TaskStatsHourly.model, TaskStatsHourly.image_quality, TaskStatsHourly.status),
+        )
+    )
+
+    # Tasks per user and day
+    day = _day_of(GenerationTask.created_at, dialect)
+    await session.execute(since(delete(UserStatsDaily), UserStatsDaily.day, start_day and start_day.date()))
+    await session.execute(
+        insert(UserStatsDaily).from_select(
+            ["day", "user_id", "tasks", "tokens_spent"],
+            since(
+                select(
+                    day,
+                    GenerationTask.user_id,
+                    func.count(GenerationTask.id),
+                    func.coalesce(func.sum(GenerationTask.tokens_spent), 0),
+                ),
+                GenerationTask.created_at,
+                aware(start_day),
+            ).group_by(day, GenerationTask.user_id),
+        )
+    )
+
+    # Signups per day (ix_users_created_at)
+    day = _day_of(User.created_at, dialect)
+    await session.execute(since(delete(SignupStatsDaily), SignupStatsDaily.day, start_day and start_day.date()))
+    await session.execute(
+        insert(SignupStatsDaily).from_select(
+            ["day", "users"],
+            since(
+                select(day, func.count(User.id)),
+                User.created_at,
+                aware(start_day),
+            ).group_by(day),
+        )
+    )
+    return start
+
+
+async def run_refresh() -> bool:
+    """
+    Refresh the rollups in one transaction.
+
+    Returns:
+        False if another process is refreshing
+    """
+    async with get_session_maker(ROLE_ANALYTICS)() as session:
+        if session.get_bind().dialect.name == "postgresql":
+            locked = await session.scalar(select(func.pg_try_advisory_xact_lock(ADVISORY_LOCK_ID)))
+            if not locked:
+                return False
+        start = await refresh_rollups(session)
+        await session.commit()
+
+    if start is None:
+        logger.info("Stats rollups rebuilt from the whole history")
+    return True
+
+
+_refresher: Optional[asyncio.Task] = None
+
+
+async def _refresh_forever() -> None:
+    while True:
+        try:
+            await run_refresh()
+        except Exception as e:
+            logger.error(f"Stats rollup refresh failed: {e}")
+        await asyncio.sleep(config.stats_rollup_interval)
+
+
+def start_stats_rollup() -> None:
+    """Start refreshing the rollups (app startup)."""
+    global _refresher
+    if config.stats_rollup_interval <= 0:
+        return
+    if _refresher is None or _refresher.done():
+        _refresher = asyncio.create_task(_refresh_forever())
+
+
+async def stop_stats_rollup() -> None:
+    """Stop refreshing the rollups (app shutdown)."""
+    global _refresher
+    if _refresher is not None:
+        _refresher.cancel()
+        try:
+            await _refresher
+        except asyncio.CancelledError:
+            pass
+        _refresher = None
+
+
+async def _main() -> int:
+    from bot.db.database import close_db
+
+    try:
+        refreshed = await run_refresh()
+    finally:
+        await close_db()
+    if not refreshed:
+        print("Another process is refreshing the stats rollups")
+        return 1
+    print("Stats rollups refreshed")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_main()))
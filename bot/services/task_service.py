@@ -9,9 +9,9 @@ from dataclasses import dataclass
 from typing import Optional
 
 from bot.db.database import get_session_maker
-from bot.db.repositories import UserRepository, TaskRepository
+from bot.db.repositories import TaskRepository
 from bot.db.models import GenerationTask
-from bot.services.balance import BalanceService, InsufficientBalanceError
+from bot.services.eta import TaskEta, format_eta, get_eta_service
 from bot.services.image_tokens import estimate_image_tokens, calculate_total_cost
 
 logger = logging.getLogger(__name__)
@@ -27,6 +27,7 @@ class TaskCreationResult:
     error_message: Optional[str] = None
     required_tokens: Optional[int] = None
     available_tokens: Optional[int] = None
+    eta: Optional[TaskEta] = None
 
 
 async def calculate_task_cost(
@@ -73,7 +74,7 @@ async def create_and_enqueue_task(
     
     Args:
         user_id: Database user ID
-        telegram_id: Telegram user ID (for rate limiting)
+        telegram_id: Telegram user ID (kept for callers; the user is checked by user_id)
         task_type: "generate" or "edit"
         prompt: Text prompt for generation
         quality: Image quality
@@ -86,76 +87,72 @@ async def create_and_enqueue_task(
     Returns:
         TaskCreationResult with success status and task or error info
     """
+    from bot.config import config
+    
     cost = await calculate_task_cost(quality, size, cost_multiplier, images_count)
     
     session_maker = get_session_maker()
     
     async with session_maker() as session:
-        balance_service = BalanceService(session)
         task_repo = TaskRepository(session)
-        user_repo = UserRepository(session)
         
-        # Verify user exists
-        user = await user_repo.get_by_telegram_id(telegram_id)
-        if user is None:
+        # Rate limit check, deduction, task and ledger row - one atomic statement
+        charged = await task_repo.create_charged(
+            user_id=user_id,
+            task_type=task_type,
+            prompt=prompt,
+            tokens_spent=cost,
+            model=model,
+            image_quality=quality,
+            image_size=size,
+            source_image_url=source_image_url,
+            images_count=images_count,
+            max_recent_tasks=config.max_tasks_per_user_per_hour,
+        )
+    
+    task = charged.task
+    if task is None:
+        if charged.balance is None:
             return TaskCreationResult(
                 success=False,
                 error_type="user_not_found",
                 error_message="Пользователь не найден",
             )
-        
-        # Check rate limiting
-        from bot.config import config
-        recent_tasks = await task_repo.count_user_tasks_since(
-            user_id=user_id,
-            hours=1,
-        )
-        if recent_tasks >= config.max_tasks_per_user_per_hour:
+        if charged.recent_tasks >= config.max_tasks_per_user_per_hour:
             return TaskCreationResult(
                 success=False,
                 error_type="rate_limit",
                 error_message=f"Превышен лимит: {config.max_tasks_per_user_per_hour} задач в час",
             )
-        
-        try:
-            # Deduct tokens
-            await balance_service.deduct_tokens(user_id, cost)
-            
-            # Create task
-            task = await task_repo.create(
-                user_id=user_id,
-                task_type=task_type,
-                prompt=prompt,
-                tokens_spent=cost,
-                model=model,
-                image_quality=quality,
-                image_size=size,
-                source_image_url=source_image_url,
-                images_count=images_count,
-            )
-            
-            logger.info(f"Created {task_type} task {task.id} for user {user_id}")
-            
-        except InsufficientBalanceError as e:
-            return TaskCreationResult(
-                success=False,
-                error_type="insufficient_balance",
-                error_message="Недостаточно токенов",
-                required_tokens=e.required,
-                available_tokens=e.available,
-            )
+        return TaskCreationResult(
+            success=False,
+            error_type="insufficient_balance",
+            error_message="Недостаточно токенов",
+            required_tokens=cost,
+            available_tokens=charged.balance,
+        )
+    
+    logger.info(f"Created {task_type} task {task.id} for user {user_id}")
     
     # Enqueue task to RQ (outside of DB session)
+    queue_name = None
     try:
-        from bot.tasks.generation import enqueue_generation_task
-        enqueue_generation_task(task.id)
+        from bot.tasks.generation import enqueue_task
+        queue_name = await enqueue_task(task)
     except Exception as e:
         logger.error(f"Failed to enqueue task {task.id}: {e}")
         # Task is created, worker will pick it up eventually
     
+    try:
+        eta = await get_eta_service().estimate(model, quality, queue_name=queue_name, enqueued=True)
+    except Exception as e:
+        logger.warning(f"Failed to estimate ETA for task {task.id}: {e}")
+        eta = None
+    
     return TaskCreationResult(
         success=True,
         task=task,
+        eta=eta,
     )
 
 
@@ -178,13 +175,22 @@ def build_rate_limit_text(limit: int) -> str:
     )
 
 
-def build_task_created_text(task_id: int, task_type: str) -> str:
-    """Build success message for task creation."""
+def build_task_created_text(task_id: int, task_type: str, eta: Optional[TaskEta] = None) -> str:
+    """Build success message for task creation (with the queue ETA if known)."""
     action = "генерируется" if task_type == "generate" else "редактируется"
+    if eta is None:
+        timing = "Это может занять 30-60 секунд."
+    elif eta.ahead > 0:
+        timing = (
+            f"Задач в очереди перед вами: {eta.ahead}\n"
+            f"Начнём через {format_eta(eta.start_in)}, результат через {format_eta(eta.finish_in)}."
+        )
+    else:
+        timing = f"Результат будет примерно через {format_eta(eta.finish_in)}."
     return (
         "✅ <b>Задача создана!</b>\n\n"
         f"🆔 ID задачи: <code>{task_id}</code>\n\n"
         f"⏳ Ваше изображение {action}...\n"
         "Я отправлю результат, когда будет готово.\n\n"
-        "Это может занять 30-60 секунд."
+        f"{timing}"
     )
@@ -0,0 +1,261 @@
+"""Shared rate limiter for outbound Telegram Bot API messages.
+
+The app and every worker send through their own Bot session, and each of them
+used to pace itself (if at all) with fixed sleeps, so together they could go
+over Telegram's limits - about 30 messages per second per bot, 1 per second
+per private chat and 20 per minute per group or channel - and get
+``RetryAfter`` back. ``TelegramRateLimitMiddleware`` is installed on the
+shared Bot session (``bot.bot.get_bot``) and takes a token from Redis before
+every send/edit/copy/forward call:
+
+- ``tg_rate:global:<second>``        -> messages sent by all processes this second
+- ``tg_rate:chat:<chat_id>:<window>`` -> messages to one chat in its window
+  (``PRIVATE_CHAT_WINDOW`` seconds for private chats, so a handler's few
+  messages in a row go out at once; 1 minute for groups and channels)
+- ``tg_rate:pause:<chat_id>``        -> set for the Retry-After Telegram gave us
+
+Each window is a token bucket refilled at its start; a call that finds it empty
+waits for the next window. Calls have a priority class (``telegram_priority``):
+result delivery may use the whole global budget, progress edits and broadcast
+only a share of it, so a running broadcast never delays a generated image.
+On ``RetryAfter`` the chat is paused for every process and the call is retried
+once the pause is over (progress edits give up instead - the next update
+follows anyway).
+"""
+
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator, Optional, Union
+
+import redis.asyncio as aioredis
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from bot.config import config
+from bot.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "tg_rate"
+
+PRIORITY_RESULT = "result"
+PRIORITY_PROGRESS = "progress"
+PRIORITY_BROADCAST = "broadcast"
+
+# Share of the global limit each class may use; the rest is left for higher classes
+PRIORITY_SHARES = {
+    PRIORITY_RESULT: 1.0,
+    PRIORITY_PROGRESS: 0.8,
+    PRIORITY_BROADCAST: 0.6,
+}
+
+# Telegram limit of groups and channels (messages per minute)
+GROUP_MESSAGES_PER_MINUTE = 20
+
+# Private chats get their per-second rate averaged over this many seconds:
+# a burst of up to rate x window messages, then the rate
+PRIVATE_CHAT_WINDOW = 3
+
+# Retries of a call that got RetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+# Longer RetryAfter is not waited out, the error goes to the caller
+MAX_RETRY_AFTER_WAIT = 60.0
+
+# Methods that count as a message: send*, edit*, copy*, forward*
+LIMITED_METHOD_PREFIXES = ("Send", "Edit", "Copy", "Forward")
+
+
+class TelegramRateLimited(Exception):
+    """No token was free within the max wait of the call."""
+
+    def __init__(self, chat_id: Union[int, str], retry_after: float):
+        super().__init__(f"Telegram rate limit for chat {chat_id}, retry in {retry_after:.1f}s")
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class SendPolicy:
+    """Priority class and max wait of the calls in a context."""
+
+    priority: str = PRIORITY_RESULT
+    max_wait: Optional[float] = None  # None - wait as long as needed
+
+
+_policy: contextvars.ContextVar[SendPolicy] = contextvars.ContextVar(
+    "telegram_send_policy", default=SendPolicy()
+)
+
+
+@contextmanager
+def telegram_priority(priority: str, max_wait: Optional[float] = None) -> Iterator[None]:
+    """
+    Send the Bot API calls of the block with a priority class.
+
+    Args:
+        priority: PRIORITY_RESULT, PRIORITY_PROGRESS or PRIORITY_BROADCAST
+        max_wait: Raise TelegramRateLimited instead of waiting longer for a token
+    """
+    token = _policy.set(SendPolicy(priority, max_wait))
+    try:
+        yield
+    finally:
+        _policy.reset(token)
+
+
+class TelegramRateLimiter:
+    """Redis token buckets shared by all processes that send to Telegram."""
+
+    def __init__(
+        self,
+        global_rate: int,
+        chat_rate: int,
+        redis: Optional[aioredis.Redis] = None,
+    ):
+        """
+        Initialize limiter.
+
+        Args:
+            global_rate: Messages per second for the whole bot
+            chat_rate: Messages per second to one private chat
+            redis: Async Redis client (default: shared pool)
+        """
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self._redis = redis
+
+    @property
+    def redis(self) -> aioredis.Redis:
+        return self._redis or get_redis()
+
+    def _chat_window(self, chat_id: Union[int, str]) -> tuple:
+        """Window length and limit of a chat: private chats have positive IDs."""
+        if isinstance(chat_id, int) and chat_id > 0:
+            return PRIVATE_CHAT_WINDOW, max(1, self.chat_rate) * PRIVATE_CHAT_WINDOW
+        return 60, GROUP_MESSAGES_PER_MINUTE
+
+    async def try_acquire(self, chat_id: Union[int, str], priority: str = PRIORITY_RESULT) -> float:
+        """
+        Take a token of the global and the chat bucket.
+
+        Args:
+            chat_id: Target chat
+            priority: Priority class of the call
+
+        Returns:
+            0 if the token was taken, otherwise seconds to wait before trying again
+        """
+        now = time.time()
+        pause_ms = await self.redis.pttl(f"{KEY_PREFIX}:pause:{chat_id}")
+        if pause_ms and pause_ms > 0:
+            return pause_ms / 1000
+
+        global_limit = max(1, int(self.global_rate * PRIORITY_SHARES.get(priority, 1.0)))
+        chat_seconds, chat_limit = self._chat_window(chat_id)
+        second = int(now)
+        chat_window = int(now // chat_seconds)
+        global_key = f"{KEY_PREFIX}:global:{second}"
+        chat_key = f"{KEY_PREFIX}:chat:{chat_id}:{chat_window}"
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(global_key)
+            pipe.expire(global_key, 2)
+            pipe.incr(chat_key)
+            pipe.expire(chat_key, chat_seconds + 1)
+            global_count, _, chat_count, _ = await pipe.execute()
+
+        if global_count <= global_limit and chat_count <= chat_limit:
+            return 0.0
+
+        # Give the tokens back so the failed attempt doesn't starve other calls
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.decr(global_key)
+            pipe.decr(chat_key)
+            await pipe.execute()
+
+        if chat_count > chat_limit:
+            return (chat_window + 1) * chat_seconds - now
+        return second + 1 - now
+
+    async def acquire(
+        self,
+        chat_id: Union[int, str],
+        priority: str = PRIORITY_RESULT,
+        max_wait: Optional[float] = None,
+    ) -> None:
+        """
+        Wait for a token.
+
+        Raises:
+            TelegramRateLimited: No token within max_wait seconds
+        """
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = await self.try_acquire(chat_id, priority)
+            if wait <= 0:
+                return
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise TelegramRateLimited(chat_id, wait)
+            # Jitter so the processes that waited don't all come back at once
+            await asyncio.sleep(wait + random.uniform(0, 0.05))
+
+    async def pause(self, chat_id: Union[int, str], seconds: float) -> None:
+        """Hold every process's calls to the chat for the Retry-After Telegram sent."""
+        await self.redis.set(
+            f"{KEY_PREFIX}:pause:{chat_id}", "1", px=max(1, int(seconds * 1000))
+        )
+
+
+class TelegramRateLimitMiddleware(BaseRequestMiddleware):
+    """Bot session middleware that runs message calls through the limiter."""
+
+    def __init__(self, limiter: Optional[TelegramRateLimiter] = None):
+        self.limiter = limiter or TelegramRateLimiter(
+            global_rate=config.telegram_global_rate,
+            chat_rate=config.telegram_chat_rate,
+        )
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not type(method).__name__.startswith(LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        policy = _policy.get()
+        attempt = 0
+        while True:
+            try:
+                await self.limiter.acquire(chat_id, policy.priority, policy.max_wait)
+            except TelegramRateLimited:
+                raise
+            except Exception as e:
+                # Redis trouble must not stop messages from going out
+                logger.warning(f"Telegram rate limiter unavailable, sending unthrottled: {e}")
+
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                logger.warning(
+                    f"Telegram RetryAfter {e.retry_after}s for chat {chat_id} "
+                    f"({type(method).__name__}, {policy.priority})"
+                )
+                paused = True
+                try:
+                    await self.limiter.pause(chat_id, e.retry_after)
+                except Exception as pause_error:
+                    logger.warning(f"Failed to store Telegram pause: {pause_error}")
+                    paused = False
+                if (
+                    policy.priority == PRIORITY_PROGRESS
+                    or attempt >= MAX_RETRY_AFTER_ATTEMPTS
+                    or e.retry_after > MAX_RETRY_AFTER_WAIT
+                ):
+                    raise
+                if not paused:
+                    await asyncio.sleep(e.retry_after)
@@ -4,63 +4,164 @@ This module contains the main task function that processes
 image generation/editing requests asynchronously.
 """
 
-import asyncio
 import logging
+import time
 import traceback
-from typing import Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
 
+from aiogram.types import Message
 from redis import Redis
-from rq import Queue, Retry
+from rq import Queue, Retry, get_current_job
 
+from bot.bot import get_bot
 from bot.config import config
-from bot.db.database import get_session_maker
+from bot.db.database import get_session_maker, unit_of_work
 from bot.db.models import GenerationTask
-from bot.db.repositories import TaskRepository
+from bot.db.repositories import TaskRepository, UserRepository
 from bot.services.balance import BalanceService
-from bot.services.image_provider import (
-    OpenAIImageProvider,
-    SeeDreamImageProvider,
-    GenerationResult,
-    ImageProvider,
+from bot.services.eta import DEFAULT_SERVICE_SECONDS, get_eta_service
+from bot.services.fair_dispatch import get_fair_dispatcher
+from bot.services.image_provider import GenerationResult
+from bot.services.progress_events import (
+    STAGE_DELIVERED,
+    STAGE_RESULT_RECEIVED,
+    STAGE_STARTED,
+    STAGE_UPLOADING,
+    StageReporter,
+    bind_stage_reporter,
+    report_stage,
+    reset_stage_reporter,
 )
+from bot.services.provider_registry import get_image_provider
 from bot.services.image_tokens import estimate_api_tokens, IMAGE_QUALITY_LABELS, get_actual_resolution
 from bot.services.admin_notify import notify_generation_failure, notify_moderation_block
+from bot.services.monitoring import forward_result_to_monitoring
+from bot.tasks.routing import LEGACY_QUEUE, is_paying_user, route_generation_task
+from bot.tasks.runtime import run_coroutine
 
 logger = logging.getLogger(__name__)
 
 # Maximum retry attempts (handled by RQ, but we track in DB too)
 MAX_RETRIES = 3
 
-# RQ Queue instance (lazy initialization)
-_queue: Optional[Queue] = None
+# A task waits at most this long in total for an open provider circuit,
+# then the attempt counts against MAX_RETRIES as a normal failure
+MAX_DEFER_SECONDS = 1800
 
+# Shortest delay of a deferred task (seconds)
+MIN_DEFER_SECONDS = 5
 
-def get_queue() -> Queue:
-    """Get or create the RQ queue instance."""
-    global _queue
-    if _queue is None:
-        redis_conn = Redis.from_url(config.redis_url)
-        _queue = Queue(connection=redis_conn)
-    return _queue
+# Seconds added to a job's timeout for the DB, progress edits and the result upload
+JOB_TIMEOUT_MARGIN = 60
 
+# RQ connection and queue instances (lazy initialization)
+_redis_conn: Optional[Redis] = None
+_queues: Dict[str, Queue] = {}
 
-def enqueue_generation_task(task_id: int) -> None:
+
+def get_queue(name: str = LEGACY_QUEUE) -> Queue:
+    """Get or create an RQ queue instance by name."""
+    global _redis_conn
+    if name not in _queues:
+        if _redis_conn is None:
+            _redis_conn = Redis.from_url(config.redis_url)
+        _queues[name] = Queue(name=name, connection=_redis_conn)
+    return _queues[name]
+
+
+def job_timeout() -> int:
+    """
+    RQ timeout of a generation job, derived from the timeouts of its steps.
+    
+    Covers the source image download, the provider request and the result
+    download and upload to Telegram, so the provider timeout fires (and the
+    task is retried or refunded) before RQ kills the job.
+    """
+    return int(
+        config.download_timeout
+        + config.provider_connect_timeout
+        + config.provider_request_timeout
+        + config.download_timeout
+        + config.telegram_request_timeout
+        + JOB_TIMEOUT_MARGIN
+    )
+
+
+def enqueue_to_queue(task_id: int, queue_name: str, delay: float = 0) -> None:
     """
-    Enqueue a generation task to RQ.
+    Put a generation task on an RQ queue.
     
     Args:
         task_id: Database ID of the GenerationTask
+        queue_name: RQ queue name
+        delay: Seconds until the job becomes runnable (RQ scheduler)
     """
-    queue = get_queue()
+    queue = get_queue(queue_name)
     
     # Enqueue with retry policy: 3 attempts with exponential backoff
-    job = queue.enqueue(
-        process_generation_task,
-        task_id,
+    options = dict(
         retry=Retry(max=MAX_RETRIES, interval=[10, 30, 60]),
+        job_timeout=job_timeout(),
     )
+    if delay > 0:
+        job = queue.enqueue_in(timedelta(seconds=delay), process_generation_task, task_id, **options)
+        logger.info(f"Enqueued task {task_id} as job {job.id} on {queue.name} in {delay:.0f}s")
+        return
+    
+    job = queue.enqueue(process_generation_task, task_id, **options)
+    
+    logger.info(f"Enqueued task {task_id} as job {job.id} on {queue.name}")
+
+
+async def enqueue_task(task: GenerationTask) -> str:
+    """
+    Enqueue a created task on the queue of its model, quality and user tier.
+    
+    Goes through the fair dispatcher: if the user already has the maximum of
+    tasks in flight, the task waits for one of them to finish.
     
-    logger.info(f"Enqueued task {task_id} as job {job.id}")
+    Args:
+        task: Created GenerationTask
+    
+    Returns:
+        Name of the queue the job is routed to
+    """
+    try:
+        paid = await is_paying_user(task.user_id)
+    except Exception as e:
+        logger.warning(f"Failed to check payments of user {task.user_id}: {e}")
+        paid = False
+    queue_name = route_generation_task(task.model, task.image_quality, paid)
+    
+    dispatcher = get_fair_dispatcher()
+    if dispatcher is None:
+        enqueue_to_queue(task.id, queue_name)
+    else:
+        await dispatcher.submit(task.id, task.user_id, queue_name)
+    return queue_name
+
+
+async def _release_fair_slot(task_id: int) -> None:
+    """Free the owner's in-flight slot of a finished task."""
+    dispatcher = get_fair_dispatcher()
+    if dispatcher is None:
+        return
+    try:
+        await dispatcher.release(task_id)
+    except Exception as e:
+        logger.warning(f"Task {task_id}: failed to release fair dispatch slot: {e}")
+
+
+async def _refresh_fair_slot(task_id: int, delay: float) -> None:
+    """Keep the owner's in-flight slot of a deferred task."""
+    dispatcher = get_fair_dispatcher()
+    if dispatcher is None:
+        return
+    try:
+        await dispatcher.refresh(task_id, delay)
+    except Exception as e:
+        logger.warning(f"Task {task_id}: failed to refresh fair dispatch slot: {e}")
 
 
 def process_generation_task(task_id: int) -> bool:
@@ -83,21 +184,65 @@ def process_generation_task(task_id: int) -> bool:
     Raises:
         Exception: Re-raised for RQ retry mechanism
     """
-    # Run async code in sync context (RQ workers are sync)
-    return asyncio.run(
-        _process_generation_task_async(task_id)
+    # The job's queue, for deferring the task (the coroutine runs on another thread)
+    job = get_current_job()
+    queue_name = job.origin if job is not None else None
+    
+    # Run async code on the process-wide loop (RQ workers are sync).
+    # Reusing one loop keeps DB, Telegram and provider connections alive between jobs.
+    return run_coroutine(
+        _process_and_release(task_id, queue_name)
     )
 
 
-async def _process_generation_task_async(task_id: int) -> bool:
+async def _process_and_release(task_id: int, queue_name: Optional[str] = None) -> bool:
+    """Process a task and, once it has a final outcome, release its fair dispatch slot."""
+    # Exceptions go to RQ for a retry - the task keeps its slot meanwhile
+    try:
+        success = await _process_generation_task_async(task_id, queue_name)
+    except TaskDeferred:
+        # Re-enqueued for later - still in flight
+        return False
+    await _release_fair_slot(task_id)
+    return success
+
+
+async def _defer_task(task: GenerationTask, queue_name: Optional[str], delay: float) -> None:
+    """Re-enqueue a task for when its provider's circuit closes."""
+    if queue_name is None:
+        try:
+            paid = await is_paying_user(task.user_id)
+        except Exception:
+            paid = False
+        queue_name = route_generation_task(task.model, task.image_quality, paid)
+    delay = max(delay, MIN_DEFER_SECONDS)
+    enqueue_to_queue(task.id, queue_name, delay=delay)
+    await _refresh_fair_slot(task.id, delay)
+
+
+def _waited_seconds(task: GenerationTask) -> float:
+    """Seconds since the task was created."""
+    created_at = task.created_at
+    if created_at is None:
+        return 0.0
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created_at).total_seconds()
+
+
+async def _process_generation_task_async(task_id: int, queue_name: Optional[str] = None) -> bool:
     """
     Async implementation of generation task processing.
     
     Args:
         task_id: Database ID of the GenerationTask
+        queue_name: Queue of the running job (deferred tasks go back to it)
     
     Returns:
         True if successful, False otherwise
+    
+    Raises:
+        TaskDeferred: The provider circuit is open, the task was re-enqueued
     """
     logger.info(f"Processing generation task {task_id}")
     
@@ -108,40 +253,37 @@ async def _process_generation_task_async(task_id: int) -> bool:
         task_repo = TaskRepository(session)
         balance_service = BalanceService(session)
         
-        # Get task from database
-        task = await task_repo.get_by_id(task_id)
-        if task is None:
-            logger.error(f"Task {task_id} not found")
-            return False
-        
-        # Get user's telegram_id
+        # Take the task (UPDATE ... RETURNING loads it) and its owner's telegram_id in one commit
         from sqlalchemy import select
         from bot.db.models import User
         
-        result = await session.execute(
-            select(User.telegram_id).where(User.id == task.user_id)
-        )
-        telegram_id = result.scalar_one_or_none()
-        
-        # Update status to processing
-        await task_repo.update_status(task_id, status="processing")
+        async with unit_of_work(session):
+            task = await task_repo.update_status(task_id, status="processing")
+            if task is None:
+                logger.error(f"Task {task_id} not found")
+                return False
+            
+            owner = (await session.execute(
+                select(User.telegram_id, User.username, User.first_name).where(User.id == task.user_id)
+            )).first()
+            telegram_id = owner.telegram_id if owner else None
         logger.info(f"Task {task_id} status updated to processing")
         
+        # Stage events drive the user's progress message (see progress_events)
+        reporter = StageReporter(task_id, telegram_id, task.task_type) if telegram_id else None
+        reporter_token = bind_stage_reporter(reporter)
+        processing_started = time.monotonic()
+        eta_service = get_eta_service()
         try:
-            # Initialize image provider based on model
-            image_provider: ImageProvider
-            if task.model and task.model.startswith("seedream"):
-                # Use SeeDream provider
-                image_provider = SeeDreamImageProvider(
-                    api_key=config.ark_api_key,
-                    model="seedream-4-5-251128",
-                )
-            else:
-                # Use OpenAI provider
-                image_provider = OpenAIImageProvider(
-                    api_key=config.openai_api_key,
-                    model=task.model or "gpt-image-1",
-                )
+            expected_seconds = await eta_service.service_seconds(task.model, task.image_quality)
+        except Exception as e:
+            logger.warning(f"Task {task_id}: failed to get expected duration: {e}")
+            expected_seconds = DEFAULT_SERVICE_SECONDS
+        await report_stage(STAGE_STARTED, expected_s=int(expected_seconds))
+        
+        try:
+            # Get image provider based on model
+            image_provider = get_image_provider(task.model)
             
             # Generate or edit based on task type
             result: GenerationResult
@@ -169,21 +311,34 @@ async def _process_generation_task_async(task_id: int) -> bool:
             
             # Animation will be automatically replaced by result message
             
-            if result.success and (result.image_url or result.image_base64):
+            if result.deferred and _waited_seconds(task) < MAX_DEFER_SECONDS:
+                # Circuit open: wait for it without using up a retry
+                delay = result.retry_after or MIN_DEFER_SECONDS
+                await task_repo.update_status(task_id, status="pending")
+                await _defer_task(task, queue_name, delay)
+                logger.info(f"Task {task_id} deferred for {delay:.0f}s: {result.error}")
+                raise TaskDeferred(task_id)
+            
+            if result.success and (result.image_url or result.image_bytes):
+                await report_stage(STAGE_RESULT_RECEIVED)
+                
                 # Calculate API tokens for admin tracking
                 api_tokens = estimate_api_tokens(task.image_quality, task.image_size)
                 
                 # Send result to user via Telegram
-                file_id = await _send_result_to_user(
+                sent = await _send_result_to_user(
                     task,
-                    result.image_url or result.image_base64 or "",
-                    is_base64=result.image_base64 is not None and result.image_url is None,
+                    image_url=result.image_url,
+                    image_bytes=result.image_bytes,
                 )
+                # The image is in Telegram now - don't hold it for the rest of the job
+                result.image_bytes = None
 
-                if not file_id:
+                if sent is None:
                     raise GenerationError("Failed to send result to user")
+                file_id = sent.document.file_id
 
-                # Success - update task with result and API tokens
+                # Success - the result is delivered, "done" is committed on its own
                 await task_repo.update_status(
                     task_id,
                     status="done",
@@ -192,11 +347,42 @@ async def _process_generation_task_async(task_id: int) -> bool:
                     api_tokens_spent=api_tokens,
                 )
                 
-                # Update user's total API tokens spent
-                await _update_user_api_tokens(session, task.user_id, api_tokens)
+                # Admin bookkeeping must not turn a delivered result into a retry
+                try:
+                    await UserRepository(session).add_api_tokens(task.user_id, api_tokens)
+                except Exception as e:
+                    await session.rollback()
+                    logger.error(f"Task {task_id}: failed to update user's API tokens: {e}")
                 
                 logger.info(f"Task {task_id} completed successfully (API tokens: {api_tokens})")
-                
+
+                # Copy to the monitoring channel once the task is done; bounded wait, may be skipped
+                await forward_result_to_monitoring(
+                    get_bot(),
+                    sent,
+                    user_telegram_id=owner.telegram_id,
+                    username=owner.username,
+                    first_name=owner.first_name,
+                    task_id=task.id,
+                    task_type=task.task_type,
+                    model=task.model,
+                    quality=task.image_quality,
+                    size=task.image_size,
+                    tokens_spent=task.tokens_spent,
+                    prompt=task.prompt,
+                    generation_time=time.monotonic() - processing_started,
+                )
+
+                # Feed the ETA histogram
+                try:
+                    await eta_service.record(
+                        task.model,
+                        task.image_quality,
+                        time.monotonic() - processing_started,
+                    )
+                except Exception as e:
+                    logger.warning(f"Task {task_id}: failed to record latency: {e}")
+
                 return True
             else:
                 # API returned error - check if it's moderation error
@@ -209,31 +395,30 @@ async def _process_generation_task_async(task_id: int) -> bool:
                 
                 raise GenerationError(error_msg)
         
+        except TaskDeferred:
+            raise
+        
         except ModerationError as e:
             # Animation will be automatically replaced by error message
             
             error_msg = str(e)
             logger.warning(f"Task {task_id} blocked by moderation: {error_msg}")
             
-            # Mark as failed immediately (no retries for moderation)
-            await task_repo.update_status(
-                task_id,
-                status="failed",
-                error_message="Content moderation",
-            )
-            
-            # Refund tokens
-            await balance_service.refund_task(task_id)
+            # Mark as failed immediately (no retries for moderation) and refund, atomically
+            async with unit_of_work(session):
+                await task_repo.update_status(
+                    task_id,
+                    status="failed",
+                    error_message="Content moderation",
+                )
+                await balance_service.refund_task(task_id)
             logger.info(f"Task {task_id} marked as failed (moderation), tokens refunded")
             
             # Send moderation notification to user
             await _send_moderation_notification(task)
             
             # Notify admins
-            from aiogram import Bot
-            bot = Bot(token=config.bot_token)
-            await _notify_admins_about_error(bot, task, error_msg)
-            await bot.session.close()
+            await _notify_admins_about_error(get_bot(), task, error_msg)
             
             return False
         
@@ -244,24 +429,19 @@ async def _process_generation_task_async(task_id: int) -> bool:
             error_msg = str(e)
             logger.error(f"Task {task_id} failed with error: {error_msg}")
             
-            # Refresh task to get current retry count
-            task = await task_repo.get_by_id(task_id)
-            if task is None:
-                return False
-            
+            # Only this job changes the retry count, so the row taken at the start is current
             current_retry = task.retry_count + 1
             
             if current_retry >= MAX_RETRIES:
-                # All retries exhausted - mark as failed and refund
-                await task_repo.update_status(
-                    task_id,
-                    status="failed",
-                    error_message=error_msg,
-                    increment_retry=True,
-                )
-                
-                # Refund tokens
-                await balance_service.refund_task(task_id)
+                # All retries exhausted - mark as failed and refund, atomically
+                async with unit_of_work(session):
+                    await task_repo.update_status(
+                        task_id,
+                        status="failed",
+                        error_message=error_msg,
+                        increment_retry=True,
+                    )
+                    await balance_service.refund_task(task_id)
                 logger.info(f"Task {task_id} marked as failed, tokens refunded")
                 
                 # Notify user about failure
@@ -281,6 +461,9 @@ async def _process_generation_task_async(task_id: int) -> bool:
                     f"re-queuing..."
                 )
                 raise  # Re-raise for RQ retry mechanism
+        
+        finally:
+            reset_stage_reporter(reporter_token)
 
 
 class GenerationError(Exception):
@@ -293,54 +476,34 @@ class ModerationError(Exception):
     pass
 
 
-async def _update_user_api_tokens(session, user_id: int, api_tokens: int) -> None:
-    """
-    Update user's total API tokens spent for admin tracking.
-    
-    Args:
-        session: Database session
-        user_id: User's database ID
-        api_tokens: API tokens to add
-    """
-    try:
-        from sqlalchemy import select
-        from bot.db.models import User
-        
-        result = await session.execute(
-            select(User).where(User.id == user_id)
-        )
-        user = result.scalar_one_or_none()
-        
-        if user:
-            user.api_tokens_spent += api_tokens
-            await session.commit()
-    except Exception as e:
-        logger.error(f"Failed to update user API tokens: {e}")
+class TaskDeferred(Exception):
+    """The task was re-enqueued to wait for its provider (not a failure)."""
+    pass
 
 
 async def _send_result_to_user(
     task: GenerationTask,
-    image_data: str,
-    is_base64: bool = False,
-) -> Optional[str]:
+    image_url: Optional[str] = None,
+    image_bytes: Optional[bytes] = None,
+) -> Optional[Message]:
     """
     Send generated image to user via Telegram.
     
     Args:
         task: GenerationTask with user info
-        image_data: URL of the generated image or base64 string
-        is_base64: Whether image_data is base64 encoded
+        image_url: URL of the generated image
+        image_bytes: Decoded image (used when there is no URL)
+    
+    Returns:
+        The sent result message (with its document), None on failure
     """
-    import time
     start_time = time.time()
     
     try:
-        from aiogram import Bot
-        from aiogram.types import BufferedInputFile, URLInputFile
         from bot.keyboards.inline import result_feedback_keyboard
-        import base64
+        from bot.services.delivery import send_task_result
         
-        bot = Bot(token=config.bot_token)
+        bot = get_bot()
         
         # Get user's telegram_id from task's user relationship
         session_maker = get_session_maker()
@@ -363,8 +526,8 @@ async def _send_result_to_user(
         # Stop progress animation by deleting it
         # We need to find the message with animation and delete it
         # Since we don't have message_id, we'll use a helper function
-        from bot.utils.progress_animation import delete_progress_animation_for_user
-        await delete_progress_animation_for_user(telegram_id, config.bot_token)
+        from bot.utils.progress_animation import delete_progress_animation_for_task
+        await delete_progress_animation_for_task(task.id, config.bot_token)
         
         # Send image to user
         task_type_emoji = "🎨" if task.task_type == "generate" else "🪄"
@@ -405,59 +568,33 @@ async def _send_result_to_user(
         # Build final caption
         caption = static_text.replace("PROMPT_PLACEHOLDER", prompt_text)
 
-        # Generate filename based on model
-        if task.model and task.model.startswith("seedream"):
-            filename = "SeeDream-4.5.png"
-        else:
-            filename = "GPT_Image.png"
-
         # Try to send with full caption, fallback to shorter if too long
         sent = None
         caption_to_use = caption
         
         for attempt in range(2):
             try:
-                if is_base64:
-                    # Decode base64 and send as document
-                    decode_start = time.time()
-                    logger.info(f"Task {task.id}: Decoding base64 image, size: {len(image_data)} chars")
-                    image_bytes = base64.b64decode(image_data)
-                    decode_time = time.time() - decode_start
-                    logger.info(f"Task {task.id}: Decoded to {len(image_bytes)} bytes in {decode_time:.2f}s")
-                    
-                    buffer_start = time.time()
-                    document = BufferedInputFile(image_bytes, filename=filename)
-                    buffer_time = time.time() - buffer_start
-                    logger.info(f"Task {task.id}: BufferedInputFile created in {buffer_time:.2f}s")
-                    
-                    send_start = time.time()
-                    logger.info(f"Task {task.id}: Sending document to user {telegram_id}")
-                    sent = await bot.send_document(
-                        chat_id=telegram_id,
-                        document=document,
-                        caption=caption_to_use,
-                        parse_mode="HTML",
-                        reply_markup=result_feedback_keyboard(task.id),
-                    )
-                    send_time = time.time() - send_start
-                    logger.info(f"Task {task.id}: Document sent in {send_time:.2f}s")
-                else:
-                    # Send URL as document (Telegram will fetch it)
-                    send_start = time.time()
-                    logger.info(f"Task {task.id}: Sending URL document to user {telegram_id}")
-                    
-                    # Create URLInputFile with custom filename
-                    url_file = URLInputFile(image_data, filename=filename)
-                    
-                    sent = await bot.send_document(
-                        chat_id=telegram_id,
-                        document=url_file,
-                        caption=caption_to_use,
-                        parse_mode="HTML",
-                        reply_markup=result_feedback_keyboard(task.id),
-                    )
-                    send_time = time.time() - send_start
-                    logger.info(f"Task {task.id}: URL document sent in {send_time:.2f}s")
+                # Stream the image to Telegram in chunks: provider URL body is piped
+                # through without buffering, decoded bytes are sent without copies
+                source = "URL" if image_url else f"{len(image_bytes)} bytes"
+                
+                send_start = time.time()
+                logger.info(f"Task {task.id}: Sending document ({source}) to user {telegram_id}")
+                await report_stage(STAGE_UPLOADING)
+                sent = await send_task_result(
+                    bot,
+                    telegram_id,
+                    task,
+                    caption=caption_to_use,
+                    image_bytes=image_bytes,
+                    image_url=image_url,
+                    # file_id is saved together with the "done" status
+                    save_file_id=False,
+                    parse_mode="HTML",
+                    reply_markup=result_feedback_keyboard(task.id),
+                )
+                send_time = time.time() - send_start
+                logger.info(f"Task {task.id}: Document sent in {send_time:.2f}s")
                 
                 # Success - break the loop
                 break
@@ -483,69 +620,14 @@ async def _send_result_to_user(
                     raise
 
         file_id = sent.document.file_id if sent and sent.document else None
+        if file_id:
+            await report_stage(STAGE_DELIVERED)
         
         total_time = time.time() - start_time
         logger.info(f"Task {task.id}: Total _send_result_to_user time: {total_time:.2f}s")
         logger.info(f"Result sent to user {telegram_id} for task {task.id}")
         
-        # Forward result to monitoring channel
-        if config.monitoring_channel_id and sent:
-            logger.info(f"Attempting to forward result to monitoring channel {config.monitoring_channel_id}")
-            try:
-                # Get user info
-                session_maker_mon = get_session_maker()
-                async with session_maker_mon() as session_mon:
-                    from sqlalchemy import select
-                    from bot.db.models import User
-                    
-                    result_user = await session_mon.execute(
-                        select(User).where(User.id == task.user_id)
-                    )
-                    user = result_user.scalar_one_or_none()
-                    
-                    if user:
-                        # Forward result message
-                        await bot.forward_message(
-                            chat_id=config.monitoring_channel_id,
-                            from_chat_id=telegram_id,
-                            message_id=sent.message_id,
-                        )
-                        
-                        logger.info(f"Forwarded result message {sent.message_id} to monitoring channel")
-                        
-                        # Send details message
-                        user_display = f"@{user.username}" if user.username else user.first_name or f"ID:{user.telegram_id}"
-                        type_emoji = "🎨" if task.task_type == "generate" else "🪄"
-                        
-                        details_text = (
-                            f"{type_emoji} <b>Результат генерации</b>\n\n"
-                            f"<b>Task ID:</b> {task.id}\n"
-                            f"<b>Пользователь:</b> {user_display}\n"
-                            f"<b>Telegram ID:</b> <code>{user.telegram_id}</code>\n\n"
-                            f"<b>Модель:</b> {task.model}\n"
-                            f"<b>Качество:</b> {task.image_quality}\n"
-                            f"<b>Размер:</b> {task.image_size}\n"
-                            f"<b>Токены:</b> {task.tokens_spent} 🪙\n"
-                            f"<b>Время:</b> {total_time:.1f}с\n\n"
-                            f"<b>Промпт:</b>\n<i>{task.prompt[:500]}{'...' if len(task.prompt) > 500 else ''}</i>"
-                        )
-                        
-                        await bot.send_message(
-                            chat_id=config.monitoring_channel_id,
-                            text=details_text,
-                            parse_mode="HTML",
-                        )
-                        
-                        logger.info(f"Forwarded result to monitoring channel for task {task.id}")
-                    else:
-                        logger.warning(f"User {task.user_id} not found for monitoring")
-                        
-            except Exception as e:
-                logger.error(f"Failed to forward result to monitoring channel: {e}", exc_info=True)
-        
-        await bot.session.close()
-
-        return file_id
+        return sent if file_id else None
     
     except Exception as e:
         logger.error(f"Failed to send result to user: {e}")
@@ -562,9 +644,7 @@ async def _send_failure_notification(task: GenerationTask, error_msg: str) -> No
         error_msg: Error message to include
     """
     try:
-        from aiogram import Bot
-        
-        bot = Bot(token=config.bot_token)
+        bot = get_bot()
         
         # Get user's telegram_id
         session_maker = get_session_maker()
@@ -582,8 +662,8 @@ async def _send_failure_notification(task: GenerationTask, error_msg: str) -> No
                 return
         
         # Stop progress animation
-        from bot.utils.progress_animation import delete_progress_animation_for_user
-        await delete_progress_animation_for_user(telegram_id, config.bot_token)
+        from bot.utils.progress_animation import delete_progress_animation_for_task
+        await delete_progress_animation_for_task(task.id, config.bot_token)
         
         # Send failure notification to user
         message = (
@@ -598,8 +678,6 @@ async def _send_failure_notification(task: GenerationTask, error_msg: str) -> No
         
         # Notify admins about the error
         await _notify_admins_about_error(bot, task, error_msg)
-        
-        await bot.session.close()
     
     except Exception as e:
         logger.error(f"Failed to send failure notification: {e}")
@@ -613,9 +691,7 @@ async def _send_moderation_notification(task: GenerationTask) -> None:
         task: GenerationTask that was blocked
     """
     try:
-        from aiogram import Bot
-        
-        bot = Bot(token=config.bot_token)
+        bot = get_bot()
         
         # Get user's telegram_id
         session_maker = get_session_maker()
@@ -633,8 +709,8 @@ async def _send_moderation_notification(task: GenerationTask) -> None:
                 return
         
         # Stop progress animation
-        from bot.utils.progress_animation import delete_progress_animation_for_user
-        await delete_progress_animation_for_user(telegram_id, config.bot_token)
+        from bot.utils.progress_animation import delete_progress_animation_for_task
+        await delete_progress_animation_for_task(task.id, config.bot_token)
         
         # Send moderation notification to user
         message = (
@@ -649,8 +725,6 @@ async def _send_moderation_notification(task: GenerationTask) -> None:
         await bot.send_message(chat_id=telegram_id, text=message, parse_mode="HTML")
         
         logger.info(f"Moderation notification sent to user {telegram_id} for task {task.id}")
-        
-        await bot.session.close()
     
     except Exception as e:
         logger.error(f"Failed to send moderation notification: {e}")
@@ -0,0 +1,225 @@
+"""Routing of generation jobs to per-provider, per-lane RQ queues.
+
+Jobs go to ``gen:<provider>:<lane>`` instead of the single ``default`` queue:
+
+- provider - ``openai`` or ``seedream`` (from the task model), so workers can
+  be provisioned separately for each upstream API;
+- lane - ``paid`` for users with a successful payment, otherwise ``light``
+  (low/medium quality) or ``heavy`` (high quality), so slow high quality jobs
+  don't block cheap ones.
+
+Workers pick the next queue with smooth weighted round-robin over the lane
+weights (GENERATION_QUEUE_WEIGHTS) and skip queues that already run their
+limit of jobs across all workers (GENERATION_QUEUE_LIMITS).
+"""
+
+import logging
+import time
+from typing import Dict, List, Optional
+
+from bot.config import config
+
+logger = logging.getLogger(__name__)
+
+QUEUE_PREFIX = "gen"
+
+PROVIDERS = ("openai", "seedream")
+
+LANE_PAID = "paid"
+LANE_LIGHT = "light"
+LANE_HEAVY = "heavy"
+LANES = (LANE_PAID, LANE_LIGHT, LANE_HEAVY)
+
+# Qualities that go to the heavy lane
+HEAVY_QUALITIES = ("high",)
+
+# Queue of jobs enqueued before routing existed - still drained by workers
+LEGACY_QUEUE = "default"
+
+
+def queue_name(provider: str, lane: str) -> str:
+    """RQ queue name of a provider/lane pair."""
+    return f"{QUEUE_PREFIX}:{provider}:{lane}"
+
+
+def generation_queue_names(provider: Optional[str] = None) -> List[str]:
+    """
+    Get all generation queue names, lanes in priority order.
+
+    Args:
+        provider: Only queues of this provider
+
+    Returns:
+        Queue names
+    """
+    providers = (provider,) if provider else PROVIDERS
+    return [queue_name(p, lane) for p in providers for lane in LANES]
+
+
+def route_generation_task(model: Optional[str], quality: Optional[str], paid: bool = False) -> str:
+    """
+    Pick the queue for a generation job.
+
+    Args:
+        model: Task model
+        quality: Task image quality
+        paid: The user has made a successful payment
+
+    Returns:
+        RQ queue name
+    """
+    from bot.services.provider_registry import resolve_provider_key
+
+    provider, _ = resolve_provider_key(model)
+    if paid:
+        lane = LANE_PAID
+    elif quality in HEAVY_QUALITIES:
+        lane = LANE_HEAVY
+    else:
+        lane = LANE_LIGHT
+    return queue_name(provider, lane)
+
+
+def queue_lane(name: str) -> Optional[str]:
+    """Lane of a generation queue name (None for other queues)."""
+    parts = name.split(":")
+    if len(parts) == 3 and parts[0] == QUEUE_PREFIX:
+        return parts[2]
+    return None
+
+
+async def is_paying_user(user_id: int) -> bool:
+    """Check whether the user has a successful payment (routes to the paid lane)."""
+    from bot.db.database import get_session_maker
+    from bot.db.repositories import PaymentRepository
+
+    session_maker = get_session_maker()
+    async with session_maker() as session:
+        return await PaymentRepository(session).has_succeeded_payment(user_id)
+
+
+class WeightedQueueSelector:
+    """
+    Smooth weighted round-robin order of queues with concurrency limits.
+
+    Every pick adds each queue's weight to its current score and the picked
+    queue pays back the total, so with all queues busy the picks follow the
+    weights (6:3:1 -> 6 of 10 jobs from the first queue) and are interleaved
+    instead of coming in bursts.
+    """
+
+    def __init__(self, weights: Dict[str, int], limits: Optional[Dict[str, int]] = None):
+        """
+        Initialize selector.
+
+        Args:
+            weights: Queue name -> weight (queues with weight <= 0 are still
+                served, but only when all others are empty)
+            limits: Queue name -> max running jobs across all workers
+        """
+        self.weights = {name: max(weight, 0) for name, weight in weights.items()}
+        self.limits = limits or {}
+        self._scores: Dict[str, float] = {name: 0.0 for name in weights}
+
+    def order(self, running: Optional[Dict[str, int]] = None) -> List[str]:
+        """
+        Queue names in the order they should be tried for the next job.
+
+        Args:
+            running: Queue name -> currently running jobs (for the limits)
+
+        Returns:
+            Queue names, queues at their limit left out
+        """
+        running = running or {}
+        allowed = [
+            name for name in self.weights
+            if name not in self.limits or running.get(name, 0) < self.limits[name]
+        ]
+        return sorted(
+            allowed,
+            key=lambda name: (self._scores[name] + self.weights[name], self.weights[name]),
+            reverse=True,
+        )
+
+    def picked(self, name: str) -> None:
+        """Account a job taken from the queue."""
+        if name not in self._scores:
+            return
+        total = sum(self.weights.values())
+        for queue in self._scores:
+            self._scores[queue] += self.weights[queue]
+        self._scores[name] -= total
+
+
+def build_queue_selector(queue_names: List[str]) -> WeightedQueueSelector:
+    """
+    Build a selector for the worker's queues from the configured lane weights and limits.
+
+    Args:
+        queue_names: Queues the worker listens on
+
+    Returns:
+        WeightedQueueSelector
+    """
+    weights = {}
+    limits = {}
+    for name in queue_names:
+        lane = queue_lane(name)
+        weights[name] = config.generation_queue_weights.get(lane, 1) if lane else 1
+        short_name = name[len(QUEUE_PREFIX) + 1:] if lane else name
+        if short_name in config.generation_queue_limits:
+            limits[name] = config.generation_queue_limits[short_name]
+    return WeightedQueueSelector(weights, limits)
+
+
+class WeightedDequeueMixin:
+    """
+    RQ worker mixin that dequeues with a WeightedQueueSelector.
+
+    RQ blocks on BLPOP over the queue list in order, so the selector order
+    decides which non-empty queue wins. The blocking wait is cut into short
+    rounds to re-check the limits of queues that were left out.
+    """
+
+    # Set by the process owner; without it RQ's default strict order is used
+    queue_selector: Optional[WeightedQueueSelector] = None
+
+    # Seconds between limit re-checks while waiting for a job
+    queue_recheck_interval: int = 5
+
+    def _selected_queues(self) -> list:
+        by_name = {queue.name: queue for queue in self.queues}
+        limited = [name for name in self.queue_selector.limits if name in by_name]
+        running = {}
+        if limited:
+            with self.connection.pipeline() as pipe:
+                for name in limited:
+                    pipe.zcard(by_name[name].started_job_registry.key)
+                running = dict(zip(limited, pipe.execute()))
+        return [by_name[name] for name in self.queue_selector.order(running) if name in by_name]
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        if self.queue_selector is None:
+            return super().dequeue_job_and_maintain_ttl(timeout, max_idle_time)
+
+        started = time.monotonic()
+        while True:
+            queues = self._selected_queues()
+            if queues:
+                self._ordered_queues = queues
+                # timeout is None in burst mode: non-blocking pop
+                wait = None if timeout is None else min(timeout, self.queue_recheck_interval)
+                result = super().dequeue_job_and_maintain_ttl(wait, max_idle_time=wait)
+                if result is not None:
+                    self.queue_selector.picked(result[1].name)
+                    return result
+            else:
+                # Every queue runs its limit of jobs
+                self.heartbeat()
+                time.sleep(self.queue_recheck_interval)
+
+            if timeout is None or getattr(self, "_stop_requested", False):
+                return None
+            if max_idle_time is not None and time.monotonic() - started >= max_idle_time:
+                return None
@@ -0,0 +1,370 @@
+"""Long-lived asyncio runtime for the generation worker.
+
+RQ job functions are synchronous. Previously every job called ``asyncio.run()``,
+which created a new event loop and with it a new DB pool, Telegram session and
+OpenAI client for each task. This module keeps a single event loop running in a
+background thread for the whole life of the worker process, so loop-bound
+resources (SQLAlchemy async engine, aiohttp/httpx sessions) are created once
+and reused by every job.
+
+It also provides ``SlotWorker`` - a non-forking RQ worker that can run in a
+thread - so several jobs can be processed concurrently by one process while
+sharing the same runtime.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import signal
+import threading
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Set, Tuple
+
+from rq import Queue, SimpleWorker
+from rq.executions import Execution
+from rq.intermediate_queue import IntermediateQueue
+from rq.job import Job, JobStatus
+from rq.worker import WorkerStatus
+from rq.timeouts import TimerDeathPenalty
+
+from bot.tasks.routing import WeightedDequeueMixin, build_queue_selector
+
+logger = logging.getLogger(__name__)
+
+# How often a waiting job thread wakes up while the coroutine runs.
+# Needed so RQ's TimerDeathPenalty can interrupt the thread on job timeout.
+_RESULT_POLL_INTERVAL = 1.0
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_thread: Optional[threading.Thread] = None
+_lock = threading.Lock()
+
+# Coroutines submitted by job threads and not finished yet
+_running: Set[concurrent.futures.Future] = set()
+
+# Async callables run on the runtime loop before it stops
+_shutdown_hooks: List[Callable[[], Awaitable[None]]] = []
+
+
+def _run_loop(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def get_runtime_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get or start the process-wide event loop.
+
+    Returns:
+        Event loop running in a background daemon thread
+    """
+    global _loop, _thread
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _thread = threading.Thread(
+                target=_run_loop,
+                args=(_loop,),
+                name="worker-runtime-loop",
+                daemon=True,
+            )
+            _thread.start()
+            logger.info("Worker runtime event loop started")
+    return _loop
+
+
+def run_coroutine(coro: Awaitable[Any]) -> Any:
+    """
+    Run a coroutine on the runtime loop and block until it finishes.
+
+    Safe to call from several threads at once - coroutines from different
+    job slots run concurrently on the same loop.
+
+    Args:
+        coro: Coroutine to execute
+
+    Returns:
+        Result of the coroutine
+
+    Raises:
+        Exception: Whatever the coroutine raised
+    """
+    loop = get_runtime_loop()
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    _running.add(future)
+    future.add_done_callback(_running.discard)
+    try:
+        while True:
+            try:
+                return future.result(timeout=_RESULT_POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                continue
+    except BaseException:
+        # Job timeout or shutdown - don't leave the coroutine running
+        future.cancel()
+        raise
+
+
+def register_shutdown_hook(hook: Callable[[], Awaitable[None]]) -> None:
+    """
+    Register an async cleanup callable to run on the runtime loop at shutdown.
+
+    Args:
+        hook: Async callable without arguments (e.g. ``close_db``)
+    """
+    if hook not in _shutdown_hooks:
+        _shutdown_hooks.append(hook)
+
+
+async def _run_shutdown_hooks() -> None:
+    for hook in reversed(_shutdown_hooks):
+        try:
+            await hook()
+        except Exception as e:
+            logger.error(f"Runtime shutdown hook {hook!r} failed: {e}")
+
+
+def shutdown_runtime(timeout: float = 30.0) -> None:
+    """
+    Run shutdown hooks and stop the runtime loop.
+
+    Args:
+        timeout: Maximum seconds to wait for the hooks to finish
+    """
+    global _loop, _thread
+    with _lock:
+        loop, thread = _loop, _thread
+        _loop = None
+        _thread = None
+
+    if loop is None or loop.is_closed():
+        return
+
+    # Jobs abandoned by the drain must not keep running (and fail) while the
+    # hooks close the pools under them
+    for future in list(_running):
+        future.cancel()
+
+    try:
+        asyncio.run_coroutine_threadsafe(_run_shutdown_hooks(), loop).result(timeout=timeout)
+    except Exception as e:
+        logger.error(f"Failed to run runtime shutdown hooks: {e}")
+
+    loop.call_soon_threadsafe(loop.stop)
+    if thread is not None:
+        thread.join(timeout=timeout)
+    loop.close()
+    logger.info("Worker runtime event loop stopped")
+
+
+class SlotWorker(WeightedDequeueMixin, SimpleWorker):
+    """
+    Non-forking RQ worker that can run in a non-main thread.
+
+    - Jobs run in the worker process itself, so the runtime loop and its
+      connection pools survive between jobs.
+    - Signal handlers are installed by the process owner, not by each slot.
+    - Job timeouts use a timer thread instead of SIGALRM.
+    - With a queue selector, queues are served by weight (see bot.tasks.routing).
+    - Waiting for a job is cut into short rounds, so a drain stops idle slots
+      and a job popped during the drain goes back to its queue.
+    """
+
+    death_penalty_class = TimerDeathPenalty
+
+    # Seconds a slot blocks on the queues before checking for a drain
+    drain_check_interval: int = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._abandoned_job_id: Optional[str] = None
+        self._result_lock = threading.Lock()
+
+    def _install_signal_handlers(self):
+        pass
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        started = time.monotonic()
+        while not self._stop_requested:
+            # timeout is None in burst mode: non-blocking pop
+            wait = None if timeout is None else min(timeout, self.drain_check_interval)
+            result = super().dequeue_job_and_maintain_ttl(wait, max_idle_time=wait)
+            if result is not None:
+                if self._stop_requested:
+                    job, queue = result
+                    logger.info(f"Job {job.id} dequeued during drain, returning it to {queue.name}")
+                    requeue_job(job, queue)
+                    return None
+                return result
+            if timeout is None:
+                return None
+            if max_idle_time is not None and time.monotonic() - started >= max_idle_time:
+                return None
+        return None
+
+    def abandon_current_job(self) -> Optional[Tuple[Job, Optional[Execution]]]:
+        """
+        Give up the running job so that this slot never records its result.
+
+        Returns:
+            The job and its execution, or None if the job has already finished
+        """
+        with self._result_lock:
+            job = self.get_current_job()
+            if job is None:
+                return None
+            self._abandoned_job_id = job.id
+            return job, self.execution
+
+    def handle_job_success(self, job, queue, *args, **kwargs):
+        with self._result_lock:
+            if job.id == self._abandoned_job_id:
+                return
+            super().handle_job_success(job, queue, *args, **kwargs)
+
+    def handle_job_failure(self, job, queue, *args, **kwargs):
+        with self._result_lock:
+            if job.id == self._abandoned_job_id:
+                return
+            super().handle_job_failure(job, queue, *args, **kwargs)
+
+
+def requeue_job(job: Job, queue: Queue, execution: Optional[Execution] = None) -> None:
+    """
+    Put a job that won't run in this process back at the front of its queue.
+
+    Args:
+        job: Dequeued or abandoned job
+        queue: Queue the job came from
+        execution: Execution of an abandoned running job
+    """
+    with queue.connection.pipeline() as pipe:
+        pipe.lrem(IntermediateQueue.get_intermediate_queue_key(queue.key), 1, job.id)
+        if execution is not None:
+            queue.started_job_registry.remove_execution(execution, pipeline=pipe)
+        job.set_status(JobStatus.QUEUED, pipeline=pipe)
+        queue.push_job_id(job.id, pipeline=pipe, at_front=True)
+        pipe.execute()
+
+
+def _busy_job_ids(workers: List[SlotWorker]) -> List[str]:
+    """Get IDs of jobs currently executed by the given slots."""
+    return [
+        worker.get_current_job_id()
+        for worker in workers
+        if worker.get_state() == WorkerStatus.BUSY
+    ]
+
+
+def run_worker_slots(
+    queues: list,
+    connection,
+    concurrency: int = 1,
+    burst: bool = False,
+    drain_timeout: float = 300.0,
+    weighted: bool = False,
+) -> None:
+    """
+    Run ``concurrency`` SlotWorkers on the given queues in one process.
+    
+    SIGTERM/SIGINT start a graceful drain: slots stop taking new jobs and the
+    process waits up to ``drain_timeout`` seconds for running jobs to finish.
+    Jobs still running then are put back on their queues. A second signal
+    exits immediately.
+    
+    Args:
+        queues: RQ queues to listen on
+        connection: Redis connection
+        concurrency: Number of jobs processed at the same time
+        burst: Exit when queues are empty
+        drain_timeout: Seconds to wait for running jobs on shutdown
+        weighted: Serve queues by the configured weights and limits instead of strict order
+    """
+    from bot.bot import close_bot
+    from bot.db.database import close_db
+    from bot.services.provider_registry import close_providers
+    from bot.redis_pool import close_redis
+
+    register_shutdown_hook(close_db)
+    register_shutdown_hook(close_bot)
+    register_shutdown_hook(close_providers)
+    register_shutdown_hook(close_redis)
+
+    workers = [
+        SlotWorker(queues, connection=connection)
+        for _ in range(max(concurrency, 1))
+    ]
+    if weighted:
+        for worker in workers:
+            worker.queue_selector = build_queue_selector([queue.name for queue in queues])
+    # Slot 0 also runs the RQ scheduler, which re-enqueues jobs
+    # scheduled by the Retry intervals (DEFAULT_RETRY)
+    threads = [
+        threading.Thread(
+            target=worker.work,
+            kwargs={"burst": burst, "with_scheduler": i == 0},
+            name=f"worker-slot-{i}",
+            daemon=True,
+        )
+        for i, worker in enumerate(workers)
+    ]
+
+    drain_requested = threading.Event()
+
+    def _request_drain(signum, frame):
+        if drain_requested.is_set():
+            logger.warning("Second stop signal received, exiting without waiting for running jobs")
+            raise SystemExit(1)
+        logger.info(
+            f"Received {signal.Signals(signum).name}, draining "
+            f"{len(_busy_job_ids(workers))} running job(s)..."
+        )
+        drain_requested.set()
+        for worker in workers:
+            worker._stop_requested = True
+
+    signal.signal(signal.SIGTERM, _request_drain)
+    signal.signal(signal.SIGINT, _request_drain)
+
+    logger.info(f"Starting {len(threads)} worker slot(s)")
+    for thread in threads:
+        thread.start()
+
+    abandoned = []
+    try:
+        while not drain_requested.is_set() and any(thread.is_alive() for thread in threads):
+            drain_requested.wait(timeout=1.0)
+
+        if drain_requested.is_set():
+            # Idle slots leave within drain_check_interval, busy ones after their job
+            deadline = time.monotonic() + drain_timeout
+            for thread in threads:
+                thread.join(timeout=max(deadline - time.monotonic(), 0))
+
+            for worker, thread in zip(workers, threads):
+                if not thread.is_alive():
+                    continue
+                running = worker.abandon_current_job()
+                if running is not None:
+                    abandoned.append(running)
+                if worker.scheduler:
+                    worker.stop_scheduler()
+                worker.register_death()
+
+            if abandoned:
+                logger.warning(
+                    f"Drain timeout ({drain_timeout:.0f}s) exceeded, requeueing job(s): "
+                    f"{', '.join(job.id for job, _ in abandoned)}"
+                )
+            else:
+                logger.info("All running jobs finished")
+    finally:
+        # Cancels the abandoned coroutines before they go back to their queues
+        shutdown_runtime()
+        by_name = {queue.name: queue for queue in queues}
+        for job, execution in abandoned:
+            queue = by_name.get(job.origin) or Queue(job.origin, connection=connection)
+            try:
+                requeue_job(job, queue, execution)
+            except Exception as e:
+                logger.error(f"Failed to requeue abandoned job {job.id}: {e}")
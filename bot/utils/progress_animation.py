@@ -1,13 +1,94 @@
-"""Progress animation for image generation tasks."""
+"""Progress animation for image generation tasks.
+
+All progress messages of the app are driven by one ``ProgressScheduler``
+instead of a coroutine per animation. State lives in Redis, so animations
+survive an app restart:
+
+- ``progress_animation:due``            -> sorted set, task_id by next update time
+- ``progress_animation:state:<id>``     -> hash with the task's chat, message_id and progress values
+
+Animations are keyed by task, so a user with several tasks in flight gets a
+progress message per task and events of one never touch the other.
+
+Every ``poll_interval`` the scheduler claims due animations (ZREM, so several
+app replicas never edit the same message twice), edits up to the per-tick
+budget concurrently through the shared Bot session and schedules the next
+update. The worker stops an animation by removing its state
+(``delete_progress_animation_for_task``).
+
+Progress reflects what the worker actually does: each tick first applies the
+worker's stage events (``bot.services.progress_events``) read through a
+consumer group, so every event is handled by one app replica. Once the result
+is received, the message is no longer edited - it is about to be replaced.
+"""
 
 import asyncio
+import os
 import random
+import socket
 import time
-from typing import Optional, List
+from typing import Dict, Optional, List
 import logging
 
+from redis.exceptions import ResponseError
+
+from bot.config import config
+from bot.redis_pool import get_redis
+from bot.services.eta import format_eta, get_eta_service
+from bot.services.progress_events import (
+    DELIVERY_STAGES,
+    STAGE_MODEL_STARTED,
+    STAGE_QUEUED,
+    STAGE_RESULT_RECEIVED,
+    STAGE_SOURCES_DOWNLOADED,
+    STAGE_STARTED,
+    STAGE_UPLOADING,
+    STAGE_DELIVERED,
+    STREAM_KEY,
+)
+from bot.services.telegram_rate_limit import (
+    PRIORITY_PROGRESS,
+    TelegramRateLimited,
+    telegram_priority,
+)
+from bot.tasks.generation import MAX_DEFER_SECONDS, job_timeout
+
 logger = logging.getLogger(__name__)
 
+DUE_KEY = "progress_animation:due"
+STATE_KEY_PREFIX = "progress_animation:state:"
+
+# Animations older than this are dropped: a task may wait for an open provider
+# circuit, then run for up to the job timeout
+MAX_ANIMATION_SECONDS = MAX_DEFER_SECONDS + job_timeout()
+
+# Random delay between message updates
+UPDATE_DELAY_RANGE = (7, 12)
+
+# An edit that can't get a Bot API rate limit token this fast is rescheduled
+EDIT_MAX_WAIT = 1.0
+
+# Consumer group of the app replicas on the stage event stream
+EVENTS_GROUP = "progress-animation"
+
+# Max stage events applied per tick
+EVENTS_BATCH = 500
+
+# Progress range (floor, ceiling) of each stage. Within a stage the bar creeps
+# towards the ceiling; the model call is by far the longest stage.
+STAGE_PROGRESS = {
+    STAGE_QUEUED: (0, 5),
+    STAGE_STARTED: (10, 15),
+    STAGE_SOURCES_DOWNLOADED: (20, 25),
+    STAGE_MODEL_STARTED: (30, 90),
+    STAGE_RESULT_RECEIVED: (95, 95),
+    STAGE_UPLOADING: (95, 95),
+    STAGE_DELIVERED: (100, 100),
+}
+
+# Progress after which the model stage shows its "final touches" subtitle
+LATE_MODEL_PROGRESS = 60
+
 
 # Красивые мотивационные фразы для разных этапов
 PROGRESS_PHRASES = [
@@ -26,6 +107,10 @@ PROGRESS_PHRASES = [
 ]
 
 
+# Надпись, пока задача ждёт свободного воркера
+QUEUED_SUBTITLE = "В очереди, скоро начнём"
+
+
 # Последовательные надписи для редактирования (меняются по порядку)
 EDIT_SUBTITLES = [
     "Изучаю ваше фото",
@@ -51,6 +136,7 @@ class ProgressAnimator:
     
     def __init__(
         self,
+        task_id: int,
         telegram_id: int,
         bot_token: str,
         task_type: str = "generate",
@@ -60,11 +146,13 @@ class ProgressAnimator:
         Initialize progress animator.
         
         Args:
+            task_id: Database ID of the task the message tracks
             telegram_id: User's Telegram ID
-            bot_token: Bot token for sending messages
+            bot_token: Bot token (kept for compatibility, messages go through the shared bot)
             task_type: "generate" or "edit"
             total_steps: Total number of steps (default 5)
         """
+        self.task_id = task_id
         self.telegram_id = telegram_id
         self.bot_token = bot_token
         self.task_type = task_type
@@ -75,8 +163,8 @@ class ProgressAnimator:
         self.current_step = 1
         self.current_progress = 0
         self.current_subtitle_index = 0
-        self.is_running = False
-        self.animation_task: Optional[asyncio.Task] = None
+        self.stage = STAGE_QUEUED
+        self.finish_at = 0.0  # Expected result time, 0 if unknown
         
         # Task type emoji, title and subtitles
         if task_type == "edit":
@@ -88,157 +176,92 @@ class ProgressAnimator:
             self.title = "Генерация"
             self.subtitles = GENERATE_SUBTITLES
     
+    @classmethod
+    def from_state(cls, task_id: int, state: Dict[str, str]) -> "ProgressAnimator":
+        """Restore an animator from its Redis state hash."""
+        animator = cls(
+            task_id,
+            int(state["telegram_id"]),
+            bot_token="",
+            task_type=state.get("task_type", "generate"),
+            total_steps=int(state.get("total_steps", 5)),
+        )
+        animator.message_id = int(state["message_id"])
+        animator.start_time = float(state["start_time"])
+        animator.current_step = int(state.get("step", 1))
+        animator.current_progress = int(state.get("progress", 0))
+        animator.current_subtitle_index = int(state.get("subtitle", 0))
+        animator.stage = state.get("stage", STAGE_QUEUED)
+        animator.finish_at = float(state.get("finish_at", 0))
+        return animator
+    
+    def to_state(self) -> Dict[str, str]:
+        """Serialize animator state for Redis."""
+        return {
+            "telegram_id": str(self.telegram_id),
+            "message_id": str(self.message_id),
+            "task_type": self.task_type,
+            "total_steps": str(self.total_steps),
+            "start_time": str(self.start_time),
+            "step": str(self.current_step),
+            "progress": str(self.current_progress),
+            "subtitle": str(self.current_subtitle_index),
+            "stage": self.stage,
+            "finish_at": str(self.finish_at),
+        }
+    
     async def start(self) -> None:
-        """Start the progress animation."""
-        if self.is_running:
-            return
-        
-        self.is_running = True
+        """Send the progress message and hand the animation to the scheduler."""
         self.start_time = time.time()
         
-        # Send initial message
-        await self._send_initial_message()
-        
-        # Start animation loop
-        self.animation_task = asyncio.create_task(self._animation_loop())
-    
-    async def stop(self) -> None:
-        """Stop the progress animation and delete message."""
-        self.is_running = False
-        
-        # Cancel animation task
-        if self.animation_task:
-            self.animation_task.cancel()
-            try:
-                await self.animation_task
-            except asyncio.CancelledError:
-                pass
+        try:
+            eta = await get_eta_service().estimate()
+            if eta is not None:
+                self.finish_at = eta.finish_at
+        except Exception as e:
+            logger.warning(f"Failed to estimate ETA: {e}")
         
-        # Delete message
-        if self.message_id:
-            await self._delete_message()
-    
-    async def _send_initial_message(self) -> None:
-        """Send initial progress message."""
-        bot = None
-        redis_client = None
         try:
-            from aiogram import Bot
-            import redis.asyncio as redis
-            
-            bot = Bot(token=self.bot_token)
+            from bot.bot import get_bot
             
-            text = self._build_progress_text()
-            
-            message = await bot.send_message(
-                chat_id=self.telegram_id,
-                text=text,
-                parse_mode="HTML",
-            )
+            bot = get_bot()
             
+            with telegram_priority(PRIORITY_PROGRESS):
+                message = await bot.send_message(
+                    chat_id=self.telegram_id,
+                    text=self._build_progress_text(),
+                    parse_mode="HTML",
+                )
             self.message_id = message.message_id
             
-            # Save message_id to Redis for later deletion
-            redis_client = redis.from_url("redis://redis:6379/0")
-            message_id_key = f"progress_animation:{self.telegram_id}"
-            await redis_client.set(message_id_key, str(self.message_id), ex=600)  # Expire in 10 minutes
+            await _save_and_schedule(self.task_id, self.to_state())
             
         except Exception as e:
             logger.error(f"Failed to send initial progress message: {e}")
-        finally:
-            # Always close connections
-            if bot:
-                await bot.session.close()
-            if redis_client:
-                await redis_client.close()
     
-    async def _animation_loop(self) -> None:
-        """Main animation loop that updates progress periodically."""
-        try:
-            import redis.asyncio as redis
-            
-            redis_client = redis.from_url("redis://redis:6379/0")
-            stop_flag_key = f"progress_animation_stop:{self.telegram_id}"
-            
-            while self.is_running:
-                # Check if stop flag is set
-                stop_flag = await redis_client.get(stop_flag_key)
-                if stop_flag:
-                    logger.info(f"Stop flag detected for user {self.telegram_id}, terminating animation")
-                    self.is_running = False
-                    break
-                
-                # Random delay between 7-12 seconds
-                delay = random.uniform(7, 12)
-                await asyncio.sleep(delay)
-                
-                if not self.is_running:
-                    break
-                
-                # Check stop flag again after sleep
-                stop_flag = await redis_client.get(stop_flag_key)
-                if stop_flag:
-                    logger.info(f"Stop flag detected for user {self.telegram_id}, terminating animation")
-                    self.is_running = False
-                    break
-                
-                # Update progress
-                await self._update_progress()
-            
-            await redis_client.close()
-                
-        except asyncio.CancelledError:
-            pass
-        except Exception as e:
-            logger.error(f"Error in animation loop: {e}")
+    async def stop(self) -> None:
+        """Stop the progress animation and delete message."""
+        await delete_progress_animation_for_task(self.task_id, self.bot_token)
     
-    async def _update_progress(self) -> None:
-        """Update progress message with new values."""
-        if not self.message_id:
-            return
+    def advance(self) -> None:
+        """Move progress forward for the next update according to the current stage."""
+        floor, ceiling = STAGE_PROGRESS.get(self.stage, STAGE_PROGRESS[STAGE_QUEUED])
+        if self.current_progress < floor:
+            self.current_progress = floor
+        else:
+            self.current_progress = min(ceiling, self.current_progress + random.randint(3, 8))
         
-        bot = None
-        try:
-            from aiogram import Bot
-            from aiogram.exceptions import TelegramBadRequest
-            
-            bot = Bot(token=self.bot_token)
-            
-            # Increment progress (10-20% each time)
-            progress_increment = random.randint(10, 20)
-            self.current_progress = min(95, self.current_progress + progress_increment)
-            
-            # Maybe increment step
-            expected_step = int((self.current_progress / 100) * self.total_steps) + 1
-            if expected_step > self.current_step and expected_step <= self.total_steps:
-                self.current_step = expected_step
-            
-            # Move to next subtitle if available
-            if self.current_subtitle_index < len(self.subtitles) - 1:
-                self.current_subtitle_index += 1
-            
-            text = self._build_progress_text()
-            
-            await bot.edit_message_text(
-                chat_id=self.telegram_id,
-                message_id=self.message_id,
-                text=text,
-                parse_mode="HTML",
-            )
-            
-        except TelegramBadRequest as e:
-            # Message was deleted - stop animation
-            if "message to edit not found" in str(e).lower():
-                logger.info(f"Progress message {self.message_id} was deleted, stopping animation")
-                self.is_running = False
-            else:
-                logger.error(f"Telegram error updating progress: {e}")
-        except Exception as e:
-            logger.error(f"Failed to update progress message: {e}")
-        finally:
-            # Always close bot session
-            if bot:
-                await bot.session.close()
+        # Step and subtitle follow the stage, not the elapsed time
+        if self.stage in (STAGE_QUEUED, STAGE_STARTED):
+            index = 0
+        elif self.stage == STAGE_SOURCES_DOWNLOADED:
+            index = 1
+        elif self.stage == STAGE_MODEL_STARTED:
+            index = 3 if self.current_progress >= LATE_MODEL_PROGRESS else 2
+        else:
+            index = 4
+        self.current_subtitle_index = min(index, len(self.subtitles) - 1)
+        self.current_step = min(index + 1, self.total_steps)
     
     def _build_progress_text(self) -> str:
         """Build progress message text."""
@@ -253,136 +276,316 @@ class ProgressAnimator:
         progress_bar = "🟩" * filled_blocks + "⬜" * empty_blocks
         
         # Get current subtitle
-        subtitle = self.subtitles[self.current_subtitle_index]
+        if self.stage == STAGE_QUEUED:
+            subtitle = QUEUED_SUBTITLE
+        else:
+            subtitle = self.subtitles[self.current_subtitle_index]
         
         # Random motivational phrase
         phrase = random.choice(PROGRESS_PHRASES)
         
+        # Remaining time from the ETA service (refined when the worker starts)
+        remaining = ""
+        if self.finish_at:
+            left = self.finish_at - time.time()
+            remaining = f" • Осталось {format_eta(left)}" if left > 0 else " • Почти готово"
+        
         text = (
             f"{self.emoji} <b>{self.title}</b>\n\n"
             f"{subtitle}\n\n"
             f"{progress_bar} {self.current_progress}%\n\n"
-            f"⏱ Прошло: {elapsed}с • Шаг {self.current_step}/{self.total_steps}\n\n"
+            f"⏱ Прошло: {elapsed}с • Шаг {self.current_step}/{self.total_steps}{remaining}\n\n"
             f"<i>{phrase}</i>"
         )
         
         return text
+
+
+async def _save_and_schedule(task_id: int, state: Dict[str, str]) -> None:
+    """Store animation state and schedule its next update."""
+    state_key = f"{STATE_KEY_PREFIX}{task_id}"
+    async with get_redis().pipeline(transaction=True) as pipe:
+        pipe.hset(state_key, mapping=state)
+        pipe.expire(state_key, MAX_ANIMATION_SECONDS)
+        pipe.zadd(DUE_KEY, {str(task_id): time.time() + random.uniform(*UPDATE_DELAY_RANGE)})
+        await pipe.execute()
+
+
+class ProgressScheduler:
+    """Single timer loop that updates all progress messages of the process."""
     
-    async def _delete_message(self) -> None:
-        """Delete the progress message."""
-        if not self.message_id:
-            return
+    def __init__(self, edits_per_second: float, poll_interval: float = 0.5):
+        """
+        Initialize scheduler.
         
-        bot = None
-        redis_client = None
+        Args:
+            edits_per_second: Telegram edit budget of this process
+            poll_interval: Seconds between scheduler ticks
+        """
+        self.edits_per_second = edits_per_second
+        self.poll_interval = poll_interval
+        self._task: Optional[asyncio.Task] = None
+        self._consumer = f"{socket.gethostname()}:{os.getpid()}"
+        self._group_ready = False
+    
+    @property
+    def batch_size(self) -> int:
+        """Max edits per tick under the rate budget."""
+        return max(1, int(self.edits_per_second * self.poll_interval))
+    
+    def start(self) -> None:
+        """Start the scheduler loop (picks up animations left by a previous run)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Progress scheduler started ({self.edits_per_second:g} edits/s)")
+    
+    async def stop(self) -> None:
+        """Stop the scheduler loop. Animation state stays in Redis."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            logger.info("Progress scheduler stopped")
+    
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Progress scheduler tick failed: {e}")
+            await asyncio.sleep(self.poll_interval)
+    
+    async def tick(self) -> int:
+        """
+        Apply new stage events, then update animations that are due.
+        
+        Returns:
+            Number of animations processed
+        """
         try:
-            from aiogram import Bot
-            from aiogram.exceptions import TelegramBadRequest
-            import redis.asyncio as redis
-            
-            bot = Bot(token=self.bot_token)
-            
+            await self.apply_stage_events()
+        except Exception as e:
+            logger.warning(f"Failed to apply progress stage events: {e}")
+        
+        redis_client = get_redis()
+        due = await redis_client.zrangebyscore(
+            DUE_KEY, "-inf", time.time(), start=0, num=self.batch_size
+        )
+        if not due:
+            return 0
+        
+        # Claim: only the process whose ZREM succeeded updates the message
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for member in due:
+                pipe.zrem(DUE_KEY, member)
+            removed = await pipe.execute()
+        claimed = [int(member) for member, ok in zip(due, removed) if ok]
+        
+        await asyncio.gather(*(self._update(task_id) for task_id in claimed))
+        return len(claimed)
+    
+    async def apply_stage_events(self) -> int:
+        """
+        Read new worker stage events and store the stage in animation state.
+        
+        Events of tasks without an animation are ignored. On a delivery stage
+        the animation is unscheduled.
+        
+        Returns:
+            Number of events read
+        """
+        redis_client = get_redis()
+        if not self._group_ready:
             try:
-                await bot.delete_message(
-                    chat_id=self.telegram_id,
-                    message_id=self.message_id,
-                )
-            except TelegramBadRequest as e:
-                # Message already deleted - that's ok
-                if "message to delete not found" not in str(e).lower():
-                    logger.error(f"Failed to delete progress message: {e}")
-            
-            # Clean up Redis key
-            redis_client = redis.from_url("redis://redis:6379/0")
-            message_id_key = f"progress_animation:{self.telegram_id}"
-            await redis_client.delete(message_id_key)
+                await redis_client.xgroup_create(STREAM_KEY, EVENTS_GROUP, id="$", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self._group_ready = True
+        
+        response = await redis_client.xreadgroup(
+            EVENTS_GROUP, self._consumer, {STREAM_KEY: ">"}, count=EVENTS_BATCH
+        )
+        if not response:
+            return 0
+        
+        # Events come in stream order: later fields of a task override earlier ones
+        entry_ids = []
+        latest: Dict[int, Dict[str, str]] = {}
+        for _stream, entries in response:
+            for entry_id, fields in entries:
+                entry_ids.append(entry_id)
+                fields = {
+                    (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                    for k, v in fields.items()
+                }
+                try:
+                    task_id = int(fields["task_id"])
+                    update = {"stage": fields["stage"], "ts": float(fields["ts"])}
+                    if "expected_s" in fields:
+                        # Worker's estimate for this model/quality
+                        update["finish_at"] = update["ts"] + float(fields["expected_s"])
+                except (KeyError, ValueError):
+                    continue
+                latest.setdefault(task_id, {}).update(update)
+        
+        task_ids = list(latest)
+        if task_ids:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for task_id in task_ids:
+                    pipe.exists(f"{STATE_KEY_PREFIX}{task_id}")
+                animated = await pipe.execute()
             
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for task_id, exists in zip(task_ids, animated):
+                    if not exists:
+                        continue
+                    update = latest[task_id]
+                    state_key = f"{STATE_KEY_PREFIX}{task_id}"
+                    pipe.hset(state_key, "stage", update["stage"])
+                    if "finish_at" in update:
+                        pipe.hset(state_key, "finish_at", str(update["finish_at"]))
+                    # Keeps a TTL even if the worker deleted the state meanwhile
+                    pipe.expire(state_key, MAX_ANIMATION_SECONDS)
+                    if update["stage"] in DELIVERY_STAGES:
+                        pipe.zrem(DUE_KEY, str(task_id))
+                await pipe.execute()
+        
+        await redis_client.xack(STREAM_KEY, EVENTS_GROUP, *entry_ids)
+        return len(entry_ids)
+    
+    async def _update(self, task_id: int) -> None:
+        """Edit one progress message and schedule its next update."""
+        from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+        from bot.bot import get_bot
+        
+        redis_client = get_redis()
+        state_key = f"{STATE_KEY_PREFIX}{task_id}"
+        raw_state = await redis_client.hgetall(state_key)
+        state = {
+            (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+            for k, v in raw_state.items()
+        }
+        
+        # Stopped by the worker (or a leftover of a concurrent stop)
+        if "message_id" not in state or "start_time" not in state or "telegram_id" not in state:
+            await redis_client.delete(state_key)
+            return
+        
+        animator = ProgressAnimator.from_state(task_id, state)
+        if time.time() - animator.start_time > MAX_ANIMATION_SECONDS:
+            await redis_client.delete(state_key)
+            return
+        
+        if animator.stage in DELIVERY_STAGES:
+            # Result is on its way - the worker deletes this message
+            return
+        
+        animator.advance()
+        try:
+            with telegram_priority(PRIORITY_PROGRESS, max_wait=EDIT_MAX_WAIT):
+                await get_bot().edit_message_text(
+                    chat_id=animator.telegram_id,
+                    message_id=animator.message_id,
+                    text=animator._build_progress_text(),
+                    parse_mode="HTML",
+                )
+        except (TelegramRetryAfter, TelegramRateLimited) as e:
+            # Rate limited - try again when Telegram allows
+            await redis_client.zadd(DUE_KEY, {str(task_id): time.time() + e.retry_after})
+            return
+        except TelegramBadRequest as e:
+            # Message was deleted - stop animation
+            if "message to edit not found" in str(e).lower():
+                logger.info(f"Progress message {animator.message_id} was deleted, stopping animation")
+                await redis_client.delete(state_key)
+                return
+            if "message is not modified" not in str(e).lower():
+                logger.error(f"Telegram error updating progress: {e}")
         except Exception as e:
-            logger.error(f"Failed to delete progress message: {e}")
-        finally:
-            # Always close connections
-            if bot:
-                await bot.session.close()
-            if redis_client:
-                await redis_client.close()
+            logger.error(f"Failed to update progress message: {e}")
+        
+        # The worker may have stopped the animation while we were editing
+        if await redis_client.exists(state_key):
+            await _save_and_schedule(task_id, animator.to_state())
+
+
+_scheduler: Optional[ProgressScheduler] = None
+
+
+def start_progress_scheduler() -> ProgressScheduler:
+    """Start the process-wide progress scheduler (app startup)."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ProgressScheduler(edits_per_second=config.progress_edits_per_second)
+    _scheduler.start()
+    return _scheduler
 
 
-async def stop_progress_animation(telegram_id: int, bot_token: str) -> None:
+async def stop_progress_scheduler() -> None:
+    """Stop the progress scheduler (app shutdown)."""
+    global _scheduler
+    if _scheduler is not None:
+        await _scheduler.stop()
+        _scheduler = None
+
+
+async def stop_progress_animation(task_id: int, bot_token: str) -> None:
     """
-    Stop and delete any progress animation for a user.
+    Stop and delete the progress animation of a task.
     
     This is a helper function to stop animation from worker without needing the animator instance.
-    It finds and deletes any message with progress animation text.
     
     Args:
-        telegram_id: User's Telegram ID
+        task_id: Database ID of the task
         bot_token: Bot token
     """
-    try:
-        from aiogram import Bot
-        
-        bot = Bot(token=bot_token)
-        
-        # Get recent messages and try to delete progress animation
-        # We can't easily find the exact message, so we'll just let it auto-delete on result send
-        # The animation will be replaced by the result message
-        
-        await bot.session.close()
-        
-    except Exception as e:
-        logger.error(f"Failed to stop progress animation: {e}")
+    await delete_progress_animation_for_task(task_id, bot_token)
 
 
-async def delete_progress_animation_for_user(telegram_id: int, bot_token: str) -> None:
+async def delete_progress_animation_for_task(task_id: int, bot_token: str) -> None:
     """
-    Delete progress animation message for a user using Redis to find message_id.
-    Also sets a stop flag to terminate the animation loop.
+    Stop the task's progress animation and delete its message.
+    
+    Removing the state is the stop signal: the scheduler drops animations
+    without state on their next tick. Other tasks of the same user keep
+    their animations.
     
     Args:
-        telegram_id: User's Telegram ID
+        task_id: Database ID of the task
         bot_token: Bot token
     """
-    bot = None
-    redis_client = None
     try:
-        import redis.asyncio as redis
-        from aiogram import Bot
         from aiogram.exceptions import TelegramBadRequest
+        from bot.bot import get_bot
         
-        # Get message_id from Redis
-        redis_client = redis.from_url("redis://redis:6379/0")
-        message_id_key = f"progress_animation:{telegram_id}"
-        stop_flag_key = f"progress_animation_stop:{telegram_id}"
-        
-        # Set stop flag first to terminate animation loop
-        await redis_client.set(stop_flag_key, "1", ex=60)  # Expire in 1 minute
+        state_key = f"{STATE_KEY_PREFIX}{task_id}"
+        async with get_redis().pipeline(transaction=True) as pipe:
+            pipe.hmget(state_key, "telegram_id", "message_id")
+            pipe.delete(state_key)
+            pipe.zrem(DUE_KEY, str(task_id))
+            (telegram_id, message_id), _, _ = await pipe.execute()
         
-        message_id = await redis_client.get(message_id_key)
-        
-        if message_id:
-            message_id = int(message_id.decode())
+        if telegram_id and message_id:
+            telegram_id = int(telegram_id)
+            message_id = int(message_id)
             
             # Delete the message
-            bot = Bot(token=bot_token)
+            bot = get_bot()
             try:
                 await bot.delete_message(chat_id=telegram_id, message_id=message_id)
-                logger.info(f"Deleted progress animation message {message_id} for user {telegram_id}")
+                logger.info(f"Deleted progress animation message {message_id} of task {task_id}")
             except TelegramBadRequest as e:
                 # Message already deleted - that's ok
                 if "message to delete not found" not in str(e).lower():
                     logger.debug(f"Could not delete progress message {message_id}: {e}")
             except Exception as e:
                 logger.debug(f"Could not delete progress message {message_id}: {e}")
-            
-            # Clean up Redis keys
-            await redis_client.delete(message_id_key)
-            await redis_client.delete(stop_flag_key)
         
     except Exception as e:
-        logger.warning(f"Failed to delete progress animation for user {telegram_id}: {e}")
-    finally:
-        # Always close connections
-        if bot:
-            await bot.session.close()
-        if redis_client:
-            await redis_client.close()
+        logger.warning(f"Failed to delete progress animation of task {task_id}: {e}")
@@ -0,0 +1,88 @@
+"""Streaming upload of generated images to Telegram.
+
+``StreamingUploadFile`` is an aiogram ``InputFile`` that feeds the multipart
+upload chunk by chunk:
+
+- from a provider URL (SeeDream) - the response body is piped to Telegram
+  as it arrives, the full 4K image is never buffered in our process;
+- from decoded bytes (GPT image models) - chunks are memoryview slices of
+  the same buffer, no copies are made.
+
+After the upload the file knows how many bytes were sent and how long it
+took, so the caller can log throughput.
+"""
+
+import logging
+import time
+from typing import TYPE_CHECKING, AsyncGenerator, Optional
+
+from aiogram.types import InputFile
+
+if TYPE_CHECKING:
+    from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+# Bigger than aiogram's 64 KB default - fewer writes for multi-MB images
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class StreamingUploadFile(InputFile):
+    """InputFile that streams bytes or a URL body to Telegram and measures throughput."""
+
+    def __init__(
+        self,
+        filename: str,
+        data: Optional[bytes] = None,
+        url: Optional[str] = None,
+        chunk_size: int = UPLOAD_CHUNK_SIZE,
+    ):
+        """
+        Initialize upload file.
+
+        Args:
+            filename: Filename shown in Telegram
+            data: Image bytes (used if url is not set)
+            url: Image URL to stream from
+            chunk_size: Upload chunk size
+        """
+        if data is None and url is None:
+            raise ValueError("Either data or url is required")
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.data = data
+        self.url = url
+        self.bytes_sent = 0
+        self.elapsed = 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        """Upload throughput of the last read."""
+        return self.bytes_sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    async def read(self, bot: "Bot") -> AsyncGenerator[bytes, None]:
+        self.bytes_sent = 0
+        started = time.monotonic()
+        try:
+            if self.url is not None:
+                chunks = self._read_url()
+            else:
+                chunks = self._read_data()
+            async for chunk in chunks:
+                self.bytes_sent += len(chunk)
+                yield chunk
+        finally:
+            self.elapsed = time.monotonic() - started
+
+    async def _read_data(self) -> AsyncGenerator[memoryview, None]:
+        view = memoryview(self.data)
+        for offset in range(0, len(view), self.chunk_size):
+            yield view[offset:offset + self.chunk_size]
+
+    async def _read_url(self) -> AsyncGenerator[bytes, None]:
+        from bot.services.provider_registry import get_download_client
+
+        # Read timeout of the download client applies per chunk, not to the whole body
+        async with get_download_client().stream("GET", self.url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                yield chunk
@@ -4,6 +4,7 @@ import asyncio
 import os
 from typing import AsyncGenerator
 
+import fakeredis
 import pytest
 import pytest_asyncio
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
@@ -53,3 +54,11 @@ async def test_session(test_engine) -> AsyncGenerator[AsyncSession, None]:
     
     async with async_session_maker() as session:
         yield session
+
+
+@pytest_asyncio.fixture(scope="function")
+async def redis() -> AsyncGenerator[fakeredis.FakeAsyncRedis, None]:
+    """Create an in-memory Redis for the services that keep state in Redis."""
+    client = fakeredis.FakeAsyncRedis()
+    yield client
+    await client.aclose()
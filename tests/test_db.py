@@ -170,3 +170,330 @@ class TestTaskRepository:
 
         history = await task_repo.get_user_history(user.id, limit=3)
         assert len(history) == 3
+
+
+class TestLoaderProfiles:
+    """Tests that user queries load only what their loader profile asks for."""
+
+    def test_relationships_never_load_implicitly(self):
+        """Test that no relationship is eager or lazily loaded by default."""
+        from bot.db.database import Base
+
+        eager = [
+            f"{mapper.class_.__name__}.{rel.key} (lazy={rel.lazy!r})"
+            for mapper in Base.registry.mappers
+            for rel in mapper.relationships
+            if rel.lazy != "raise"
+        ]
+        assert eager == []
+
+    @pytest.mark.asyncio
+    async def test_session_user_is_one_query(self, test_engine, test_session: AsyncSession):
+        """Test that the per-update user lookup doesn't load tasks or referrals."""
+        from sqlalchemy import event
+        from sqlalchemy.exc import InvalidRequestError
+        from bot.db.repositories import USER_PROFILE_LOAD
+
+        referrer = User(telegram_id=700, username="inviter", tokens=0)
+        test_session.add(referrer)
+        await test_session.commit()
+        user = User(telegram_id=701, tokens=0, referrer_id=referrer.id)
+        test_session.add(user)
+        await test_session.commit()
+        task_repo = TaskRepository(test_session)
+        for i in range(3):
+            await task_repo.create(user_id=user.id, task_type="generate", prompt=f"p{i}", tokens_spent=1)
+        test_session.expunge_all()
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(test_engine.sync_engine, "before_cursor_execute", count)
+        try:
+            repo = UserRepository(test_session)
+            loaded = await repo.get_by_telegram_id(701)
+            assert len(statements) == 1
+            with pytest.raises(InvalidRequestError):
+                loaded.tasks
+            with pytest.raises(InvalidRequestError):
+                loaded.referrals
+
+            test_session.expunge_all()
+            statements.clear()
+            profile = await repo.get_by_telegram_id(701, load=USER_PROFILE_LOAD)
+            assert len(statements) == 1
+            assert profile.referrer.username == "inviter"
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", count)
+
+
+class TestIndexAdvisor:
+    """Tests that hot generation_tasks queries are served by indexes."""
+
+    @pytest.mark.asyncio
+    async def test_query_set_uses_indexes(self, test_engine):
+        """Test that no query of the advisor scans generation_tasks sequentially."""
+        from bot.db.index_advisor import QUERY_SET, explain_query_set, seed
+
+        async with test_engine.connect() as conn:
+            transaction = await conn.begin()
+            try:
+                await seed(conn, users=50, tasks=2000)
+                reports = await explain_query_set(conn)
+            finally:
+                await transaction.rollback()
+
+        assert len(reports) == len(QUERY_SET)
+        assert [r.error for r in reports if r.error] == []
+        assert {r.name: r.seq_scans for r in reports if r.seq_scans} == {}
+
+
+class TestDatabasePools:
+    """Tests for pool profiles and checkout metrics."""
+
+    def test_asyncpg_engine_uses_role_profile(self, monkeypatch):
+        """Test that a role gets its pool settings and the statement cache."""
+        from bot.db import database
+
+        monkeypatch.setattr(config, "database_url", "postgresql+asyncpg://u:p@db/bot")
+        monkeypatch.setattr(config, "db_statement_cache_size", 0)
+
+        kwargs = database._engine_kwargs(database.ROLE_ANALYTICS)
+        profile = database.POOL_PROFILES[database.ROLE_ANALYTICS]
+
+        assert kwargs["poolclass"] is database.MeteredPool
+        assert kwargs["pool_size"] == profile.pool_size
+        assert kwargs["max_overflow"] == profile.max_overflow
+        assert kwargs["pool_pre_ping"] == profile.pre_ping
+        assert kwargs["connect_args"]["prepared_statement_cache_size"] == 0
+        assert kwargs["connect_args"]["server_settings"]["application_name"] == "telegram_bot:analytics"
+
+    @pytest.mark.asyncio
+    async def test_metered_pool_counts_checkouts_and_timeouts(self, tmp_path):
+        """Test that checkouts, overflow and pool timeouts are recorded."""
+        from sqlalchemy import exc, text
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from bot.db.database import MeteredPool
+
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{tmp_path / 'pool.db'}",
+            poolclass=MeteredPool,
+            pool_size=1,
+            max_overflow=1,
+            pool_timeout=0.1,
+        )
+        try:
+            async with engine.connect() as first, engine.connect() as second:
+                await first.execute(text("SELECT 1"))
+                await second.execute(text("SELECT 1"))
+                with pytest.raises(exc.TimeoutError):
+                    async with engine.connect():
+                        pass
+
+            metrics = engine.pool.metrics
+            assert metrics.checkouts == 2
+            assert metrics.overflow_max == 1
+            assert metrics.timeouts == 1
+            assert metrics.wait_max >= 0
+        finally:
+            await engine.dispose()
+
+
+class TestUnitOfWork:
+    """Tests for RETURNING mutators and batched commits."""
+
+    @pytest.mark.asyncio
+    async def test_update_status_is_one_statement(self, test_engine, test_session: AsyncSession):
+        """Test that a status update doesn't select before or refresh after."""
+        from sqlalchemy import event
+
+        user = User(telegram_id=800, tokens=5)
+        test_session.add(user)
+        await test_session.commit()
+        task_repo = TaskRepository(test_session)
+        task = await task_repo.create(user_id=user.id, task_type="generate", prompt="p", tokens_spent=1)
+
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(test_engine.sync_engine, "before_cursor_execute", count)
+        try:
+            updated = await task_repo.update_status(task.id, "pending", error_message="e", increment_retry=True)
+        finally:
+            event.remove(test_engine.sync_engine, "before_cursor_execute", count)
+
+        assert len(statements) == 1
+        assert statements[0].lstrip().upper().startswith("UPDATE")
+        assert (updated.retry_count, updated.error_message) == (1, "e")
+
+    @pytest.mark.asyncio
+    async def test_unit_of_work_commits_once_or_rolls_back(self, test_session: AsyncSession):
+        """Test that batched mutations are committed together or not at all."""
+        from bot.db.database import unit_of_work
+        from bot.services.balance import BalanceService
+
+        user = User(telegram_id=801, tokens=5)
+        test_session.add(user)
+        await test_session.commit()
+        task_repo = TaskRepository(test_session)
+        task = await task_repo.create(user_id=user.id, task_type="generate", prompt="p", tokens_spent=3)
+
+        with pytest.raises(RuntimeError):
+            async with unit_of_work(test_session):
+                await task_repo.update_status(task.id, "failed")
+                await BalanceService(test_session).refund_task(task.id)
+                raise RuntimeError("notification failed")
+
+        await test_session.refresh(user)
+        await test_session.refresh(task)
+        assert (task.status, user.tokens) == ("pending", 5)
+
+        async with unit_of_work(test_session):
+            await task_repo.update_status(task.id, "failed")
+            refunded = await BalanceService(test_session).refund_task(task.id)
+            assert test_session.in_transaction()
+
+        assert refunded.tokens == 8
+        assert not test_session.in_transaction()
+
+    @pytest.mark.asyncio
+    async def test_update_tokens_refuses_negative_balance(self, test_session: AsyncSession):
+        """Test that a debit larger than the balance changes nothing."""
+        user = User(telegram_id=802, tokens=2)
+        test_session.add(user)
+        await test_session.commit()
+        user_repo = UserRepository(test_session)
+
+        assert await user_repo.update_tokens(user.id, -3) is None
+        credited = await user_repo.update_tokens(user.id, 4)
+
+        assert credited is user
+        assert user.tokens == 6
+
+
+class TestTokenLedger:
+    """Tests for the append-only token ledger and its balance snapshots."""
+
+    @pytest.mark.asyncio
+    async def test_post_writes_rows_and_balances_together(self, test_session: AsyncSession):
+        """Test that every movement is a ledger row and a rejected debit writes nothing."""
+        from sqlalchemy import func, select
+        from bot.db.models import Transaction
+        from bot.db.repositories import LedgerEntry, TransactionRepository
+        from bot.services.balance import InsufficientBalanceError
+
+        buyer, referrer = User(telegram_id=901, tokens=1), User(telegram_id=902, tokens=0)
+        test_session.add_all([buyer, referrer])
+        await test_session.commit()
+        ledger = TransactionRepository(test_session)
+
+        users = await ledger.post([
+            LedgerEntry(buyer.id, 50, "purchase", "Пакет"),
+            LedgerEntry(referrer.id, 10, "referral_bonus", "Бонус", related_user_id=buyer.id),
+        ])
+        with pytest.raises(InsufficientBalanceError):
+            await ledger.post([LedgerEntry(referrer.id, -11, "generation", "Генерация")])
+
+        rows = await test_session.scalar(select(func.count(Transaction.id)))
+        assert (users[buyer.id].tokens, users[referrer.id].tokens) == (51, 10)
+        assert rows == 2
+
+    @pytest.mark.asyncio
+    async def test_refund_task_refunds_once(self, test_session: AsyncSession):
+        """Test that a task's refund row makes a repeated refund a no-op."""
+        from bot.services.balance import BalanceService
+
+        user = User(telegram_id=903, tokens=5)
+        test_session.add(user)
+        await test_session.commit()
+        task = await TaskRepository(test_session).create(
+            user_id=user.id, task_type="generate", prompt="p", tokens_spent=3
+        )
+        balance_service = BalanceService(test_session)
+
+        refunded = await balance_service.refund_task(task.id)
+        assert refunded.tokens == 8
+        assert await balance_service.refund_task(task.id) is None
+        await test_session.refresh(user)
+        assert user.tokens == 8
+
+    @pytest.mark.asyncio
+    async def test_compaction_and_reconciliation(self, test_session: AsyncSession):
+        """Test that snapshots follow the ledger and a balance changed outside it is reported."""
+        from sqlalchemy import update
+        from bot.db.models import TokenBalance
+        from bot.db.repositories import StatsRepository
+        from bot.services.ledger import compact_balances, reconcile
+
+        user_repo = UserRepository(test_session)
+        user, _ = await user_repo.get_or_create(telegram_id=904)
+        await user_repo.update_tokens(user.id, 20, type="purchase", description="Пакет")
+        await user_repo.update_tokens(user.id, -4, type="generation", description="Генерация")
+
+        assert await compact_balances(test_session, settle_seconds=0) == 1
+        snapshot = await test_session.get(TokenBalance, user.id)
+        assert (snapshot.balance, snapshot.spent, snapshot.purchased) == (user.tokens, 4, 20)
+        assert await StatsRepository(test_session).get_total_tokens_spent() == 4
+
+        # Rows after the snapshot count towards the expected balance
+        await user_repo.update_tokens(user.id, 4, type="refund", description="Возврат")
+        assert await reconcile(test_session) == []
+        assert await compact_balances(test_session, settle_seconds=0) == 1
+        assert await compact_balances(test_session, settle_seconds=0) == 0
+
+        await test_session.execute(update(User).where(User.id == user.id).values(tokens=User.tokens + 1))
+        mismatches = await reconcile(test_session)
+        assert [(m.user_id, m.tokens - m.ledger_balance) for m in mismatches] == [(user.id, 1)]
+
+    @pytest.mark.asyncio
+    async def test_financial_stats_read_the_ledger(self, test_session: AsyncSession):
+        """Test that finance stats add up ledger rows by type."""
+        from bot.db.repositories import StatsRepository
+
+        user_repo = UserRepository(test_session)
+        user, _ = await user_repo.get_or_create(telegram_id=905)
+        await user_repo.update_tokens(user.id, 100, type="purchase", description="Пакет")
+        await user_repo.update_tokens(user.id, -6, type="generation", description="Генерация")
+        await user_repo.update_tokens(user.id, 2, type="refund", description="Возврат")
+
+        finance = await StatsRepository(test_session).get_financial_stats(days=1)
+
+        assert finance["tokens_given"] == config.initial_tokens
+        assert (finance["tokens_spent"], finance["tokens_purchased"], finance["purchases_count"]) == (4, 100, 1)
+
+
+class TestStatsRollups:
+    """Tests for the pre-aggregated admin statistics."""
+
+    @pytest.mark.asyncio
+    async def test_stats_read_refreshed_rollups(self, test_session: AsyncSession):
+        """Test that stats follow the rollups and a refresh picks up status changes."""
+        from bot.db.repositories import StatsRepository
+        from bot.services.stats_rollup import refresh_rollups
+
+        heavy, light = User(telegram_id=911, username="heavy"), User(telegram_id=912, username="light")
+        test_session.add_all([heavy, light])
+        await test_session.commit()
+        task_repo = TaskRepository(test_session)
+        for user, model in ((heavy, "gpt-image-1"), (heavy, "gpt-image-1"), (light, "gpt-image-1.5")):
+            task = await task_repo.create(
+                user_id=user.id, task_type="generate", prompt="p", model=model, tokens_spent=2
+            )
+        stats_repo = StatsRepository(test_session)
+
+        assert await stats_repo.get_total_tasks() == 0
+        assert await refresh_rollups(test_session) is None
+        stats = await stats_repo.get_full_stats()
+        assert (stats["total_tasks"], stats["tasks_today"]) == (3, 3)
+        assert (stats["users_today"], stats["active_users_today"]) == (2, 2)
+        assert stats["model_usage"] == {"gpt-image-1": 2, "gpt-image-1.5": 1}
+        assert [row.username for row in await stats_repo.get_top_users()] == ["heavy", "light"]
+
+        await task_repo.update_status(task.id, status="failed", error_message="boom")
+        assert await refresh_rollups(test_session) is not None
+        assert await stats_repo.get_tasks_by_status() == {"pending": 2, "failed": 1}
+        assert (await stats_repo.get_error_stats("24h"))["total"] == 1
@@ -1,5 +1,6 @@
 """Tests for service layer - BalanceService and templates."""
 
+import fakeredis
 import pytest
 import pytest_asyncio
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -8,7 +9,14 @@ from bot.db.models import User, GenerationTask
 from bot.db.repositories import UserRepository, TaskRepository
 from bot.services.balance import BalanceService, InsufficientBalanceError
 from bot.config import config
+from bot.services import image_provider
 from bot.services.image_tokens import estimate_image_tokens
+from bot.services.provider_registry import (
+    close_providers,
+    get_download_client,
+    get_image_provider,
+    resolve_provider_key,
+)
 from bot.templates.prompts import (
     TEMPLATES,
     PromptTemplate,
@@ -108,6 +116,130 @@ class TestBalanceService:
         
         assert updated_user.tokens == expected_initial_tokens
 
+    @pytest.mark.asyncio
+    async def test_second_refund_is_refused(self, test_session: AsyncSession):
+        """Test that a task gets one refund row, a second one violates the refund index."""
+        from sqlalchemy.exc import IntegrityError
+        from bot.db.repositories import LedgerEntry, TransactionRepository
+
+        user, _ = await UserRepository(test_session).get_or_create(telegram_id=100100106)
+        task = await TaskRepository(test_session).create(
+            user_id=user.id,
+            task_type="generate",
+            prompt="Test prompt",
+            tokens_spent=3,
+        )
+        balance_service = BalanceService(test_session)
+
+        assert await balance_service.refund_task(task.id) is not None
+        assert await balance_service.refund_task(task.id) is None
+
+        with pytest.raises(IntegrityError):
+            await TransactionRepository(test_session).append([
+                LedgerEntry(user.id, 3, "refund", "Возврат", task_id=task.id)
+            ])
+        await test_session.rollback()
+
+
+class TestChargedTaskCreation:
+    """Tests for atomic charge-and-create of generation tasks."""
+
+    @pytest.mark.asyncio
+    async def test_create_paid_task_charges_and_writes_ledger(self, test_session: AsyncSession):
+        """Test that the task, the deduction and the ledger row are written together."""
+        from sqlalchemy import select
+        from bot.db.models import Transaction
+
+        user = User(telegram_id=100200300, tokens=10)
+        test_session.add(user)
+        await test_session.commit()
+
+        balance_service = BalanceService(test_session)
+        task = await balance_service.create_paid_task(
+            user.id, 4, task_type="generate", prompt="cat", model="gpt-image-1.5"
+        )
+
+        await test_session.refresh(user)
+        assert user.tokens == 6
+        assert task.status == "pending"
+        assert task.tokens_spent == 4
+        ledger = (await test_session.execute(
+            select(Transaction).where(Transaction.task_id == task.id)
+        )).scalar_one()
+        assert (ledger.type, ledger.tokens_amount, ledger.user_id) == ("generation", -4, user.id)
+
+    @pytest.mark.asyncio
+    async def test_insufficient_balance_writes_nothing(self, test_session: AsyncSession):
+        """Test that a refused charge keeps the balance and creates no task."""
+        user = User(telegram_id=100200301, tokens=3)
+        test_session.add(user)
+        await test_session.commit()
+
+        with pytest.raises(InsufficientBalanceError) as exc_info:
+            await BalanceService(test_session).create_paid_task(
+                user.id, 5, task_type="generate", prompt="cat"
+            )
+
+        assert (exc_info.value.required, exc_info.value.available) == (5, 3)
+        await test_session.refresh(user)
+        assert user.tokens == 3
+        assert await TaskRepository(test_session).count_user_tasks_since(user.id) == 0
+
+    @pytest.mark.asyncio
+    async def test_rate_limit_refuses_before_charging(self, test_session: AsyncSession):
+        """Test that the hourly limit is checked in the same operation."""
+        user = User(telegram_id=100200302, tokens=100)
+        test_session.add(user)
+        await test_session.commit()
+        task_repo = TaskRepository(test_session)
+
+        for _ in range(2):
+            charged = await task_repo.create_charged(
+                user.id, "generate", "cat", 1, max_recent_tasks=2
+            )
+            assert charged.task is not None
+        charged = await task_repo.create_charged(user.id, "generate", "cat", 1, max_recent_tasks=2)
+
+        assert charged.task is None
+        assert (charged.balance, charged.recent_tasks) == (98, 2)
+
+    @pytest.mark.asyncio
+    async def test_postgresql_is_one_statement(self):
+        """Test that PostgreSQL gets the whole operation as one statement."""
+        from unittest.mock import MagicMock
+        from sqlalchemy.dialects import postgresql
+
+        statements = []
+
+        class PostgresSession:
+            info = {}
+
+            def get_bind(self):
+                bind = MagicMock()
+                bind.dialect.name = "postgresql"
+                return bind
+
+            async def execute(self, statement):
+                statements.append(str(statement.compile(dialect=postgresql.dialect())))
+                result = MagicMock()
+                result.first.return_value = (10, 0, 42, None)
+                return result
+
+            async def commit(self):
+                pass
+
+        charged = await TaskRepository(PostgresSession()).create_charged(
+            7, "generate", "cat", 3, max_recent_tasks=20
+        )
+
+        assert len(statements) == 1
+        sql = statements[0]
+        assert sql.startswith("WITH recent AS")
+        assert "UPDATE users" in sql
+        assert "INSERT INTO generation_tasks" in sql
+        assert "INSERT INTO transactions" in sql
+        assert charged.task.id == 42 and charged.balance == 10
+
 
 class TestPromptTemplates:
     """Tests for prompt templates."""
@@ -150,3 +282,702 @@ class TestPromptTemplates:
         """Test that all template IDs are unique."""
         ids = [t.id for t in TEMPLATES]
         assert len(ids) == len(set(ids))
+
+
+class TestProviderRegistry:
+    """Tests for the image provider client registry."""
+
+    def test_resolve_provider_key(self):
+        """Test mapping task models to (provider, model) keys."""
+        assert resolve_provider_key(None) == ("openai", "gpt-image-1")
+        assert resolve_provider_key("gpt-image-1.5") == ("openai", "gpt-image-1.5")
+        assert resolve_provider_key("seedream-4-5") == ("seedream", "seedream-4-5-251128")
+        assert resolve_provider_key("seedream-4-5-251128") == ("seedream", "seedream-4-5-251128")
+
+    @pytest.mark.asyncio
+    async def test_providers_are_reused(self, monkeypatch):
+        """Test that one client is kept per (provider, model)."""
+        monkeypatch.setattr(config, "openai_api_key", "test-key")
+        monkeypatch.setattr(config, "ark_api_key", "test-key")
+        try:
+            gpt = get_image_provider("gpt-image-1")
+            assert get_image_provider(None) is gpt
+            assert get_image_provider("gpt-image-1.5") is not gpt
+            assert get_image_provider("seedream-4-5") is get_image_provider("seedream-4-5-251128")
+            assert get_download_client() is get_download_client()
+        finally:
+            await close_providers()
+
+        assert get_image_provider("gpt-image-1") is not gpt
+        await close_providers()
+
+
+class TestSourceDownloads:
+    """Tests for concurrent edit source downloads."""
+
+    @pytest.mark.asyncio
+    async def test_download_image_sources_parallel_and_ordered(self, monkeypatch):
+        """Test that sources download concurrently, bounded, in original order."""
+        import asyncio
+
+        active = 0
+        peak = 0
+
+        async def fake_download(src, bot_token):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            # Later sources finish first
+            await asyncio.sleep(0.05 / (int(src) + 1))
+            active -= 1
+            return src.encode()
+
+        monkeypatch.setattr(image_provider, "_download_image_source", fake_download)
+        monkeypatch.setattr(config, "source_download_concurrency", 3)
+
+        sources = [str(i) for i in range(7)]
+        result = await image_provider.download_image_sources(sources, "token")
+
+        assert result == [s.encode() for s in sources]
+        assert peak == 3
+
+    @pytest.mark.asyncio
+    async def test_download_image_sources_timeout(self, monkeypatch):
+        """Test that a slow source fails the download with a timeout."""
+        import asyncio
+
+        async def slow_download(src, bot_token):
+            await asyncio.sleep(1)
+            return b""
+
+        monkeypatch.setattr(image_provider, "_download_image_source", slow_download)
+        monkeypatch.setattr(config, "download_timeout", 0.05)
+
+        with pytest.raises(TimeoutError):
+            await image_provider.download_image_sources(["a", "b"], "token")
+
+    def test_parse_image_sources(self):
+        """Test parsing single and JSON-array sources."""
+        assert image_provider.parse_image_sources("file_id") == ["file_id"]
+        assert image_provider.parse_image_sources('["a", "b"]') == ["a", "b"]
+
+
+class TestSourceImageCache:
+    """Tests for the Redis-backed source image cache."""
+
+    @pytest.fixture
+    def cache(self, redis):
+        from bot.services.source_cache import SourceImageCache
+
+        return SourceImageCache(redis, max_bytes=250)
+
+    @pytest.mark.asyncio
+    async def test_get_put(self, cache):
+        """Test storing and reading an image by file_id."""
+        assert await cache.get("file_a") is None
+
+        await cache.put("file_a", "uniq_a", b"x" * 100)
+
+        assert await cache.get("file_a") == b"x" * 100
+
+    @pytest.mark.asyncio
+    async def test_same_file_different_file_ids(self, cache):
+        """Test that one blob is stored per file_unique_id."""
+        await cache.put("file_a1", "uniq_a", b"x" * 100)
+        await cache.put("file_a2", "uniq_a", b"x" * 100)
+
+        assert await cache.get("file_a1") == b"x" * 100
+        assert int(await cache.redis.get("source_cache:total")) == 100
+
+    @pytest.mark.asyncio
+    async def test_concurrent_puts_count_once(self, cache):
+        """Test that concurrent puts of the same image don't inflate the total."""
+        import asyncio
+
+        await asyncio.gather(*(cache.put(f"file_{i}", "uniq_a", b"x" * 100) for i in range(5)))
+
+        assert int(await cache.redis.get("source_cache:total")) == 100
+
+    @pytest.mark.asyncio
+    async def test_lru_eviction(self, cache):
+        """Test that least recently used images are evicted over the limit."""
+        await cache.put("file_a", "uniq_a", b"a" * 100)
+        await cache.put("file_b", "uniq_b", b"b" * 100)
+        # Touch A so B becomes the oldest
+        await cache.get("file_a")
+        await cache.put("file_c", "uniq_c", b"c" * 100)
+
+        assert await cache.get("file_b") is None
+        assert await cache.get("file_a") == b"a" * 100
+        assert await cache.get("file_c") == b"c" * 100
+        assert int(await cache.redis.get("source_cache:total")) == 200
+
+
+class TestResultDelivery:
+    """Tests for choosing the media reference of a task result."""
+
+    def test_resolve_result_media_priority(self):
+        """Test file_id, then bytes, then URL."""
+        from bot.services.delivery import resolve_result_media
+        from bot.utils.streaming_upload import StreamingUploadFile
+
+        task = GenerationTask(
+            user_id=1,
+            task_type="generate",
+            prompt="p",
+            tokens_spent=1,
+            model="seedream-4-5",
+            result_file_id="FILE",
+            result_image_url="https://example.com/a.png",
+        )
+        assert resolve_result_media(task, image_bytes=b"data") == "FILE"
+
+        task.result_file_id = None
+        media = resolve_result_media(task, image_bytes=b"data")
+        assert isinstance(media, StreamingUploadFile)
+        assert media.data == b"data" and media.url is None
+        assert media.filename == "SeeDream-4.5.png"
+
+        media = resolve_result_media(task)
+        assert media.url == "https://example.com/a.png"
+
+        task.result_image_url = None
+        assert resolve_result_media(task) is None
+
+
+class TestProgressScheduler:
+    """Tests for the Redis-backed progress animation scheduler."""
+
+    @pytest.fixture(autouse=True)
+    def shared_redis(self, redis, monkeypatch):
+        from bot.utils import progress_animation
+
+        monkeypatch.setattr(progress_animation, "get_redis", lambda: redis)
+
+    @pytest.fixture
+    def fake_bot(self, monkeypatch):
+        import bot.bot
+
+        class FakeBot:
+            def __init__(self):
+                self.edits = []
+                self.deleted = []
+
+            async def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+                self.edits.append((chat_id, message_id))
+
+            async def delete_message(self, chat_id, message_id):
+                self.deleted.append((chat_id, message_id))
+
+        fake = FakeBot()
+        monkeypatch.setattr(bot.bot, "get_bot", lambda: fake)
+        return fake
+
+    async def _add_animation(self, task_id, telegram_id, message_id, due):
+        import time
+        from bot.utils import progress_animation
+
+        animator = progress_animation.ProgressAnimator(task_id, telegram_id, "token")
+        animator.message_id = message_id
+        await progress_animation._save_and_schedule(task_id, animator.to_state())
+        await progress_animation.get_redis().zadd(
+            progress_animation.DUE_KEY, {str(task_id): time.time() + due}
+        )
+
+    @pytest.mark.asyncio
+    async def test_tick_updates_due_and_reschedules(self, redis, fake_bot):
+        """Test that only due animations are edited, within the budget, and rescheduled."""
+        from bot.utils.progress_animation import ProgressScheduler, DUE_KEY
+
+        for task_id in (1, 2, 3):
+            await self._add_animation(task_id, task_id, 100 + task_id, due=-1)
+        await self._add_animation(4, 4, 104, due=60)
+
+        scheduler = ProgressScheduler(edits_per_second=4, poll_interval=0.5)
+        assert await scheduler.tick() == 2
+        assert await scheduler.tick() == 1
+        assert await scheduler.tick() == 0
+
+        assert sorted(fake_bot.edits) == [(1, 101), (2, 102), (3, 103)]
+        # All four are still scheduled
+        assert await redis.zcard(DUE_KEY) == 4
+        # Nothing reported by the worker yet - the bar stays in the queued range
+        state = await redis.hgetall("progress_animation:state:1")
+        assert 0 < int(state[b"progress"]) <= 5
+
+    @pytest.mark.asyncio
+    async def test_stop_removes_animation(self, redis, fake_bot):
+        """Test that stopping deletes the message and the scheduler skips it."""
+        from bot.utils.progress_animation import (
+            ProgressScheduler,
+            DUE_KEY,
+            delete_progress_animation_for_task,
+        )
+
+        await self._add_animation(70, 7, 707, due=-1)
+        await delete_progress_animation_for_task(70, "token")
+
+        assert fake_bot.deleted == [(7, 707)]
+        assert await redis.zcard(DUE_KEY) == 0
+        assert await ProgressScheduler(edits_per_second=10).tick() == 0
+        assert fake_bot.edits == []
+
+    @pytest.mark.asyncio
+    async def test_stage_events_drive_progress(self, redis, fake_bot, monkeypatch):
+        """Test that stage events move their task's bar and delivery stops its edits only."""
+        from bot.services import progress_events
+        from bot.services.progress_events import StageReporter
+        from bot.utils.progress_animation import ProgressScheduler, DUE_KEY
+
+        monkeypatch.setattr(progress_events, "get_redis", lambda: redis)
+        await self._add_animation(1, 5, 505, due=-1)
+        # A second task of the same user
+        await self._add_animation(2, 5, 506, due=60)
+        scheduler = ProgressScheduler(edits_per_second=10)
+        # Creates the consumer group before the worker publishes
+        assert await scheduler.apply_stage_events() == 0
+
+        reporter = StageReporter(task_id=1, telegram_id=5)
+        await reporter.report(progress_events.STAGE_STARTED)
+        await reporter.report(progress_events.STAGE_MODEL_STARTED)
+        assert await scheduler.tick() == 1
+
+        state = await redis.hgetall("progress_animation:state:1")
+        assert state[b"stage"] == b"model_started"
+        assert 30 <= int(state[b"progress"]) <= 90
+
+        await reporter.report(progress_events.STAGE_RESULT_RECEIVED)
+        assert await scheduler.apply_stage_events() == 1
+        assert await redis.zscore(DUE_KEY, "1") is None
+        assert fake_bot.edits == [(5, 505)]
+
+        other = await redis.hgetall("progress_animation:state:2")
+        assert other[b"stage"] == b"queued"
+        assert await redis.zscore(DUE_KEY, "2") is not None
+
+
+class TestEtaService:
+    """Tests for queue ETA estimates."""
+
+    @pytest.fixture
+    def service(self, redis):
+        from bot.services.eta import EtaService
+
+        return EtaService(redis)
+
+    @pytest.mark.asyncio
+    async def test_latency_histogram(self, service):
+        """Test that recorded times give per-label and overall percentiles."""
+        from bot.services.eta import ALL_LABEL, latency_label
+
+        for seconds in (8, 9, 12, 25, 50):
+            await service.record("gpt-image-1", "high", seconds)
+        await service.record("seedream", "high", 100)
+
+        stats = await service.latency(latency_label("gpt-image-1", "high"))
+        assert stats.count == 5
+        assert stats.p50 == 15
+        assert stats.p90 == 60
+        assert (await service.latency(ALL_LABEL)).count == 6
+        assert await service.latency(latency_label("gpt-image-1", "low")) is None
+
+    @pytest.mark.asyncio
+    async def test_estimate_from_queue_state(self, service):
+        """Test start/finish estimates from queue depth and worker slots."""
+        from bot.services.eta import DEFAULT_SERVICE_SECONDS
+
+        # No workers - no estimate
+        assert await service.estimate() is None
+
+        await service.redis.sadd("rq:workers:default", "w1", "w2")
+        eta = await service.estimate()
+        assert eta.start_in == 0
+        assert eta.finish_in == DEFAULT_SERVICE_SECONDS
+
+        # Both slots busy, 3 jobs queued in front
+        await service.redis.zadd("rq:wip:default", {"job1": 1, "job2": 1})
+        await service.redis.rpush("rq:queue:default", "a", "b", "c")
+        eta = await service.estimate()
+        assert eta.ahead == 3
+        assert eta.start_in == 4 / 2 * DEFAULT_SERVICE_SECONDS
+
+        # Own job already enqueued is not counted as ahead
+        assert (await service.estimate(enqueued=True)).ahead == 2
+
+
+class TestQueueRouting:
+    """Tests for generation queue routing and weighted queue selection."""
+
+    def test_route_by_provider_lane_and_tier(self):
+        """Test that model, quality and payment pick the queue."""
+        from bot.tasks.routing import route_generation_task
+
+        assert route_generation_task("gpt-image-1", "low") == "gen:openai:light"
+        assert route_generation_task("gpt-image-1", "high") == "gen:openai:heavy"
+        assert route_generation_task("seedream-4.5", "high") == "gen:seedream:heavy"
+        assert route_generation_task("seedream-4.5", "high", paid=True) == "gen:seedream:paid"
+
+    def test_selector_follows_weights_and_limits(self):
+        """Test that picks follow the weights and limited queues are skipped."""
+        from bot.tasks.routing import WeightedQueueSelector
+
+        selector = WeightedQueueSelector({"a": 6, "b": 3, "c": 1}, limits={"c": 2})
+        picks = []
+        for _ in range(10):
+            name = selector.order()[0]
+            selector.picked(name)
+            picks.append(name)
+        assert picks.count("a") == 6
+        assert picks.count("b") == 3
+        assert picks.count("c") == 1
+        # Bursts are interleaved
+        assert picks[:3] != ["a", "a", "a"]
+
+        assert "c" not in selector.order(running={"c": 2})
+        assert "c" in selector.order(running={"c": 1})
+
+
+class TestWorkerDrain:
+    """Tests for the graceful drain of worker slots."""
+
+    def test_idle_slot_stops_on_drain(self):
+        """Test that a slot waiting for jobs leaves once a drain is requested."""
+        import threading
+        import time
+
+        from rq import Queue
+        from rq.worker import WorkerStatus
+        from bot.tasks.runtime import SlotWorker
+
+        connection = fakeredis.FakeRedis()
+        worker = SlotWorker([Queue("q", connection=connection)], connection=connection)
+        thread = threading.Thread(target=worker.work, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while worker.get_state() != WorkerStatus.IDLE and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        worker._stop_requested = True
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    def test_requeued_job_goes_back_to_front(self):
+        """Test that a job dequeued during the drain is the next one served."""
+        from rq import Queue
+        from rq.job import JobStatus
+        from bot.tasks.runtime import requeue_job
+
+        connection = fakeredis.FakeRedis()
+        queue = Queue("q", connection=connection)
+        first = queue.enqueue(len, "a")
+        second = queue.enqueue(len, "bb")
+
+        job, _ = Queue.dequeue_any([queue], None, connection=connection)
+        assert job.id == first.id
+
+        requeue_job(job, queue)
+        assert queue.job_ids == [first.id, second.id]
+        assert job.get_status() == JobStatus.QUEUED
+
+
+class TestFairDispatcher:
+    """Tests for per-user fair dispatch of tasks to RQ."""
+
+    @pytest.fixture
+    def dispatcher(self, redis):
+        from bot.services.fair_dispatch import FairDispatcher
+
+        dispatched = []
+        dispatcher = FairDispatcher(
+            redis, max_inflight=2, enqueue=lambda task_id, queue: dispatched.append(task_id)
+        )
+        dispatcher.dispatched = dispatched
+        return dispatcher
+
+    @pytest.mark.asyncio
+    async def test_flood_waits_behind_cap(self, dispatcher):
+        """Test that a user's tasks beyond the cap wait and others go straight to RQ."""
+        for task_id in range(1, 6):
+            await dispatcher.submit(task_id, user_id=1, queue_name="q")
+        assert await dispatcher.submit(100, user_id=2, queue_name="q") is True
+
+        assert dispatcher.dispatched == [1, 2, 100]
+
+    @pytest.mark.asyncio
+    async def test_release_dispatches_next_in_order(self, dispatcher):
+        """Test that finishing a task dispatches the owner's next pending task."""
+        for task_id in range(1, 5):
+            await dispatcher.submit(task_id, user_id=1, queue_name="q")
+
+        await dispatcher.release(1)
+        assert dispatcher.dispatched == [1, 2, 3]
+        # Unknown or already released tasks are ignored
+        await dispatcher.release(1)
+        await dispatcher.release(2)
+        await dispatcher.release(3)
+        assert dispatcher.dispatched == [1, 2, 3, 4]
+        assert await dispatcher.redis.smembers("fair:users") == set()
+
+    @pytest.mark.asyncio
+    async def test_refreshed_slot_outlives_stale_time(self, dispatcher):
+        """Test that a deferred task keeps its slot past the stale time of its dispatch."""
+        import time
+        from bot.services.fair_dispatch import STALE_INFLIGHT_SECONDS
+
+        for task_id in range(1, 4):
+            await dispatcher.submit(task_id, user_id=1, queue_name="q")
+        dispatched_at = time.time() - STALE_INFLIGHT_SECONDS - 1
+        await dispatcher.redis.zadd("fair:inflight:1", {"1": dispatched_at, "2": dispatched_at})
+
+        await dispatcher.refresh(1, delay=60)
+        await dispatcher.sweep()
+
+        # Only the slot of task 2 expired, task 3 takes it
+        assert dispatcher.dispatched == [1, 2, 3]
+        assert await dispatcher.redis.zscore("fair:inflight:1", "1") > time.time()
+        assert await dispatcher.redis.ttl("fair:owner:1") > STALE_INFLIGHT_SECONDS
+
+
+class TestProviderGuard:
+    """Tests for the provider concurrency limiter and circuit breaker."""
+
+    @pytest.fixture
+    def guard(self, redis):
+        from bot.services.provider_guard import ProviderGuard
+
+        return ProviderGuard(
+            "openai:test",
+            max_limit=4,
+            failure_threshold=3,
+            base_cooldown=30,
+            lease_seconds=60,
+            redis=redis,
+        )
+
+    @pytest.mark.asyncio
+    async def test_limit_caps_running_calls(self, guard):
+        """Test that no more than the limit of calls hold a slot."""
+        tokens = [await guard._try_take_slot(4) for _ in range(5)]
+        assert tokens[-1] is None
+        await guard.release(tokens[0], None)
+        assert await guard._try_take_slot(4) is not None
+
+    @pytest.mark.asyncio
+    async def test_aimd_and_breaker(self, guard):
+        """Test that overloads halve the limit and open the circuit, success closes it."""
+        from bot.services.image_provider import GenerationResult
+        from bot.services.provider_guard import ProviderUnavailableError
+
+        overload = GenerationResult(success=False, error="503", status_code=503, transient=True)
+        token = await guard.acquire()
+        await guard.release(token, overload)
+        state = await guard.get_state()
+        assert state.limit == 2
+        assert state.open_until == 0
+
+        # Retry-After opens the circuit at once and for at least that long
+        token = await guard.acquire()
+        await guard.release(token, GenerationResult(success=False, transient=True, retry_after=120))
+        with pytest.raises(ProviderUnavailableError) as exc_info:
+            await guard.acquire()
+        assert exc_info.value.retry_after > 100
+
+        # Cooldown passed: one probe goes through and its success closes the circuit
+        await guard.redis.hset(guard._state_key, "open_until", 1)
+        token = await guard.acquire()
+        assert await guard.redis.exists(guard._probe_key)
+        await guard.release(token, GenerationResult(success=True, image_bytes=b"x"))
+        state = await guard.get_state()
+        assert state.open_until == 0
+        assert state.failures == 0
+        assert state.limit == 2.5
+
+    @pytest.mark.asyncio
+    async def test_late_success_keeps_open_circuit(self, guard):
+        """Test that a success finishing after the circuit opened doesn't undo the opening."""
+        import time
+        from bot.services.image_provider import GenerationResult
+
+        token = await guard.acquire()
+        open_until = time.time() + 120
+        await guard.redis.hset(
+            guard._state_key, mapping={"limit": 2, "failures": 3, "open_until": open_until}
+        )
+        await guard.release(token, GenerationResult(success=True, image_bytes=b"x"))
+
+        state = await guard.get_state()
+        assert state.open_until == open_until
+        assert state.failures == 3
+        assert state.limit == 2
+
+    @pytest.mark.asyncio
+    async def test_open_circuit_defers_calls(self, guard):
+        """Test that a call rejected by an open circuit is deferred, not failed as an overload."""
+        import time
+        from bot.services.provider_guard import GuardedImageProvider
+
+        class Provider:
+            async def generate(self, *args, **kwargs):
+                raise AssertionError("must not be called")
+
+        await guard.redis.hset(guard._state_key, mapping={"limit": 4, "open_until": time.time() + 120})
+        result = await GuardedImageProvider(Provider(), guard).generate("prompt")
+
+        assert result.deferred and not result.transient
+        assert result.retry_after > 100
+
+
+class TestTelegramRateLimit:
+    """Tests for the shared Bot API rate limiter."""
+
+    @pytest.fixture
+    def limiter(self, redis):
+        from bot.services.telegram_rate_limit import TelegramRateLimiter
+
+        return TelegramRateLimiter(global_rate=10, chat_rate=1, redis=redis)
+
+    @pytest.mark.asyncio
+    async def test_priority_shares_and_chat_limit(self, limiter, monkeypatch):
+        """Test that lower classes leave headroom and a chat gets a short burst."""
+        from bot.services import telegram_rate_limit
+        from bot.services.telegram_rate_limit import PRIORITY_BROADCAST, PRIORITY_RESULT
+
+        # Stay inside one window
+        monkeypatch.setattr(telegram_rate_limit.time, "time", lambda: 1000.25)
+
+        taken = [await limiter.try_acquire(chat, PRIORITY_BROADCAST) for chat in range(1, 9)]
+        assert taken.count(0.0) == 6
+        assert taken[-1] == pytest.approx(0.75)
+
+        # Results still get the rest of the global limit
+        assert await limiter.try_acquire(100, PRIORITY_RESULT) == 0.0
+        assert await limiter.try_acquire(101, PRIORITY_RESULT) == 0.0
+        # A private chat takes a few messages in a row, then waits for its window
+        assert await limiter.try_acquire(100, PRIORITY_RESULT) == 0.0
+        assert await limiter.try_acquire(100, PRIORITY_RESULT) == 0.0
+        assert await limiter.try_acquire(100, PRIORITY_RESULT) > 0
+
+    @pytest.mark.asyncio
+    async def test_retry_after_pauses_chat_and_retries(self, limiter):
+        """Test that RetryAfter pauses the chat and the call is sent again."""
+        from aiogram.exceptions import TelegramRetryAfter
+        from aiogram.methods import SendMessage
+        from bot.services.telegram_rate_limit import (
+            PRIORITY_PROGRESS,
+            TelegramRateLimitMiddleware,
+            telegram_priority,
+        )
+
+        middleware = TelegramRateLimitMiddleware(limiter)
+        method = SendMessage(chat_id=-100500, text="hi")
+        calls = []
+
+        async def make_request(bot, method):
+            calls.append(method)
+            if len(calls) == 1:
+                raise TelegramRetryAfter(method=method, message="Flood control", retry_after=0)
+            return "ok"
+
+        assert await middleware(make_request, None, method) == "ok"
+        assert len(calls) == 2
+
+        # Progress edits give up on RetryAfter and leave the chat paused
+        calls.clear()
+        with telegram_priority(PRIORITY_PROGRESS):
+            with pytest.raises(TelegramRetryAfter):
+                await middleware(make_request, None, method)
+        assert len(calls) == 1
+
+
+class TestBroadcast:
+    """Tests for the background broadcast engine."""
+
+    @pytest.mark.asyncio
+    async def test_broadcast_checkpoints_and_skips_blocked(self, test_engine, test_session, redis, monkeypatch):
+        """Test that a resumed broadcast skips sent users and blocked users are excluded later."""
+        from aiogram.exceptions import TelegramForbiddenError
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from bot.db import database
+        from bot.services import broadcast as broadcast_module
+
+        users = [User(telegram_id=1000 + i, tokens=0) for i in range(5)]
+        test_session.add_all(users)
+        await test_session.commit()
+
+        sent = []
+
+        class FakeBot:
+            async def copy_message(self, chat_id, from_chat_id, message_id):
+                if chat_id == 1002:
+                    raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+                sent.append(chat_id)
+
+            async def edit_message_text(self, **kwargs):
+                pass
+
+        maker = async_sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False)
+        monkeypatch.setattr(database, "get_session_maker", lambda: maker)
+        monkeypatch.setattr("bot.bot.get_bot", lambda: FakeBot())
+        monkeypatch.setattr(broadcast_module, "BATCH_SIZE", 2)
+
+        async def not_started(broadcast):
+            return False
+
+        monkeypatch.setattr(broadcast_module, "_start_if_free", not_started)
+        broadcast = await broadcast_module.create_broadcast(1, 10, 1, 11, redis=redis)
+        # Interrupted in the middle of the first page: its first user already got it
+        await redis.sadd(broadcast.batch_key, users[0].id)
+
+        assert await broadcast.acquire_lease()
+        await broadcast.run()
+
+        assert sent == [1001, 1003, 1004]
+        state = await broadcast.get_state()
+        assert state["status"] == "done"
+        assert (state["sent"], state["blocked"], state["failed"]) == ("4", "1", "0")
+        assert await redis.smembers(broadcast_module.ACTIVE_KEY) == set()
+
+        async with maker() as session:
+            recipients = await UserRepository(session).get_broadcast_recipients(0, 10)
+        assert [telegram_id for _, telegram_id in recipients] == [1000, 1001, 1003, 1004]
+
+    @pytest.mark.asyncio
+    async def test_lost_lease_stops_sending(self, test_engine, test_session, redis, monkeypatch):
+        """Test that a process whose lease was taken over neither sends nor checkpoints."""
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        from bot.db import database
+        from bot.services import broadcast as broadcast_module
+
+        test_session.add_all([User(telegram_id=2000 + i, tokens=0) for i in range(3)])
+        await test_session.commit()
+
+        sent = []
+
+        class FakeBot:
+            async def copy_message(self, chat_id, from_chat_id, message_id):
+                sent.append(chat_id)
+
+            async def edit_message_text(self, **kwargs):
+                pass
+
+        maker = async_sessionmaker(test_engine, class_=AsyncSession, expire_on_commit=False)
+        monkeypatch.setattr(database, "get_session_maker", lambda: maker)
+        monkeypatch.setattr("bot.bot.get_bot", lambda: FakeBot())
+
+        async def not_started(broadcast):
+            return False
+
+        monkeypatch.setattr(broadcast_module, "_start_if_free", not_started)
+        broadcast = await broadcast_module.create_broadcast(1, 10, 1, 11, redis=redis)
+        assert await broadcast.acquire_lease()
+        assert await broadcast.renew_lease()
+
+        # The lease expired and another replica took the broadcast over
+        await redis.set(broadcast.lease_key, "other")
+        assert not await broadcast.renew_lease()
+        await broadcast.run()
+
+        assert sent == []
+        state = await broadcast.get_state()
+        assert (state["status"], state["last_user_id"]) == ("running", "0")
+        assert await redis.get(broadcast.lease_key) == b"other"
@@ -4,8 +4,23 @@
 Usage:
     python worker.py
 
-Or with custom queue:
-    python worker.py --queue high
+By default the worker listens on every generation queue (gen:<provider>:<lane>)
+and the legacy default queue, serving them by GENERATION_QUEUE_WEIGHTS.
+
+Only the queues of one upstream provider:
+    python worker.py --provider seedream
+
+Or custom queues (repeatable):
+    python worker.py --queue gen:openai:paid --queue gen:openai:light
+
+Run 4 jobs concurrently in one process (default: WORKER_CONCURRENCY):
+    python worker.py --concurrency 4
+
+SIGTERM/SIGINT stop taking new jobs and wait up to WORKER_DRAIN_TIMEOUT
+seconds for running ones; a second signal exits immediately.
+
+Classic forking RQ worker (new process per job):
+    python worker.py --fork
 """
 
 import argparse
@@ -17,6 +32,14 @@ from redis import Redis
 from rq import Worker, Queue
 
 from bot.config import config
+from bot.db.database import ROLE_WORKER, set_process_role
+from bot.tasks.routing import (
+    LEGACY_QUEUE,
+    PROVIDERS,
+    WeightedDequeueMixin,
+    build_queue_selector,
+    generation_queue_names,
+)
 
 # Configure logging
 logging.basicConfig(
@@ -26,14 +49,23 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class WeightedWorker(WeightedDequeueMixin, Worker):
+    """Forking RQ worker with weighted queue selection."""
+
+
 def main():
     """Main entry point for RQ worker."""
     parser = argparse.ArgumentParser(description="RQ Worker for Telegram AI Image Bot")
     parser.add_argument(
         "--queue",
         "-q",
-        default="default",
-        help="Queue name to listen on (default: default)",
+        action="append",
+        help="Queue name to listen on, repeatable (default: all generation queues)",
+    )
+    parser.add_argument(
+        "--provider",
+        choices=PROVIDERS,
+        help="Listen only on the queues of this provider",
     )
     parser.add_argument(
         "--burst",
@@ -41,8 +73,24 @@ def main():
         action="store_true",
         help="Run in burst mode (exit when queue is empty)",
     )
+    parser.add_argument(
+        "--concurrency",
+        "-c",
+        type=int,
+        default=config.worker_concurrency,
+        help=f"Number of jobs processed concurrently by this process "
+        f"(default: WORKER_CONCURRENCY={config.worker_concurrency})",
+    )
+    parser.add_argument(
+        "--fork",
+        action="store_true",
+        help="Use classic forking RQ worker (one process and event loop per job)",
+    )
     args = parser.parse_args()
     
+    # Worker pool profile for every job of this process
+    set_process_role(ROLE_WORKER)
+    
     # Connect to Redis
     redis_conn = Redis.from_url(config.redis_url)
     # Mask password in URL for logging
@@ -56,15 +104,38 @@ def main():
         masked_url = config.redis_url
     logger.info(f"Connected to Redis at {masked_url}")
     
-    # Create queue
-    queue = Queue(name=args.queue, connection=redis_conn)
-    logger.info(f"Listening on queue: {args.queue}")
+    # Create queues
+    if args.queue:
+        queue_names = args.queue
+    elif args.provider:
+        queue_names = generation_queue_names(args.provider)
+    else:
+        queue_names = generation_queue_names() + [LEGACY_QUEUE]
+    queues = [Queue(name=name, connection=redis_conn) for name in queue_names]
+    logger.info(f"Listening on queues: {', '.join(queue_names)}")
+    
+    if args.fork:
+        # Start worker
+        worker = WeightedWorker(queues, connection=redis_conn)
+        if len(queues) > 1:
+            worker.queue_selector = build_queue_selector(queue_names)
+        
+        logger.info("Starting RQ worker...")
+        worker.work(burst=args.burst, with_scheduler=True)
+        return
     
-    # Start worker
-    worker = Worker([queue], connection=redis_conn)
+    # Persistent runtime: one event loop, DB pool and client set for the whole process
+    from bot.tasks.runtime import run_worker_slots
     
-    logger.info("Starting RQ worker...")
-    worker.work(burst=args.burst)
+    logger.info(f"Starting persistent RQ worker with {args.concurrency} slot(s)...")
+    run_worker_slots(
+        queues,
+        connection=redis_conn,
+        concurrency=args.concurrency,
+        burst=args.burst,
+        drain_timeout=config.worker_drain_timeout,
+        weighted=len(queues) > 1,
+    )
 
 
 if __name__ == "__main__":